@@ -0,0 +1,91 @@
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton for finding many phrases in a string in a single pass.
+
+    Usage:
+    automaton = AhoCorasick()
+    automaton.add('foo', 1)
+    automaton.add('oob', 2)
+    automaton.build()
+    list(automaton.iter('foobar')) = [(0, 3, 1), (1, 4, 2)]
+
+    Empty phrases are ignored, since they can't be found by walking the automaton.
+    """
+
+    def __init__(self):
+        # One entry per state, state 0 being the root.
+        # goto[state] maps a character to the next state
+        self.goto = [{}]
+        self.fail = [0]
+
+        # output[state] is a list of (phrase length, value) tuples that end in this state
+        self.output = [[]]
+
+        self.num_phrases = 0
+
+    def __len__(self):
+        return self.num_phrases
+
+    def add(self, phrase, value):
+        if not phrase:
+            return False
+
+        state = 0
+        for char in phrase:
+            next_state = self.goto[state].get(char, None)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = next_state
+            state = next_state
+
+        self.output[state].append((len(phrase), value))
+        self.num_phrases += 1
+        return True
+
+    def build(self):
+        """ Calculate the failure links. Must be called after the last add and before iter """
+        queue = deque()
+        for state in self.goto[0].values():
+            self.fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            parent = queue.popleft()
+            for char, state in self.goto[parent].items():
+                queue.append(state)
+
+                fail_state = self.fail[parent]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[state] = self.goto[fail_state].get(char, 0)
+
+                # The failure state is always shallower than this state,
+                # so its output list is already complete.
+                self.output[state] = self.output[state] + self.output[self.fail[state]]
+
+        return self
+
+    def iter(self, text):
+        """ Yields a (start, end, value) tuple for every phrase found in text.
+        start and end work like slice indices, so text[start:end] is the phrase. """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for length, value in output[state]:
+                yield index + 1 - length, index + 1, value
@@ -159,7 +159,7 @@ class BTTVApi(APIBase):
         self.headers = {}
 
     def get_global_emotes(self):
-        """Returns a list of global BTTV emotes in the standard Emote format."""
+        """Returns a list of global BTTV emotes in the standard Emote format, or None if the call failed."""
 
         emotes = []
         try:
@@ -167,6 +167,8 @@ class BTTVApi(APIBase):
 
             for emote in data['emotes']:
                 emotes.append({'emote_hash': emote['id'], 'code': emote['code']})
+
+            return emotes
         except urllib.error.HTTPError as e:
             if e.code == 502:
                 log.warning('Bad Gateway when getting global emotes.')
@@ -179,10 +181,10 @@ class BTTVApi(APIBase):
         except:
             log.exception('Uncaught exception in BTTVApi.get_global_emotes')
 
-        return emotes
+        return None
 
     def get_channel_emotes(self, channel):
-        """Returns a list of channel-specific BTTV emotes in the standard Emote format."""
+        """Returns a list of channel-specific BTTV emotes in the standard Emote format, or None if the call failed."""
 
         emotes = []
         try:
@@ -190,6 +192,8 @@ class BTTVApi(APIBase):
 
             for emote in data['emotes']:
                 emotes.append({'emote_hash': emote['id'], 'code': emote['code']})
+
+            return emotes
         except urllib.error.HTTPError as e:
             if e.code == 502:
                 log.warning('Bad Gateway when getting channel emotes.')
@@ -197,6 +201,7 @@ class BTTVApi(APIBase):
                 log.warning('Service Unavailable when getting channel emotes.')
             elif e.code == 404:
                 log.info('There are no BTTV Emotes for this channel.')
+                return []
             else:
                 log.exception('Unhandled HTTP error code')
         except KeyError:
@@ -204,7 +209,7 @@ class BTTVApi(APIBase):
         except:
             log.exception('Uncaught exception in BTTVApi.get_channel_emotes')
 
-        return emotes
+        return None
 
 
 class FFZApi(APIBase):
@@ -215,7 +220,7 @@ class FFZApi(APIBase):
         self.headers = {}
 
     def get_global_emotes(self):
-        """Returns a list of global FFZ emotes in the standard Emote format."""
+        """Returns a list of global FFZ emotes in the standard Emote format, or None if the call failed."""
 
         emotes = []
         try:
@@ -224,6 +229,8 @@ class FFZApi(APIBase):
             for emote_set in data['sets']:
                 for emote in data['sets'][emote_set]['emoticons']:
                     emotes.append({'emote_hash': emote['id'], 'code': emote['name']})
+
+            return emotes
         except urllib.error.HTTPError as e:
             if e.code == 502:
                 log.warning('Bad Gateway when getting global emotes.')
@@ -236,10 +243,10 @@ class FFZApi(APIBase):
         except:
             log.exception('Uncaught exception in FFZApi.get_global_emotes')
 
-        return emotes
+        return None
 
     def get_channel_emotes(self, channel):
-        """Returns a list of channel-specific FFZ emotes in the standard Emote format."""
+        """Returns a list of channel-specific FFZ emotes in the standard Emote format, or None if the call failed."""
 
         emotes = []
         try:
@@ -248,6 +255,8 @@ class FFZApi(APIBase):
             for emote_set in data['sets']:
                 for emote in data['sets'][emote_set]['emoticons']:
                     emotes.append({'emote_hash': emote['id'], 'code': emote['name']})
+
+            return emotes
         except urllib.error.HTTPError as e:
             if e.code == 502:
                 log.warning('Bad Gateway when getting channel emotes.')
@@ -255,6 +264,7 @@ class FFZApi(APIBase):
                 log.warning('Service Unavailable when getting channel emotes.')
             elif e.code == 404:
                 log.info('There are no FFZ Emotes for this channel.')
+                return []
             else:
                 log.exception('Unhandled HTTP error code')
         except KeyError:
@@ -262,7 +272,7 @@ class FFZApi(APIBase):
         except:
             log.exception('Uncaught exception in FFZApi.get_channel_emotes')
 
-        return emotes
+        return None
 
 
 class TwitchAPI(APIBase):
@@ -473,10 +483,10 @@ class SafeBrowsingAPI:
         self.appvers = appvers
         return
 
-    def check_url(self, url):
+    def check_url(self, url, session=requests):
         base_url = 'https://sb-ssl.google.com/safebrowsing/api/lookup?client=' + self.appname + '&key=' + self.apikey + '&appver=' + self.appvers + '&pver=3.1&url='
         url2 = base_url + urllib.parse.quote(url, '')
-        r = requests.get(url2)
+        r = session.get(url2)
 
         if r.status_code == 200:
             return True  # malware or phishing
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded chat log through the bot and report how fast it handles messages.
+
+Usage: python3 -m pajbot.bench chat.log --streamer pajlada --disable linkchecker --enable pyramid
+
+The log is a raw IRC log with one line per message, IRCv3 tags included, i.e.
+@badges=;display-name=Pajlada;emotes=25:0-4;subscriber=0 :pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #pajlada :Kappa 123
+PRIVMSG, WHISPER and USERNOTICE lines are replayed, everything else is ignored.
+
+The bot runs against a fresh SQLite database and an in-process redis (fakeredis),
+and never connects to anything. Requires the packages in requirements/bench.txt
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+
+log = logging.getLogger('pajbot')
+
+
+def run(args):
+    from pajbot.bench.bot import BenchBot
+    from pajbot.bench.replay import HandlerTimer
+    from pajbot.bench.replay import Replayer
+    from pajbot.bench.replay import load_events
+
+    events = load_events(args.log, limit=args.limit)
+    if not events:
+        log.error('No messages to replay in {}'.format(args.log))
+        return 1
+
+    streamer = args.streamer
+    if streamer is None:
+        streamer = events[0].target.lstrip('#')
+
+    modules = {}
+    for module_id in args.enable:
+        modules[module_id] = True
+    for module_id in args.disable:
+        modules[module_id] = False
+
+    workdir = tempfile.mkdtemp(prefix='pajbot-bench-')
+    try:
+        bot = BenchBot(streamer, workdir, modules=modules)
+        print('Enabled modules: {}'.format(', '.join(sorted(module.ID for module in bot.module_manager.modules))))
+
+        handler_timer = HandlerTimer()
+        handler_timer.install()
+
+        if args.warmup > 0:
+            Replayer(bot, events[:args.warmup]).run()
+            handler_timer.reset()
+            bot.irc.num_privmsgs = 0
+            bot.irc.num_whispers = 0
+
+        replayer = Replayer(bot, events, rate=args.rate)
+        replayer.run()
+
+        for line in replayer.report(handler_timer, num_handlers=args.handlers):
+            print(line)
+    finally:
+        shutil.rmtree(workdir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m pajbot.bench')
+    parser.add_argument('log',
+                        help='Raw IRC log to replay')
+    parser.add_argument('--streamer',
+                        help='Streamer the bot runs for (default: channel of the first message)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second to replay at (default: as fast as possible)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only replay the first LIMIT messages of the log')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='Replay the first WARMUP messages once before measuring')
+    parser.add_argument('--enable', action='append', default=[], metavar='MODULE_ID',
+                        help='Enable the module with the given ID, can be used multiple times')
+    parser.add_argument('--disable', action='append', default=[], metavar='MODULE_ID',
+                        help='Disable the module with the given ID, can be used multiple times')
+    parser.add_argument('--handlers', type=int, default=20,
+                        help='Number of handlers to list in the report')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Show log messages from the bot')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    sys.exit(run(args))
@@ -0,0 +1,151 @@
+import configparser
+import json
+import logging
+import os
+
+from sqlalchemy import event
+
+from pajbot.bot import Bot
+from pajbot.managers.db import Base
+from pajbot.managers.db import DBManager
+from pajbot.managers.irc import IRCManager
+from pajbot.managers.redis import RedisManager
+
+log = logging.getLogger(__name__)
+
+# Emotes that are put in redis before the emote managers are created,
+# so they don't try to download the global emote lists.
+BTTV_GLOBAL_EMOTES = [
+        'FeelsBadMan',
+        'FeelsGoodMan',
+        'FeelsAmazingMan',
+        'haHAA',
+        'KKona',
+        'LUL',
+        'monkaS',
+        'NaM',
+        'OMEGALUL',
+        'PepeHands',
+        'SourPls',
+        'WutFace',
+        ]
+FFZ_GLOBAL_EMOTES = [
+        'ZreknarF',
+        'LilZ',
+        'CatBag',
+        ]
+
+
+# Modules that are enabled by default, but connect to external services when enabled
+NETWORK_MODULES = [
+        'labspoints',
+        ]
+
+
+def compare_binary(a, b):
+    return (a > b) - (a < b)
+
+
+def create_config(streamer, db_path, nickname='benchbot'):
+    """ Returns a config with the values Bot.load_config requires, see config.example.ini """
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'main': {
+            'streamer': streamer,
+            'nickname': nickname,
+            'password': 'oauth:bench',
+            'db': 'sqlite:///{}'.format(db_path),
+            'timezone': 'UTC',
+            'trusted_mods': '0',
+            'offline_emotes': '1',
+            },
+        'web': {
+            'domain': 'localhost',
+            },
+        })
+    return config
+
+
+class BenchIRCManager(IRCManager):
+    """ Keeps track of what the bot sends instead of sending it anywhere """
+
+    def __init__(self, bot):
+        super().__init__(bot)
+
+        self.num_privmsgs = 0
+        self.num_whispers = 0
+
+    def start(self):
+        pass
+
+    def whisper(self, username, message):
+        self.num_whispers += 1
+
+    def privmsg(self, message, channel, increase_message=True):
+        self.num_privmsgs += 1
+
+    def on_disconnect(self, chatconn, event):
+        pass
+
+    def _dispatcher(self, connection, event):
+        pass
+
+
+class BenchBot(Bot):
+    """
+    A Bot that uses SQLite and an in-process redis (fakeredis), and never connects to anything.
+
+    modules is a dictionary of module IDs that should be enabled (True) or disabled (False).
+    Modules that are not in it use their ENABLED_DEFAULT value, except NETWORK_MODULES which are disabled.
+    """
+
+    def __init__(self, streamer, workdir, modules={}):
+        self.modules_override = modules
+        config = create_config(streamer, os.path.join(workdir, 'bench.db'))
+
+        super().__init__(config, args=BenchBot.Args())
+
+        # Replace the real IRC manager before it gets a chance to connect
+        self.irc = BenchIRCManager(self)
+
+    class Args:
+        silent = None
+
+    def load_config(self, config):
+        super().load_config(config)
+
+        try:
+            import fakeredis
+        except ImportError:
+            log.error('pajbot.bench requires fakeredis, see requirements/bench.txt')
+            raise
+
+        RedisManager.redis = fakeredis.FakeRedis(decode_responses=True)
+        RedisManager.redis.flushall()
+        self.seed_redis()
+
+    def seed_redis(self):
+        redis = RedisManager.get()
+        bttv_emotes = [{'code': code, 'emote_hash': 'bench{}'.format(i)} for i, code in enumerate(BTTV_GLOBAL_EMOTES)]
+        ffz_emotes = [{'code': code, 'emote_hash': str(i)} for i, code in enumerate(FFZ_GLOBAL_EMOTES)]
+        redis.set('global:emotes:bttv_global', json.dumps(bttv_emotes))
+        redis.set('global:emotes:ffz_global', json.dumps(ffz_emotes))
+
+    def init_database(self):
+        """ Create all tables straight from the models instead of running the migrations,
+        and apply the module overrides before the ModuleManager reads them """
+        import pajbot.models.hsbet  # NOQA
+        from pajbot.models.module import Module
+        from pajbot.modules import available_modules
+
+        @event.listens_for(DBManager.engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            # Some columns use MySQL collations, which SQLite has to know about
+            dbapi_connection.create_collation('utf8mb4_bin', compare_binary)
+
+        Base.metadata.create_all(DBManager.engine)
+
+        with DBManager.create_session_scope() as db_session:
+            for module in available_modules:
+                enabled = self.modules_override.get(module.ID, module.ENABLED_DEFAULT and module.ID not in NETWORK_MODULES)
+                db_session.merge(Module(module.ID, enabled=enabled))
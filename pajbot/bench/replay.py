@@ -0,0 +1,258 @@
+import functools
+import logging
+import time
+
+from irc.client import Event
+from irc.client import NickMask
+
+from pajbot.managers.handler import HandlerManager
+
+log = logging.getLogger(__name__)
+
+# IRC commands that are replayed, and the Bot.on_* method they end up in
+REPLAYED_TYPES = [
+        'pubmsg',
+        'action',
+        'whisper',
+        'usernotice',
+        ]
+
+TAG_ESCAPES = {
+        ':': ';',
+        's': ' ',
+        '\\': '\\',
+        'r': '\r',
+        'n': '\n',
+        }
+
+
+def unescape_tag_value(value):
+    """ Unescape an IRCv3 tag value, i.e. 'hello\\sworld' -> 'hello world' """
+    if '\\' not in value:
+        return value
+
+    parts = []
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == '\\' and index + 1 < len(value):
+            parts.append(TAG_ESCAPES.get(value[index + 1], value[index + 1]))
+            index += 2
+        else:
+            if char != '\\':
+                parts.append(char)
+            index += 1
+
+    return ''.join(parts)
+
+
+def parse_tags(raw_tags):
+    """ Returns the tags in the same format as the irc library, a list of {'key': ..., 'value': ...} """
+    tags = []
+    for item in raw_tags.split(';'):
+        key, _, value = item.partition('=')
+        tags.append({
+            'key': key,
+            'value': unescape_tag_value(value) or None,
+            })
+
+    return tags
+
+
+def parse_line(line):
+    """
+    Parse a raw IRC line into an irc.client.Event, the way the bot receives it.
+    Returns None for lines that are not replayed (see REPLAYED_TYPES).
+
+    Example:
+    @badges=;display-name=Pajlada;subscriber=0 :pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #pajlada :Kappa 123
+    """
+    line = line.rstrip('\r\n')
+    if not line:
+        return None
+
+    tags = []
+    if line[0] == '@':
+        raw_tags, _, line = line[1:].partition(' ')
+        tags = parse_tags(raw_tags)
+
+    source = None
+    if line[:1] == ':':
+        source, _, line = line[1:].partition(' ')
+
+    line, _, trailing = line.partition(' :')
+    arguments = line.split()
+    if not arguments:
+        return None
+
+    command = arguments.pop(0).upper()
+    target = arguments[0] if arguments else None
+
+    if command == 'PRIVMSG':
+        if target is None or target[:1] != '#':
+            return None
+
+        if trailing.startswith('\x01ACTION ') and trailing.endswith('\x01'):
+            return Event('action', NickMask(source), target, [trailing[8:-1]], tags)
+
+        return Event('pubmsg', NickMask(source), target, [trailing], tags)
+
+    if command == 'WHISPER':
+        return Event('whisper', NickMask(source), target, [trailing], tags)
+
+    if command == 'USERNOTICE':
+        return Event('usernotice', NickMask(source), target, [trailing] if trailing else [], tags)
+
+    return None
+
+
+def load_events(path, limit=None):
+    """ Returns the events from a raw IRC log file, one line per message """
+    events = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as log_file:
+        for line in log_file:
+            event = parse_line(line)
+            if event is not None:
+                events.append(event)
+                if limit is not None and len(events) >= limit:
+                    break
+
+    return events
+
+
+def percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0
+
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class HandlerTimer:
+    """
+    Wraps every handler in the HandlerManager to measure how much time is spent in it.
+
+    Key = handler name (i.e. LineFarmingModule.on_pubmsg)
+    Value = [number of calls, total time in seconds]
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def install(self):
+        for event, handlers in HandlerManager.handlers.items():
+            HandlerManager.handlers[event] = [(self.wrap(event, method), priority, context) for method, priority, context in handlers]
+
+    def wrap(self, event, method):
+        name = '{} ({})'.format(getattr(method, '__qualname__', repr(method)), event)
+        stats = self.handlers.setdefault(name, [0, 0.0])
+
+        @functools.wraps(method)
+        def timed_handler(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += time.perf_counter() - start
+
+        return timed_handler
+
+    def reset(self):
+        for stats in self.handlers.values():
+            stats[0] = 0
+            stats[1] = 0.0
+
+
+class Replayer:
+    """
+    Feeds events into the bot like the IRC dispatcher would, and measures how long each one takes.
+
+    rate is the target number of messages per second, or 0 to replay as fast as possible.
+    Scheduled bot functions (i.e. Bot.do_tick) are run in between messages when they're due,
+    and the time they take is reported separately.
+    """
+
+    def __init__(self, bot, events, rate=0):
+        self.bot = bot
+        self.events = events
+        self.rate = rate
+
+        self.latencies = []
+        self.scheduled_time = 0.0
+        self.elapsed = 0.0
+        self.num_skipped = 0
+
+    def dispatch(self, event):
+        method = getattr(self.bot, 'on_' + event.type, None)
+        if method is None:
+            self.num_skipped += 1
+            return
+
+        method(None, event)
+
+    def run(self):
+        interval = 1.0 / self.rate if self.rate > 0 else 0
+        latencies = []
+        scheduled_time = 0.0
+
+        start = time.perf_counter()
+        for index, event in enumerate(self.events):
+            if interval:
+                delay = start + index * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            message_start = time.perf_counter()
+            try:
+                self.dispatch(event)
+            except:
+                log.exception('Uncaught exception while replaying {}'.format(event))
+            message_end = time.perf_counter()
+            latencies.append(message_end - message_start)
+
+            # Run scheduled functions that are due, like the reactor would between two messages
+            self.bot.reactor.process_timeout()
+            scheduled_time += time.perf_counter() - message_end
+
+        self.elapsed = time.perf_counter() - start
+        self.latencies = latencies
+        self.scheduled_time = scheduled_time
+
+    def report(self, handler_timer=None, num_handlers=20):
+        lines = []
+        num_messages = len(self.latencies)
+        sorted_latencies = sorted(self.latencies)
+        busy_time = sum(self.latencies)
+
+        lines.append('Replayed {} messages in {:.2f}s ({} skipped)'.format(num_messages, self.elapsed, self.num_skipped))
+        if num_messages == 0:
+            return lines
+
+        lines.append('Throughput: {:.0f} messages/s ({:.0f} messages/s of bot time)'.format(
+            num_messages / self.elapsed,
+            num_messages / busy_time if busy_time > 0 else 0))
+        lines.append('Latency: p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(
+            percentile(sorted_latencies, 50) * 1000,
+            percentile(sorted_latencies, 90) * 1000,
+            percentile(sorted_latencies, 99) * 1000,
+            sorted_latencies[-1] * 1000))
+        lines.append('Scheduled functions (ticks etc.): {:.2f}s'.format(self.scheduled_time))
+        lines.append('Sent {} messages and {} whispers'.format(self.bot.irc.num_privmsgs, self.bot.irc.num_whispers))
+
+        if handler_timer is not None:
+            handlers = sorted(handler_timer.handlers.items(), key=lambda h: h[1][1], reverse=True)
+            lines.append('')
+            lines.append('{:<60} {:>8} {:>10} {:>10} {:>6}'.format('Handler', 'Calls', 'Total ms', 'Mean us', '%'))
+            for name, (calls, total) in handlers[:num_handlers]:
+                if calls == 0:
+                    continue
+                lines.append('{:<60} {:>8} {:>10.1f} {:>10.1f} {:>6.1f}'.format(
+                    name[:60],
+                    calls,
+                    total * 1000,
+                    total / calls * 1000000,
+                    total / busy_time * 100 if busy_time > 0 else 0))
+
+        return lines
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Measure how long finding the URLs of a message takes, per message.
+
+Usage: python3 -m pajbot.bench.urls chat.log
+
+Compares find_url_matches (what the bot uses) with running Bot.url_regex over the whole message,
+on the messages of a raw IRC log (see pajbot.bench), and checks that both find the same URLs.
+Only needs the packages the bot itself needs.
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+
+
+def measure(messages, find, repeat):
+    """ Returns the lowest per-message time of find over repeat runs, in microseconds """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            find(message)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / len(messages) * 1000000
+
+
+def run(args):
+    from pajbot.bench.replay import load_events
+    from pajbot.bot import Bot
+    from pajbot.modules.linkchecker import URL_PREFILTER
+    from pajbot.modules.linkchecker import find_url_matches
+
+    messages = [event.arguments[0] for event in load_events(args.log, limit=args.limit) if event.arguments]
+    if not messages:
+        print('No messages in {}'.format(args.log))
+        return 1
+
+    regex = re.compile(Bot.url_regex_str, re.IGNORECASE)
+
+    num_mismatches = 0
+    for message in messages:
+        if [match.group(0) for match in find_url_matches(regex, message)] != [match.group(0) for match in regex.finditer(message)]:
+            num_mismatches += 1
+            print('Different URLs found in {!r}'.format(message))
+
+    num_candidates = sum(1 for message in messages if URL_PREFILTER.search(message) is not None)
+    old = measure(messages, lambda message: list(regex.finditer(message)), args.repeat)
+    new = measure(messages, lambda message: find_url_matches(regex, message), args.repeat)
+
+    print('{} messages, {} ({:.1f}%) might contain a URL'.format(len(messages), num_candidates, num_candidates / len(messages) * 100))
+    print('url_regex over the whole message: {:.2f}us per message'.format(old))
+    print('find_url_matches:                 {:.2f}us per message ({:.1f}x)'.format(new, old / new if new > 0 else 0))
+
+    return 1 if num_mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m pajbot.bench.urls')
+    parser.add_argument('log',
+                        help='Raw IRC log to take the messages from')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first LIMIT messages of the log')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times to run through the messages, the fastest run is reported')
+
+    args = parser.parse_args()
+
+    sys.exit(run(args))
@@ -17,6 +17,8 @@ import pajbot.models.user
 import pajbot.utils
 from pajbot.actions import ActionQueue
 from pajbot.apiwrappers import TwitchAPI
+from pajbot.managers.chatlog import ChatLog
+from pajbot.managers.chatlog import ChatLogWriter
 from pajbot.managers.command import CommandManager
 from pajbot.managers.db import DBManager
 from pajbot.managers.deck import DeckManager
@@ -26,6 +28,8 @@ from pajbot.managers.handler import HandlerManager
 from pajbot.managers.irc import MultiIRCManager
 from pajbot.managers.irc import SingleIRCManager
 from pajbot.managers.kvi import KVIManager
+from pajbot.managers.moderation import ModerationManager
+from pajbot.managers.recentchat import RecentChatManager
 from pajbot.managers.redis import RedisManager
 from pajbot.managers.schedule import ScheduleManager
 from pajbot.managers.time import TimeManager
@@ -34,6 +38,7 @@ from pajbot.managers.user import UserManager
 from pajbot.managers.websocket import WebSocketManager
 from pajbot.models.action import ActionParser
 from pajbot.models.banphrase import BanphraseManager
+from pajbot.models.message import MessageContext
 from pajbot.models.module import ModuleManager
 from pajbot.models.pleblist import PleblistManager
 from pajbot.models.sock import SocketManager
@@ -165,16 +170,19 @@ class Bot:
 
         RedisManager.init(**redis_options)
 
+    def init_database(self):
+        # Update the database scheme if necessary using alembic
+        # In case of errors, i.e. if the database is out of sync or the alembic
+        # binary can't be called, we will shut down the bot.
+        pajbot.utils.alembic_upgrade()
+
     def __init__(self, config, args=None):
         # Load various configuration variables from the given config object
         # The config object that should be passed through should
         # come from pajbot.utils.load_config
         self.load_config(config)
 
-        # Update the database scheme if necessary using alembic
-        # In case of errors, i.e. if the database is out of sync or the alembic
-        # binary can't be called, we will shut down the bot.
-        pajbot.utils.alembic_upgrade()
+        self.init_database()
 
         # Actions in this queue are run in a separate thread.
         # This means actions should NOT access any database-related stuff.
@@ -187,6 +195,11 @@ class Bot:
 
         HandlerManager.init_handlers()
 
+        # Handlers that take longer than this many seconds are logged while profiling, see !debug handlers
+        self.slow_handler_threshold = self.config['main'].getint('slow_handler_ms', 50) / 1000
+        if self.config['main'].getboolean('handler_profiling', False):
+            HandlerManager.enable_profiling(slow_threshold=self.slow_handler_threshold)
+
         self.socket_manager = SocketManager(self)
         self.stream_manager = StreamManager(self)
 
@@ -206,6 +219,14 @@ class Bot:
         self.kvi = KVIManager()
         self.emotes = EmoteManager(self)
         self.twitter_manager = TwitterManager(self)
+        self.moderation = ModerationManager(self)
+        self.recent_chat = RecentChatManager(max_size=self.config['main'].getint('recent_chat_size', 10000))
+
+        self.chat_log = None
+        chat_log_dir = self.config['main'].get('chat_log_dir', None)
+        if chat_log_dir:
+            self.chat_log = ChatLogWriter(ChatLog(chat_log_dir))
+            self.chat_log.start()
 
         HandlerManager.trigger('on_managers_loaded')
 
@@ -601,6 +622,10 @@ class Bot:
     def _timeout_user(self, user, duration, reason=''):
         self._timeout(user.username, duration, reason)
 
+    def moderate_bulk(self, usernames, action, duration=None, reason='', on_finished=None):
+        """ Timeout/ban/unban many users at once, see ModerationManager.moderate_bulk """
+        return self.moderation.moderate_bulk(usernames, action, duration=duration, reason=reason, on_finished=on_finished)
+
     def whisper(self, username, *messages, separator='. '):
         """
         Takes a sequence of strings and concatenates them with separator.
@@ -693,27 +718,25 @@ class Bot:
     def on_disconnect(self, chatconn, event):
         self.irc.on_disconnect(chatconn, event)
 
-    def parse_message(self, msg_raw, source, event, tags={}, whisper=False):
-        msg_lower = msg_raw.lower()
-
-        emote_tag = None
-
-        for tag in tags:
-            if tag['key'] == 'subscriber' and event.target == self.channel:
-                source.subscriber = tag['value'] == '1'
-            elif tag['key'] == 'emotes' and tag['value']:
-                emote_tag = tag['value']
-            elif tag['key'] == 'display-name' and tag['value']:
-                source.username_raw = tag['value']
-            elif tag['key'] == 'user-type':
-                source.moderator = tag['value'] == 'mod' or source.username == self.streamer
-
-        # source.num_lines += 1
+    def parse_message(self, message_context):
+        source = message_context.source
+        msg_raw = message_context.message
+        tags = message_context.tags
+        whisper = message_context.whisper
 
         if source is None:
             log.error('No valid user passed to parse_message')
             return False
 
+        if 'subscriber' in tags and message_context.event.target == self.channel:
+            source.subscriber = tags['subscriber'] == '1'
+        if tags.get('display-name', None):
+            source.username_raw = tags['display-name']
+        if 'user-type' in tags:
+            source.moderator = tags['user-type'] == 'mod' or source.username == self.streamer
+
+        # source.num_lines += 1
+
         if source.banned:
             self.ban(source.username)
             return False
@@ -723,17 +746,16 @@ class Bot:
             source.timed_out = False
 
         # Parse emotes in the message
-        message_emotes = self.emotes.parse_message_twitch_emotes(source, msg_raw, emote_tag, whisper)
+        message_emotes = message_context.emotes
 
-        urls = self.find_unique_urls(msg_raw)
+        if not whisper:
+            self.stream_manager.chat_stats.add_message(message_context.words_lower if msg_raw[:1] != '!' else [], message_emotes)
 
         if whisper:
             self.whisper('datguy1', '{} said: {}'.format(source.username, msg_raw))
         # log.debug('{2}{0}: {1}'.format(source.username, msg_raw, '<w>' if whisper else ''))
 
-        res = HandlerManager.trigger('on_message',
-                source, msg_raw, message_emotes, whisper, urls, event,
-                stop_on_false=True)
+        res = HandlerManager.trigger_context('on_message', message_context, stop_on_false=True)
         if res is False:
             return False
 
@@ -743,10 +765,9 @@ class Bot:
         if source.ignored:
             return False
 
-        if msg_lower[:1] == '!':
-            msg_lower_parts = msg_lower.split(' ')
-            trigger = msg_lower_parts[0][1:]
-            msg_raw_parts = msg_raw.split(' ')
+        if msg_raw[:1] == '!':
+            trigger = message_context.words_lower[0][1:]
+            msg_raw_parts = message_context.words
             remaining_message = ' '.join(msg_raw_parts[1:]) if len(msg_raw_parts) > 1 else None
             if trigger in self.commands:
                 command = self.commands[trigger]
@@ -754,7 +775,7 @@ class Bot:
                         'emotes': message_emotes,
                         'trigger': trigger,
                         }
-                command.run(self, source, remaining_message, event=event, args=extra_args, whisper=whisper)
+                command.run(self, source, remaining_message, event=message_context.event, args=extra_args, whisper=whisper)
 
     @time_method
     def redis_test(self, username):
@@ -786,7 +807,7 @@ class Bot:
         username = event.source.user.lower()
 
         with self.users.get_user_context(username) as source:
-            self.parse_message(event.arguments[0], source, event, whisper=True, tags=event.tags)
+            self.parse_message(MessageContext(self, source, event.arguments[0], event, whisper=True))
 
     def on_ping(self, chatconn, event):
         # self.say('Received a ping. Last ping received {} ago'.format(time_since(datetime.datetime.now().timestamp(), self.last_ping.timestamp())))
@@ -830,14 +851,17 @@ class Bot:
 
         username = event.source.user.lower()
 
+        self.recent_chat.add(username, event.arguments[0])
+        if self.chat_log is not None:
+            self.chat_log.add(username, event.arguments[0])
+
         # We use .lower() in case twitch ever starts sending non-lowercased usernames
         with self.users.get_user_context(username) as source:
-            res = HandlerManager.trigger('on_pubmsg',
-                    source, event.arguments[0],
-                    stop_on_false=True)
+            message_context = MessageContext(self, source, event.arguments[0], event)
+            res = HandlerManager.trigger_context('on_pubmsg', message_context, stop_on_false=True)
             if res is False:
                 return False
-            self.parse_message(event.arguments[0], source, event, tags=event.tags)
+            self.parse_message(message_context)
 
     @time_method
     def reload_all(self):
@@ -861,6 +885,10 @@ class Bot:
 
     def do_tick(self):
         HandlerManager.trigger('on_tick')
+        self.users.flush()
+
+        if HandlerManager.profiler is not None:
+            HandlerManager.profiler.publish()
 
     def quit(self, message, event, **options):
         quit_chub = self.config['main'].get('control_hub', None)
@@ -880,6 +908,10 @@ class Bot:
 
     def quit_bot(self, **options):
         self.commit_all()
+        self.users.flush(force=True)
+        self.emotes.flush()
+        if self.chat_log is not None:
+            self.chat_log.close()
         quit = '{nickname} {version} shutting down...'
         phrase_data = {
                 'nickname': self.nickname,
@@ -23,8 +23,10 @@ class AdminLogManager:
             'Banphrase edited': LogEntryTemplate('Edited banphrase from "{}"'),
             'Banphrase removed': LogEntryTemplate('Removed banphrase "{}"'),
             'Banphrase toggled': LogEntryTemplate('{} banphrase "{}"'),
+            'Banphrase timed out': LogEntryTemplate('Disabled banphrase "{}" because it took too long to run'),
             'Blacklist link added': LogEntryTemplate('Added blacklist link "{}"'),
             'Blacklist link removed': LogEntryTemplate('Removed blacklisted link "{}"'),
+            'Filter timed out': LogEntryTemplate('Disabled filter "{}" because it took too long to run'),
             'Module edited': LogEntryTemplate('Edited module "{}"'),
             'Module toggled': LogEntryTemplate('{} module "{}"'),
             'Timer added': LogEntryTemplate('Added timer "{}"'),
@@ -45,7 +47,7 @@ class AdminLogManager:
 
         payload = {
                 'type': type,
-                'user_id': source.id,
+                'user_id': source.id if source else None,
                 'message': message,
                 'created_at': str(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')),
                 'data': data,
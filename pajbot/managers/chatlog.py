@@ -0,0 +1,342 @@
+import calendar
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+import regex as re
+
+from pajbot.managers.schedule import ScheduleManager
+
+log = logging.getLogger(__name__)
+
+
+class ChatLogSegment:
+    """
+    One day (UTC) of chat, written to {date}.log while the day is going on.
+    Once the day is over the segment is rolled: compressed to {date}.log.gz, one gzip member per minute,
+    so a single minute can be read without decompressing the rest of the day.
+
+    The index of the segment is stored in {date}.idx:
+    minutes: minute of the day -> [offset, length] of the lines of that minute in the (compressed) log file
+    users: username -> the minutes of the day the user said something in
+    """
+
+    def __init__(self, directory, date):
+        self.date = date
+
+        base_path = os.path.join(directory, date.isoformat())
+        self.log_path = base_path + '.log'
+        self.compressed_path = base_path + '.log.gz'
+        self.index_path = base_path + '.idx'
+
+        self.minutes = {}
+        self.users = {}
+        self.compressed = False
+
+    @property
+    def start(self):
+        """ Unix timestamp of the start of the day """
+        return calendar.timegm(self.date.timetuple())
+
+    def minute_of(self, timestamp):
+        return min(max(int((timestamp - self.start) // 60), 0), 24 * 60 - 1)
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r') as index_file:
+                data = json.load(index_file)
+        except FileNotFoundError:
+            return False
+
+        self.minutes = {int(minute): offset for minute, offset in data['minutes'].items()}
+        self.users = data['users']
+        self.compressed = data['compressed']
+        return True
+
+    def save_index(self):
+        data = {
+                'minutes': self.minutes,
+                'users': self.users,
+                'compressed': self.compressed,
+                }
+
+        # Write to a temporary file first so the web process never reads half an index
+        with open(self.index_path + '.tmp', 'w') as index_file:
+            json.dump(data, index_file, separators=(',', ':'))
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def read_minutes(self, minutes):
+        """ Yields the (timestamp, username, message) tuples of the given minutes, oldest first """
+        minutes = sorted(minute for minute in minutes if minute in self.minutes)
+        if not minutes:
+            return
+
+        with open(self.compressed_path if self.compressed else self.log_path, 'rb') as log_file:
+            for minute in minutes:
+                offset, length = self.minutes[minute]
+                log_file.seek(offset)
+                data = log_file.read(length)
+                if self.compressed:
+                    data = gzip.decompress(data)
+
+                for line in data.decode('utf-8').splitlines():
+                    yield ChatLog.parse_line(line)
+
+    def roll(self):
+        """ Compress the log file, one gzip member per minute """
+        minutes = {}
+        with open(self.log_path, 'rb') as log_file, open(self.compressed_path + '.tmp', 'wb') as compressed_file:
+            for minute in sorted(self.minutes):
+                offset, length = self.minutes[minute]
+                log_file.seek(offset)
+                data = gzip.compress(log_file.read(length))
+                minutes[minute] = [compressed_file.tell(), len(data)]
+                compressed_file.write(data)
+
+        os.replace(self.compressed_path + '.tmp', self.compressed_path)
+        self.minutes = minutes
+        self.compressed = True
+        self.save_index()
+        os.remove(self.log_path)
+
+
+class ChatLog:
+    """
+    Reads the chat log in directory, see ChatLogWriter for how it's written.
+    Used by the bot and the web interface.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def format_line(timestamp, username, message):
+        return '{:.3f}\t{}\t{}\n'.format(timestamp, username, message.replace('\n', ' ').replace('\r', ' '))
+
+    def parse_line(line):
+        timestamp, username, message = line.split('\t', 2)
+        return float(timestamp), username, message
+
+    def dates(self):
+        """ Dates there is a segment for, oldest first """
+        dates = []
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return dates
+
+        for filename in filenames:
+            if filename.endswith('.idx'):
+                try:
+                    dates.append(datetime.datetime.strptime(filename[:-4], '%Y-%m-%d').date())
+                except ValueError:
+                    pass
+
+        return sorted(dates)
+
+    def segment(self, date):
+        """ The segment of the given date, or None if nothing was said on that date """
+        segment = ChatLogSegment(self.directory, date)
+        if not segment.load_index():
+            return None
+
+        return segment
+
+    def read(self, date, minutes, line_filter):
+        """ Messages in the minutes(segment) minutes of a segment that line_filter returns True for """
+        segment = self.segment(date)
+        if segment is None:
+            return []
+
+        try:
+            return [line for line in segment.read_minutes(minutes(segment)) if line_filter(line)]
+        except FileNotFoundError:
+            # The segment was rolled between loading the index and reading the log
+            segment = self.segment(date)
+            return [line for line in segment.read_minutes(minutes(segment)) if line_filter(line)]
+
+    def dates_between(self, start, end, days):
+        end_date = datetime.datetime.utcfromtimestamp(end).date()
+        start_date = end_date - datetime.timedelta(days=days - 1)
+        if start is not None:
+            start_date = max(start_date, datetime.datetime.utcfromtimestamp(start).date())
+
+        return [date for date in reversed(self.dates()) if start_date <= date <= end_date]
+
+    def user_messages(self, username, start=None, end=None, days=7, limit=100):
+        """ The last limit messages of the user between start and end (unix timestamps) in the last days segments,
+        oldest first """
+        if end is None:
+            end = time.time()
+
+        result = []
+        for date in self.dates_between(start, end, days):
+            def minutes(segment):
+                first_minute = segment.minute_of(start) if start is not None else 0
+                last_minute = segment.minute_of(end)
+                return [minute for minute in segment.users.get(username, []) if first_minute <= minute <= last_minute]
+
+            lines = self.read(date, minutes, lambda line: line[1] == username and (start is None or line[0] >= start) and line[0] <= end)
+            result = lines + result
+            if len(result) >= limit:
+                break
+
+        return result[-limit:]
+
+    def search(self, phrase=None, regex=None, start=None, end=None, days=1, limit=100, ignore_case=False, timeout=5):
+        """
+        The last limit messages between start and end in the last days segments that contain phrase,
+        or match regex (a string or a compiled pattern from the regex module), oldest first.
+
+        Raises regex.error if regex is not a valid regular expression, and TimeoutError
+        if matching regex against the messages takes longer than timeout seconds in total (None = no limit).
+        """
+        if end is None:
+            end = time.time()
+
+        if regex is not None:
+            if isinstance(regex, str):
+                regex = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+
+            deadline = time.perf_counter() + timeout if timeout is not None else None
+
+            def matches(message):
+                if deadline is None:
+                    return regex.search(message) is not None
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError('regex search timed out')
+
+                return regex.search(message, timeout=remaining) is not None
+        elif ignore_case:
+            phrase = phrase.lower()
+
+            def matches(message):
+                return phrase in message.lower()
+        else:
+            def matches(message):
+                return phrase in message
+
+        result = []
+        for date in self.dates_between(start, end, days):
+            def minutes(segment):
+                first_minute = segment.minute_of(start) if start is not None else 0
+                last_minute = segment.minute_of(end)
+                return [minute for minute in segment.minutes if first_minute <= minute <= last_minute]
+
+            lines = self.read(date, minutes, lambda line: matches(line[2]) and (start is None or line[0] >= start) and line[0] <= end)
+            result = lines + result
+            if len(result) >= limit:
+                break
+
+        return result[-limit:]
+
+
+class ChatLogWriter:
+    """
+    Appends chat messages to the chat log.
+
+    Messages are buffered in memory and written to disk every FLUSH_INTERVAL seconds from the
+    ScheduleManager thread, so writing (and compressing the segment of the previous day) never blocks the bot.
+    """
+
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, chat_log):
+        self.chat_log = chat_log
+
+        # (timestamp, username, message) tuples that have not been written yet
+        self.buffer = []
+        self.lock = threading.Lock()
+
+        # Only one flush can run at a time
+        self.flush_lock = threading.Lock()
+
+        self.segment = None
+        self.log_file = None
+        self.last_minute = 0
+
+    def start(self):
+        os.makedirs(self.chat_log.directory, exist_ok=True)
+        ScheduleManager.execute_now(self.roll_old_segments)
+        ScheduleManager.execute_every(self.FLUSH_INTERVAL, self.flush)
+
+    def add(self, username, message, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            self.buffer.append((timestamp, username, message))
+
+    def roll_old_segments(self):
+        """ Compress segments of previous days that were not rolled, i.e. because the bot was restarted """
+        today = datetime.datetime.utcnow().date()
+        with self.flush_lock:
+            for date in self.chat_log.dates():
+                if date >= today or (self.segment is not None and date == self.segment.date):
+                    continue
+
+                segment = self.chat_log.segment(date)
+                if not segment.compressed:
+                    log.info('Rolling chat log segment {}'.format(date))
+                    segment.roll()
+
+    def open_segment(self, date):
+        if self.segment is not None:
+            self.log_file.close()
+            log.info('Rolling chat log segment {}'.format(self.segment.date))
+            try:
+                self.segment.roll()
+            except:
+                log.exception('Failed to roll chat log segment {}'.format(self.segment.date))
+
+        self.segment = ChatLogSegment(self.chat_log.directory, date)
+        self.segment.load_index()
+        self.log_file = open(self.segment.log_path, 'ab')
+        self.last_minute = max(self.segment.minutes, default=0)
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+
+        if not buffer:
+            return
+
+        with self.flush_lock:
+            for timestamp, username, message in buffer:
+                date = datetime.datetime.utcfromtimestamp(timestamp).date()
+                if self.segment is None or date > self.segment.date:
+                    self.open_segment(date)
+
+                # The lines of a minute have to be next to each other in the file
+                minute = max(self.segment.minute_of(timestamp), self.last_minute)
+                data = ChatLog.format_line(timestamp, username, message).encode('utf-8')
+
+                offset = self.segment.minutes.get(minute, None)
+                if offset is None:
+                    self.segment.minutes[minute] = [self.log_file.tell(), len(data)]
+                else:
+                    offset[1] += len(data)
+                self.last_minute = minute
+
+                user_minutes = self.segment.users.setdefault(username, [])
+                if not user_minutes or user_minutes[-1] != minute:
+                    user_minutes.append(minute)
+
+                self.log_file.write(data)
+
+            self.log_file.flush()
+            self.segment.save_index()
+
+    def close(self):
+        self.flush()
+
+        with self.flush_lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+                self.segment = None
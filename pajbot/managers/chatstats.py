@@ -0,0 +1,172 @@
+import collections
+import heapq
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class SpaceSaving:
+    """
+    The most frequent items of a stream of items, in memory for at most capacity items (the Space-Saving algorithm).
+
+    An item that is not tracked yet replaces the tracked item with the lowest count and takes over its count,
+    so counts are never lower than the real count, and at most the lowest tracked count too high.
+    Adding an item is O(log capacity).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        # Key = item
+        # Value = count
+        self.counts = {}
+
+        # (count, item) of every tracked item, with outdated pairs that are skipped when they're popped
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+        else:
+            min_count, min_item = self.pop_min()
+            del self.counts[min_item]
+            self.counts[item] = min_count + count
+
+        heapq.heappush(self.heap, (self.counts[item], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def pop_min(self):
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if self.counts.get(item, None) == count:
+                return count, item
+
+    def top(self, n):
+        """ The n items with the highest counts as (item, count), highest first """
+        return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+
+class RollingTopK:
+    """
+    The most frequent items of the last num_buckets * bucket_length seconds,
+    with a SpaceSaving of capacity items for every bucket_length seconds.
+    """
+
+    def __init__(self, num_buckets, bucket_length, capacity):
+        self.num_buckets = num_buckets
+        self.bucket_length = bucket_length
+        self.capacity = capacity
+
+        # [start of the bucket, SpaceSaving], oldest first
+        self.buckets = deque()
+
+    def bucket(self, now):
+        start = now - now % self.bucket_length
+        if not self.buckets or self.buckets[-1][0] < start:
+            self.buckets.append([start, SpaceSaving(self.capacity)])
+            while start - self.buckets[0][0] >= self.num_buckets * self.bucket_length:
+                self.buckets.popleft()
+
+        return self.buckets[-1][1]
+
+    def add(self, item, count=1, now=None):
+        if now is None:
+            now = time.time()
+
+        self.bucket(now).add(item, count)
+
+    def top(self, n, seconds, now=None):
+        """ The n most frequent items of the last seconds seconds (rounded up to whole buckets) as (item, count) """
+        if now is None:
+            now = time.time()
+
+        counts = collections.Counter()
+        for start, bucket in self.buckets:
+            if start + self.bucket_length > now - seconds:
+                counts.update(bucket.counts)
+
+        return counts.most_common(n)
+
+
+class ChatStats:
+    """
+    The most used emotes and words of the last minute, the last 10 minutes and the current stream.
+    Fed with every chat message from Bot.parse_message, the cost per message only depends on its length.
+
+    Words are lowercased, counted once per message, and don't include emotes.
+    """
+
+    WINDOWS = collections.OrderedDict([
+        ('1m', 60),
+        ('10m', 600),
+        ('stream', None),
+        ])
+
+    BUCKET_LENGTH = 10
+
+    def __init__(self, capacity=100, stream_capacity=1000):
+        self.capacity = capacity
+        self.stream_capacity = stream_capacity
+
+        self.recent = {
+                'emotes': RollingTopK(600 // self.BUCKET_LENGTH, self.BUCKET_LENGTH, capacity),
+                'words': RollingTopK(600 // self.BUCKET_LENGTH, self.BUCKET_LENGTH, capacity),
+                }
+        self.reset_stream()
+
+    def reset_stream(self):
+        self.stream = {
+                'emotes': SpaceSaving(self.stream_capacity),
+                'words': SpaceSaving(self.stream_capacity),
+                }
+
+    def add_message(self, words, emotes, now=None):
+        """ words is the lowercased message split on spaces, emotes are the emotes of the message (see EmoteManager) """
+        if now is None:
+            now = time.time()
+
+        emote_codes = set()
+        for emote in emotes:
+            self.recent['emotes'].add(emote['code'], emote['count'], now)
+            self.stream['emotes'].add(emote['code'], emote['count'])
+            emote_codes.add(emote['code'].lower())
+
+        seen = set()
+        for word in words:
+            if not word or word in seen or word in emote_codes:
+                continue
+
+            seen.add(word)
+            self.recent['words'].add(word, 1, now)
+            self.stream['words'].add(word, 1)
+
+    def top(self, kind, window, n=5, now=None):
+        """ The n most used emotes (kind='emotes') or words (kind='words') of the window (see WINDOWS) as (item, count) """
+        if kind not in self.recent or window not in self.WINDOWS:
+            raise ValueError('Unknown chat stats {}_{}'.format(kind, window))
+
+        if window == 'stream':
+            return self.stream[kind].top(n)
+
+        return self.recent[kind].top(n, self.WINDOWS[window], now=now)
+
+    def summary(self, n=10, now=None):
+        if now is None:
+            now = time.time()
+
+        data = {
+                'updated_at': now,
+                }
+        for kind in self.recent:
+            data[kind] = {window: self.top(kind, window, n=n, now=now) for window in self.WINDOWS}
+
+        return data
@@ -2,6 +2,10 @@ import logging
 import random
 import socket
 import ssl
+import threading
+import time
+from collections import deque
+from collections import OrderedDict
 
 import irc
 from irc.client import InvalidCharacters
@@ -47,21 +51,432 @@ class CustomServerConnection(irc.client.ServerConnection):
 
 
 class Connection(CustomServerConnection):
-    def __init__(self, reactor):
+    # Seconds a sent message counts towards the load of the connection
+    LOAD_WINDOW = 30
+
+    def __init__(self, reactor, send_only=False):
         super().__init__(reactor)
 
-        self.num_msgs_sent = 0
         self.in_channel = False
 
-    def reduce_msgs_sent(self):
-        self.num_msgs_sent -= 1
+        # Send-only connections are only used to send messages from, events they receive are ignored
+        self.send_only = send_only
+
+        self.last_ping = time.time()
+        self.last_pong = time.time()
+
+        # Times messages were sent from this connection at, oldest first
+        self.sent = deque()
+
+    def record_send(self, now=None):
+        self.sent.append(time.time() if now is None else now)
+
+    def load(self, now=None):
+        """ Number of messages sent from this connection in the last LOAD_WINDOW seconds """
+        if now is None:
+            now = time.time()
+
+        while self.sent and self.sent[0] <= now - self.LOAD_WINDOW:
+            self.sent.popleft()
+
+        return len(self.sent)
+
+
+class RateLimiter:
+    """
+    Allows at most limit() messages in any window of interval seconds.
+    limit is a function so changes to the limit (i.e. TMI.promote_to_verified) apply right away.
+    """
+
+    def __init__(self, limit, interval):
+        self.limit = limit
+        self.interval = interval
+
+        # Times the messages in the current window were sent at, oldest first
+        self.sent = deque()
+
+    def expire(self, now):
+        while self.sent and self.sent[0] <= now - self.interval:
+            self.sent.popleft()
+
+    def available(self, now=None):
+        """ Number of messages that can be sent right now """
+        if now is None:
+            now = time.time()
+
+        self.expire(now)
+        return self.limit() - len(self.sent)
+
+    def consume(self, now=None):
+        self.sent.append(time.time() if now is None else now)
+
+    def next_available(self, now=None):
+        """ Seconds until the next message can be sent """
+        if now is None:
+            now = time.time()
+
+        if self.available(now) > 0:
+            return 0
+
+        # The message that has to leave the window before we're below the limit again
+        index = len(self.sent) - self.limit()
+        return max(0, self.sent[index] + self.interval - now)
+
+
+class CombinedRateLimiter:
+    """ Allows a message to be sent only if all of the given RateLimiters allow it """
+
+    def __init__(self, *limiters):
+        self.limiters = limiters
+
+    def available(self, now=None):
+        if now is None:
+            now = time.time()
+
+        return min(limiter.available(now) for limiter in self.limiters)
+
+    def consume(self, now=None):
+        if now is None:
+            now = time.time()
+
+        for limiter in self.limiters:
+            limiter.consume(now)
+
+    def next_available(self, now=None):
+        if now is None:
+            now = time.time()
+
+        return max(limiter.next_available(now) for limiter in self.limiters)
+
+
+def wait_time_stats(wait_times):
+    """ p50, p99 and max of the given wait times, in seconds """
+    wait_times = sorted(wait_times)
+    if not wait_times:
+        return {'wait_p50_s': 0, 'wait_p99_s': 0, 'wait_max_s': 0}
+
+    return {
+            'wait_p50_s': wait_times[len(wait_times) // 2],
+            'wait_p99_s': wait_times[int(len(wait_times) * 0.99)],
+            'wait_max_s': wait_times[-1],
+            }
+
+
+class OutboundMessage:
+    def __init__(self, channel, message, priority, counted, queued_at):
+        self.channel = channel
+        self.message = message
+        self.priority = priority
+        self.counted = counted
+        self.queued_at = queued_at
+
+        # Functions that are called with the message once it has been sent
+        self.on_sent = []
+
+
+class OutboundQueue:
+    """
+    Messages waiting to be sent, in order, one queue per priority.
+    Moderation commands are sent before chat messages, and chat messages before whispers.
+    A message that is already waiting in the queue is not queued a second time.
+
+    send is a function(channel, message) that returns False if the message could not be sent.
+    schedule is a function(delay, function) that calls function after delay seconds.
+    """
+
+    PRIORITY_MODERATION = 0
+    PRIORITY_CHAT = 1
+    PRIORITY_WHISPER = 2
+
+    PRIORITY_NAMES = ['moderation', 'chat', 'whisper']
+
+    MODERATION_COMMANDS = ('timeout', 'ban', 'unban', 'untimeout', 'delete', 'clear')
+
+    # Seconds to wait before trying again if there was no connection to send from
+    RETRY_DELAY = 2
+
+    # Number of wait times the wait time percentiles are calculated from
+    NUM_WAIT_TIMES = 500
+
+    def __init__(self, send, limiter, schedule):
+        self.send = send
+        self.limiter = limiter
+        self.schedule = schedule
+
+        self.queues = [deque() for _ in self.PRIORITY_NAMES]
+
+        # Key = (channel, message)
+        # Value = OutboundMessage
+        self.queued = {}
+
+        self.drain_scheduled = False
+        self.lock = threading.RLock()
+
+        self.num_sent = 0
+        self.num_coalesced = 0
+        self.max_depth = 0
+        self.wait_times = deque(maxlen=self.NUM_WAIT_TIMES)
+
+    def classify(channel, message):
+        """ Returns the priority a message is sent with """
+        if channel == '#jtv':
+            return OutboundQueue.PRIORITY_WHISPER
+
+        if message[:1] in ('.', '/') and message[1:].split(' ', 1)[0].lower() in OutboundQueue.MODERATION_COMMANDS:
+            return OutboundQueue.PRIORITY_MODERATION
+
+        return OutboundQueue.PRIORITY_CHAT
+
+    def __len__(self):
+        return len(self.queued)
+
+    def push(self, channel, message, counted=True, priority=None, on_sent=None, now=None):
+        """ Send the message right away if the rate limit allows it, otherwise queue it.
+        Messages that are not counted do not use up the rate limit, but still wait for it.
+        on_sent is called with the message once it has been sent. """
+        if now is None:
+            now = time.time()
+
+        if priority is None:
+            priority = OutboundQueue.classify(channel, message)
+
+        with self.lock:
+            key = (channel, message)
+            outbound_message = self.queued.get(key, None)
+            if outbound_message is not None:
+                self.num_coalesced += 1
+                if on_sent is not None:
+                    outbound_message.on_sent.append(on_sent)
+                return
+
+            outbound_message = OutboundMessage(channel, message, priority, counted, now)
+            if on_sent is not None:
+                outbound_message.on_sent.append(on_sent)
+            self.queues[priority].append(outbound_message)
+            self.queued[key] = outbound_message
+            self.max_depth = max(self.max_depth, len(self.queued))
+
+            if not self.drain_scheduled:
+                self.drain(now=now)
+
+    def drain(self, now=None):
+        """ Send as many queued messages as the rate limit allows, and schedule the rest """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.drain_scheduled = False
+
+            for queue in self.queues:
+                while queue:
+                    if self.limiter.available(now) <= 0:
+                        self.schedule_drain(self.limiter.next_available(now))
+                        return
+
+                    outbound_message = queue[0]
+                    if self.send(outbound_message.channel, outbound_message.message) is False:
+                        log.warning('No available connections to send messages from. Trying again in {} seconds.'.format(self.RETRY_DELAY))
+                        self.schedule_drain(self.RETRY_DELAY)
+                        return
+
+                    queue.popleft()
+                    del self.queued[(outbound_message.channel, outbound_message.message)]
+
+                    if outbound_message.counted:
+                        self.limiter.consume(now)
+                    self.num_sent += 1
+                    self.wait_times.append(now - outbound_message.queued_at)
+
+                    for on_sent in outbound_message.on_sent:
+                        try:
+                            on_sent(outbound_message.message)
+                        except:
+                            log.exception('Unhandled exception in on_sent of {}'.format(outbound_message.message))
+
+    def cancel(self, channel, messages):
+        """ Remove the given messages from the queue if they have not been sent yet.
+        Returns the number of messages that were removed. """
+        with self.lock:
+            keys = set((channel, message) for message in messages) & set(self.queued)
+            if not keys:
+                return 0
+
+            for key in keys:
+                del self.queued[key]
+
+            for index, queue in enumerate(self.queues):
+                self.queues[index] = deque(m for m in queue if (m.channel, m.message) not in keys)
+
+            return len(keys)
+
+    def schedule_drain(self, delay):
+        if self.drain_scheduled:
+            return
 
-    def can_send(self):
-        return self.num_msgs_sent < TMI.message_limit
+        self.drain_scheduled = True
+        self.schedule(delay, self.drain)
+
+    def stats(self, now=None):
+        """ Queue depth and wait time metrics """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            oldest = min((queue[0].queued_at for queue in self.queues if queue), default=now)
+
+            stats = {
+                    'depth': len(self.queued),
+                    'depth_per_priority': {name: len(queue) for name, queue in zip(self.PRIORITY_NAMES, self.queues)},
+                    'max_depth': self.max_depth,
+                    'oldest_wait_s': now - oldest,
+                    'sent': self.num_sent,
+                    'coalesced': self.num_coalesced,
+                    'available': self.limiter.available(now),
+                    'limit': self.limiter.limit(),
+                    }
+            stats.update(wait_time_stats(self.wait_times))
+            return stats
+
+
+class WhisperQueue:
+    """
+    Whispers waiting to be sent, sent as fast as the whisper limits allow.
+    Whispers to a user that already has a whisper waiting are merged into one line of at most MAX_LENGTH characters,
+    and users take turns so a user with a lot of whispers waiting does not hold up everyone else.
+
+    send is a function(username, message) that returns False if the whisper could not be sent.
+    schedule is a function(delay, function) that calls function after delay seconds.
+    """
+
+    MAX_LENGTH = 500
+    SEPARATOR = ' | '
+
+    # Whispers are dropped when this many lines are already waiting
+    MAX_BACKLOG = 1000
+
+    # Seconds to wait before trying again if there was no connection to send from
+    RETRY_DELAY = 2
+
+    # Number of wait times the wait time percentiles are calculated from
+    NUM_WAIT_TIMES = 500
+
+    def __init__(self, send, limiter, schedule):
+        self.send = send
+        self.limiter = limiter
+        self.schedule = schedule
+
+        # Users in the order they get their next whisper
+        # Key = username
+        # Value = list of [message, time queued at], oldest first
+        self.pending = OrderedDict()
+        self.num_lines = 0
+
+        self.drain_scheduled = False
+        self.lock = threading.RLock()
+
+        self.num_sent = 0
+        self.num_merged = 0
+        self.num_dropped = 0
+        self.max_depth = 0
+        self.wait_times = deque(maxlen=self.NUM_WAIT_TIMES)
+
+    def __len__(self):
+        return self.num_lines
+
+    def push(self, username, message, now=None):
+        """ Send the whisper right away if the limits allow it, otherwise queue it.
+        Returns False if the whisper was dropped because the backlog is full. """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            lines = self.pending.get(username, None)
+            if lines and len(lines[-1][0]) + len(self.SEPARATOR) + len(message) <= self.MAX_LENGTH:
+                lines[-1][0] += self.SEPARATOR + message
+                self.num_merged += 1
+            else:
+                if self.num_lines >= self.MAX_BACKLOG:
+                    self.num_dropped += 1
+                    log.warning('Whisper backlog is full ({} whispers), dropping whisper to {}'.format(self.num_lines, username))
+                    return False
+
+                if lines is None:
+                    lines = self.pending[username] = []
+                lines.append([message, now])
+                self.num_lines += 1
+                self.max_depth = max(self.max_depth, self.num_lines)
+
+            if not self.drain_scheduled:
+                self.drain(now=now)
+
+            return True
+
+    def drain(self, now=None):
+        """ Send as many whispers as the limits allow, and schedule the rest """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.drain_scheduled = False
+
+            while self.pending:
+                if self.limiter.available(now) <= 0:
+                    self.schedule_drain(self.limiter.next_available(now))
+                    return
+
+                username, lines = next(iter(self.pending.items()))
+                message, queued_at = lines[0]
+                if self.send(username, message) is False:
+                    log.warning('No available connections to send whispers from. Trying again in {} seconds.'.format(self.RETRY_DELAY))
+                    self.schedule_drain(self.RETRY_DELAY)
+                    return
+
+                # Move the user to the back of the line
+                del self.pending[username]
+                lines.pop(0)
+                if lines:
+                    self.pending[username] = lines
+                self.num_lines -= 1
+
+                self.limiter.consume(now)
+                self.num_sent += 1
+                self.wait_times.append(now - queued_at)
+
+    def schedule_drain(self, delay):
+        if self.drain_scheduled:
+            return
+
+        self.drain_scheduled = True
+        self.schedule(delay, self.drain)
+
+    def stats(self, now=None):
+        """ Backlog, drop and wait time metrics """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            oldest = min((lines[0][1] for lines in self.pending.values()), default=now)
+
+            stats = {
+                    'depth': self.num_lines,
+                    'recipients': len(self.pending),
+                    'max_depth': self.max_depth,
+                    'oldest_wait_s': now - oldest,
+                    'sent': self.num_sent,
+                    'merged': self.num_merged,
+                    'dropped': self.num_dropped,
+                    'available': self.limiter.available(now),
+                    }
+            stats.update(wait_time_stats(self.wait_times))
+            return stats
 
 
 class ConnectionManager:
-    def __init__(self, reactor, bot, streamer, control_hub_channel):
+    # How often send-only connections are pinged, and how long they can go without answering, in seconds
+    PING_INTERVAL = 30
+    PONG_TIMEOUT = 90
+
+    def __init__(self, reactor, bot, streamer, control_hub_channel, num_send_connections=0):
         self.streamer = streamer
         self.channel = '#' + self.streamer
         if len(control_hub_channel) > 0:
@@ -73,8 +488,27 @@ class ConnectionManager:
         self.bot = bot
         self.main_conn = None
 
+        # Connections that messages are sent from, next to main_conn which reads the chat.
+        # If there are none, messages are sent from main_conn.
+        self.num_send_connections = num_send_connections
+        self.send_conns = []
+
         self.maintenance_lock = False
 
+        # Twitch counts the messages sent in the last 30 seconds, we add a second to be safe
+        self.outbound = OutboundQueue(
+                self.send_message,
+                RateLimiter(lambda: TMI.message_limit, 31),
+                lambda delay, function: self.bot.execute_delayed(delay, function))
+
+        # Whispers have their own limits, and don't count towards the chat limit
+        self.whispers = WhisperQueue(
+                self.send_whisper,
+                CombinedRateLimiter(
+                    RateLimiter(lambda: TMI.whispers_message_limit, TMI.whispers_limit_interval),
+                    RateLimiter(lambda: TMI.whispers_minute_limit, 60)),
+                lambda delay, function: self.bot.execute_delayed(delay, function))
+
     def start(self):
         log.debug('Starting connection manager')
         try:
@@ -112,8 +546,72 @@ class ConnectionManager:
 
                 self.main_conn.in_channel = True
 
+        try:
+            self.maintain_send_connections()
+        except:
+            log.exception('Failed to maintain the send connections')
+
         self.maintenance_lock = False
 
+    def maintain_send_connections(self, now=None):
+        """ Replace send connections that disconnected or stopped answering pings,
+        and ping the rest """
+        if now is None:
+            now = time.time()
+
+        for conn in list(self.send_conns):
+            if not conn.is_connected() or now - conn.last_pong > self.PONG_TIMEOUT:
+                log.warning('Send connection is not responding, replacing it')
+                self.send_conns.remove(conn)
+                self.close_connection(conn)
+
+        while len(self.send_conns) < self.num_send_connections:
+            conn = self.make_new_connection(send_only=True)
+            if conn is None:
+                break
+
+            self.send_conns.append(conn)
+
+        for conn in self.send_conns:
+            if not conn.is_connected():
+                continue
+
+            if not conn.in_channel:
+                conn.join(self.channel)
+                conn.in_channel = True
+
+            if now - conn.last_ping >= self.PING_INTERVAL:
+                conn.ping('tmi.twitch.tv')
+                conn.last_ping = now
+
+    def close_connection(self, conn):
+        try:
+            conn.disconnect()
+        except:
+            pass
+
+        with self.reactor.mutex:
+            if conn in self.reactor.connections:
+                self.reactor.connections.remove(conn)
+
+    def on_send_conn_event(self, conn, event):
+        """ Events received on a send-only connection. Only used to see if it's still alive. """
+        if event.type == 'pong':
+            conn.last_pong = time.time()
+        elif event.type == 'disconnect':
+            self.on_disconnect(conn)
+
+    def get_send_conn(self, now=None):
+        """ Returns the least loaded healthy send connection, or main_conn if there are none """
+        send_conns = [conn for conn in self.send_conns if conn.is_connected() and conn.in_channel]
+        if send_conns:
+            return min(send_conns, key=lambda conn: conn.load(now))
+
+        if self.main_conn is not None and self.main_conn.is_connected():
+            return self.main_conn
+
+        return None
+
     def get_main_conn(self):
         if self.main_conn is None:
             self.run_maintenance()
@@ -134,7 +632,7 @@ class ConnectionManager:
         server = random.choice(servers)
         return server['host'], server['port']
 
-    def make_new_connection(self):
+    def make_new_connection(self, send_only=False):
         log.debug('Creating a new IRC connection...')
         log.debug('Selecting random IRC server... ({0})'.format(self.streamer))
 
@@ -144,7 +642,7 @@ class ConnectionManager:
 
         try:
             ssl_factory = irc.connection.Factory(wrapper=ssl.wrap_socket)
-            newconn = Connection(self.reactor)
+            newconn = Connection(self.reactor, send_only=send_only)
             with self.reactor.mutex:
                 self.reactor.connections.append(newconn)
             newconn.connect(ip, port, self.bot.nickname, self.bot.password, self.bot.nickname, connect_factory=ssl_factory)
@@ -165,15 +663,23 @@ class ConnectionManager:
         self.run_maintenance()
         return
 
-    def privmsg(self, channel, message, increase_message=True):
-        conn = self.get_main_conn()
+    def send_message(self, channel, message):
+        """ Called by the outbound queue once the rate limit allows the message to be sent """
+        conn = self.get_send_conn()
 
-        if conn is None or not conn.can_send():
-            log.error('No available connections to send messages from. Delaying message a few seconds.')
-            self.bot.execute_delayed(2, self.privmsg, (channel, message, increase_message))
+        if conn is None:
             return False
 
         conn.privmsg(channel, message)
-        if increase_message:
-            conn.num_msgs_sent += 1
-            self.bot.execute_delayed(31, conn.reduce_msgs_sent)
\ No newline at end of file
+        conn.record_send()
+        return True
+
+    def send_whisper(self, username, message):
+        """ Called by the whisper queue once the whisper limits allow the whisper to be sent """
+        return self.send_message('#jtv', '/w {} {}'.format(username, message))
+
+    def privmsg(self, channel, message, increase_message=True):
+        self.outbound.push(channel, message, counted=increase_message)
+
+    def whisper(self, username, message):
+        return self.whispers.push(username, message)
@@ -38,7 +38,14 @@ def check_connection(dbapi_con, con_record, con_proxy):
 
 class DBManager:
     def init(url):
-        DBManager.engine = create_engine(url, pool_pre_ping=True, pool_size=10, max_overflow=20)
+        options = {
+                'pool_pre_ping': True,
+                }
+        if not url.startswith('sqlite'):
+            # SQLite (used by pajbot.bench) doesn't use a connection pool with a fixed size
+            options['pool_size'] = 10
+            options['max_overflow'] = 20
+        DBManager.engine = create_engine(url, **options)
         DBManager.Session = sessionmaker(bind=DBManager.engine, autoflush=False)
         DBManager.ScopedSession = scoped_session(sessionmaker(bind=DBManager.engine))
 
@@ -2,11 +2,14 @@ import datetime
 import json
 import logging
 import os
-import re
+import threading
+import time
+from collections import OrderedDict
 
 import requests
 
 from pajbot.apiwrappers import APIBase
+from pajbot.managers.handler import HandlerManager
 from pajbot.managers.redis import RedisManager
 from pajbot.managers.schedule import ScheduleManager
 from pajbot.streamhelper import StreamHelper
@@ -14,10 +17,124 @@ from pajbot.streamhelper import StreamHelper
 log = logging.getLogger(__name__)
 
 
-class BTTVEmoteManager:
+def index_message_words(message):
+    """ Split message on spaces and index the start position of every word.
+
+    Returns an ordered dictionary where the key is the word and the value is a list
+    of every index the word starts at in the message. Words are only separated by
+    spaces, so an emote code has to be surrounded by spaces (or the start/end of
+    the message) to be found.
+
+    Example:
+    index_message_words('Kappa 123 Kappa') = {'Kappa': [0, 10], '123': [6]}
+    """
+    message_words = OrderedDict()
+    index = 0
+    for word in message.split(' '):
+        if word:
+            message_words.setdefault(word, []).append(index)
+        index += len(word) + 1
+
+    return message_words
+
+
+class EPMCounter:
+    """
+    Emotes per minute: how many times every emote was used in the last 60 seconds.
+
+    Every emote used in the last minute has a ring of 60 one-second buckets, so incrementing and reading are O(1).
+    The ring is moved forward once per second with tick(), which drops emotes that have not been used for a minute.
+    """
+
+    NUM_BUCKETS = 60
+
     def __init__(self):
-        from pajbot.apiwrappers import BTTVApi
-        self.api = BTTVApi()
+        # Key = emote code
+        # Value = [total of the buckets, list of NUM_BUCKETS counts]
+        self.counts = {}
+
+        # Index of the bucket of the current second
+        self.position = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def incr(self, code, count):
+        entry = self.counts.get(code, None)
+        if entry is None:
+            entry = self.counts[code] = [0, [0] * self.NUM_BUCKETS]
+
+        entry[0] += count
+        entry[1][self.position] += count
+
+    def get(self, code):
+        """ Number of times the emote was used in the last minute, or None if it wasn't used """
+        entry = self.counts.get(code, None)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def tick(self):
+        self.position = (self.position + 1) % self.NUM_BUCKETS
+
+        for code in list(self.counts):
+            entry = self.counts[code]
+            expired = entry[1][self.position]
+            if expired == 0:
+                continue
+
+            entry[0] -= expired
+            entry[1][self.position] = 0
+            if entry[0] <= 0:
+                del self.counts[code]
+
+    def items(self):
+        """ (code, emotes per minute) of every emote used in the last minute """
+        return ((code, entry[0]) for code, entry in self.counts.items())
+
+
+class OfflineEmoteApi:
+    """
+    Stand-in for BTTVApi and FFZApi that never touches the network, with fixed lists of emotes in the standard Emote format.
+    Used when offline_emotes is set in the config, and in tests.
+    A list that is None acts like a failed API call.
+    """
+
+    def __init__(self, global_emotes=[], channel_emotes=[]):
+        self.global_emotes = global_emotes
+        self.channel_emotes = channel_emotes
+
+    def get_global_emotes(self):
+        if self.global_emotes is None:
+            return None
+
+        return list(self.global_emotes)
+
+    def get_channel_emotes(self, channel):
+        if self.channel_emotes is None:
+            return None
+
+        return list(self.channel_emotes)
+
+
+class ThirdPartyEmoteManager:
+    """
+    Global and channel emotes of a third-party emote provider (BTTV or FFZ).
+
+    Creating the manager never calls the provider API, the last known emotes are loaded from the snapshot in redis,
+    or from the snapshot file in snapshot_dir if redis doesn't have one. update_emotes fetches the emotes from the API,
+    builds a new emote index on the side and swaps it in with a single assignment, so messages are always parsed
+    with a complete set of emotes.
+
+    Subclasses set NAME, and build the emote dictionary of every emote with build_emote(emote_code, emote_hash).
+    """
+
+    # Name of the provider in redis keys and snapshot file names
+    NAME = None
+
+    def __init__(self, api, snapshot_dir=None):
+        self.api = api
+        self.snapshot_dir = snapshot_dir
 
         # Key = Emote code (i.e. KKonaW)
         # Value = Emote hash (i.e. ghjkfghfhjg23fhjg23fh34)
@@ -27,184 +144,266 @@ class BTTVEmoteManager:
         # Proper syntax described in build_emote
         self.valid_emotes = []
 
-        self.update_global_emotes()
-        self.load_cached_channel_emotes()
-        self.update_valid_emotes()
+        # Key = Emote code (i.e. KKonaW)
+        # Value = Emote dictionary from build_emote
+        self.emote_index = {}
 
-    def load_cached_channel_emotes(self):
-        streamer = StreamHelper.get_streamer()
+        # Time of the API refresh the emotes come from, None if they were never refreshed
+        self.updated_at = None
 
-        # Try to get the list of global emotes from redis
-        try:
-            _channel_emotes = RedisManager.get().hgetall('{streamer}:emotes:bttv_channel_emotes'.format(streamer=streamer))
-        except:
-            _channel_emotes = {}
-
-        for code in _channel_emotes:
-            emote_hash = _channel_emotes[code]
-            self.channel_emotes[code] = emote_hash
-
-    def update_global_emotes(self):
-        # Try to get cached global emotes from redis
-        _global_emotes = RedisManager.get().get('global:emotes:bttv_global')
-        if _global_emotes and len(_global_emotes) > 0:
-            log.info('Got cached BTTV global emotes!')
-            _global_emotes = json.loads(_global_emotes)
-        else:
-            _global_emotes = self.api.get_global_emotes()
-            if _global_emotes and len(_global_emotes) > 0:
-                RedisManager.get().setex('global:emotes:bttv_global', time=3600, value=json.dumps(_global_emotes, separators=(',', ':')))
+        # Refreshes are started both by the scheduler and by commands, only one runs at a time
+        self.update_lock = threading.Lock()
 
-        if _global_emotes and len(_global_emotes) > 0:
-            self.global_emotes = {}
-            for emote in _global_emotes:
-                self.global_emotes[emote['code']] = emote['emote_hash']
+        self.load_snapshot()
 
-    def update_channel_emotes(self):
-        _channel_emotes = self.api.get_channel_emotes(StreamHelper.get_streamer())
-        self.channel_emotes = {}
-        for emote in _channel_emotes:
-            self.channel_emotes[emote['code']] = emote['emote_hash']
+    def snapshot_key(self):
+        return '{streamer}:emotes:{name}_snapshot'.format(streamer=StreamHelper.get_streamer(), name=self.NAME)
 
-        # Store channel emotes in redis
-        streamer = StreamHelper.get_streamer()
-        key = '{streamer}:emotes:bttv_channel_emotes'.format(streamer=streamer)
-        with RedisManager.pipeline_context() as pipeline:
-            for emote_code, emote_hash in self.channel_emotes.items():
-                pipeline.hset(key, emote_code, emote_hash)
+    def snapshot_path(self):
+        if self.snapshot_dir is None:
+            return None
 
-    def update_valid_emotes(self):
-        self.valid_emotes = []
+        return os.path.join(self.snapshot_dir, '{streamer}_{name}.json'.format(streamer=StreamHelper.get_streamer(), name=self.NAME))
 
-        for emote_code, emote_hash in self.global_emotes.items():
-            self.valid_emotes.append(self.build_emote(emote_code, emote_hash))
+    def read_snapshot(self):
+        """ Returns the last saved snapshot, or None if there is none """
+        redis = RedisManager.get()
+        if redis is not None:
+            try:
+                data = redis.get(self.snapshot_key())
+                if data:
+                    return json.loads(data)
+            except:
+                log.exception('Failed to load the {} emote snapshot from redis'.format(self.NAME))
+
+        path = self.snapshot_path()
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as snapshot_file:
+                    return json.load(snapshot_file)
+            except:
+                log.exception('Failed to load the {} emote snapshot from {}'.format(self.NAME, path))
 
-        streamer = StreamHelper.get_streamer()
-        key = '{streamer}:emotes:bttv_channel_emotes'.format(streamer=streamer)
-        for emote_code, emote_hash in list(RedisManager.get().hgetall(key).items()):
-            self.valid_emotes.append(self.build_emote(emote_code, emote_hash))
+        if redis is not None:
+            return self.read_redis_cache(redis)
+
+        return None
+
+    def read_redis_cache(self, redis):
+        """ The emotes from the redis keys that were used before snapshots, so the first start with snapshots still knows the emotes """
+        try:
+            global_emotes = json.loads(redis.get('global:emotes:{name}_global'.format(name=self.NAME)) or '[]')
+            channel_emotes = redis.hgetall('{streamer}:emotes:{name}_channel_emotes'.format(streamer=StreamHelper.get_streamer(), name=self.NAME))
+        except:
+            log.exception('Failed to load the cached {} emotes'.format(self.NAME))
+            return None
+
+        if not global_emotes and not channel_emotes:
+            return None
 
-    def build_emote(self, emote_code, emote_hash):
         return {
-                'code': emote_code,
-                'type': 'bttv',
-                'emote_hash': emote_hash,
-                'regex': re.compile('(?<![^ ]){0}(?![^ ])'.format(re.escape(emote_code))),
+                'global_emotes': {emote['code']: emote['emote_hash'] for emote in global_emotes},
+                'channel_emotes': channel_emotes,
+                'updated_at': None,
                 }
 
+    def load_snapshot(self):
+        snapshot = self.read_snapshot()
+        if snapshot is None:
+            log.info('No {} emote snapshot, the emotes are unknown until the first refresh'.format(self.NAME))
+            return
+
+        self.set_emotes(snapshot['global_emotes'], snapshot['channel_emotes'], snapshot['updated_at'])
+        log.info('Loaded {} {} emotes from the snapshot'.format(len(self.emote_index), self.NAME))
+
+    def save_snapshot(self):
+        snapshot = json.dumps({
+                'global_emotes': self.global_emotes,
+                'channel_emotes': self.channel_emotes,
+                'updated_at': self.updated_at,
+                }, separators=(',', ':'))
+
+        redis = RedisManager.get()
+        if redis is not None:
+            try:
+                redis.set(self.snapshot_key(), snapshot)
+            except:
+                log.exception('Failed to save the {} emote snapshot to redis'.format(self.NAME))
+
+        path = self.snapshot_path()
+        if path is not None:
+            try:
+                # Renamed over the old snapshot once it's complete, so a crash never leaves half a snapshot behind
+                with open(path + '.tmp', 'w') as snapshot_file:
+                    snapshot_file.write(snapshot)
+                os.replace(path + '.tmp', path)
+            except:
+                log.exception('Failed to save the {} emote snapshot to {}'.format(self.NAME, path))
+
+    def set_emotes(self, global_emotes, channel_emotes, updated_at=None):
+        valid_emotes = []
+
+        for emote_code, emote_hash in global_emotes.items():
+            valid_emotes.append(self.build_emote(emote_code, emote_hash))
+
+        for emote_code, emote_hash in channel_emotes.items():
+            valid_emotes.append(self.build_emote(emote_code, emote_hash))
+
+        emote_index = {emote['code']: emote for emote in valid_emotes}
+
+        self.global_emotes = global_emotes
+        self.channel_emotes = channel_emotes
+        self.valid_emotes = valid_emotes
+        self.emote_index = emote_index
+        self.updated_at = updated_at
+
     def update_emotes(self):
-        log.debug('Updating BTTV Emotes...')
+        """ Fetch the emotes from the API. The API returns None when a call fails, the emotes we already know are kept for that call """
+        log.debug('Updating {} Emotes...'.format(self.NAME.upper()))
 
-        self.update_global_emotes()
-        self.update_channel_emotes()
-        self.update_valid_emotes()
+        with self.update_lock:
+            global_emotes = self.api.get_global_emotes()
+            channel_emotes = self.api.get_channel_emotes(StreamHelper.get_streamer())
 
+            if global_emotes is None and channel_emotes is None:
+                log.warning('Failed to get the {} emotes, keeping the {} emotes we have'.format(self.NAME.upper(), len(self.emote_index)))
+                return
 
-class FFZEmoteManager:
-    def __init__(self):
-        from pajbot.apiwrappers import FFZApi
-        self.api = FFZApi()
+            if global_emotes is None:
+                log.warning('Failed to get the global {} emotes, keeping the {} we have'.format(self.NAME.upper(), len(self.global_emotes)))
+                global_emotes = self.global_emotes
+            else:
+                global_emotes = {emote['code']: emote['emote_hash'] for emote in global_emotes}
 
-        # Key = Emote code (i.e. KKonaW)
-        # Value = Emote hash (i.e. 157420)
-        self.global_emotes = {}
-        self.channel_emotes = {}
+            if channel_emotes is None:
+                log.warning('Failed to get the channel {} emotes, keeping the {} we have'.format(self.NAME.upper(), len(self.channel_emotes)))
+                channel_emotes = self.channel_emotes
+            else:
+                channel_emotes = {emote['code']: emote['emote_hash'] for emote in channel_emotes}
 
-        # Proper syntax described in build_emote
-        self.valid_emotes = []
+            self.set_emotes(global_emotes, channel_emotes, time.time())
+            self.save_snapshot()
 
-        self.update_global_emotes()
-        self.load_cached_channel_emotes()
-        self.update_valid_emotes()
 
-    def load_cached_channel_emotes(self):
-        streamer = StreamHelper.get_streamer()
+class BTTVEmoteManager(ThirdPartyEmoteManager):
+    NAME = 'bttv'
 
-        # Try to get the list of global emotes from redis
-        try:
-            _channel_emotes = RedisManager.get().hgetall('{streamer}:emotes:ffz_channel_emotes'.format(streamer=streamer))
-        except:
-            _channel_emotes = {}
-
-        for code in _channel_emotes:
-            emote_hash = _channel_emotes[code]
-            self.channel_emotes[code] = emote_hash
-
-    def update_global_emotes(self):
-        # Try to get cached global emotes from redis
-        _global_emotes = RedisManager.get().get('global:emotes:ffz_global')
-        if _global_emotes and len(_global_emotes) > 0:
-            _global_emotes = json.loads(_global_emotes)
-            log.info('Got cached FFZ global emotes!')
-        else:
-            _global_emotes = self.api.get_global_emotes()
-            if _global_emotes and len(_global_emotes) > 0:
-                RedisManager.get().setex('global:emotes:ffz_global', time=3600, value=json.dumps(_global_emotes, separators=(',', ':')))
+    def __init__(self, api=None, snapshot_dir=None):
+        if api is None:
+            from pajbot.apiwrappers import BTTVApi
+            api = BTTVApi()
 
-        if _global_emotes and len(_global_emotes) > 0:
-            self.global_emotes = {}
-            for emote in _global_emotes:
-                self.global_emotes[emote['code']] = emote['emote_hash']
+        super().__init__(api, snapshot_dir=snapshot_dir)
 
-    def update_channel_emotes(self):
-        _channel_emotes = self.api.get_channel_emotes(StreamHelper.get_streamer())
-        self.channel_emotes = {}
-        for emote in _channel_emotes:
-            self.channel_emotes[emote['code']] = emote['emote_hash']
+    def parse_message_words(self, message_words):
+        """ Returns the BTTV emotes found in message_words, see index_message_words """
+        # The index can be swapped by a refresh at any time, the whole message is parsed with the same one
+        emote_index = self.emote_index
 
-        # Store channel emotes in redis
-        streamer = StreamHelper.get_streamer()
-        key = '{streamer}:emotes:ffz_channel_emotes'.format(streamer=streamer)
-        with RedisManager.pipeline_context() as pipeline:
-            for emote_code, emote_hash in self.channel_emotes.items():
-                pipeline.hset(key, emote_code, emote_hash)
+        message_emotes = []
+        for word, indices in message_words.items():
+            emote = emote_index.get(word, None)
+            if emote is None:
+                continue
 
-    def update_valid_emotes(self):
-        self.valid_emotes = []
+            message_emotes.append({
+                'code': emote['code'],
+                'bttv_hash': emote['emote_hash'],
+                'start': indices[0],
+                'end': indices[0] + len(word) - 1,
+                'count': len(indices),
+                })
 
-        for emote_code, emote_hash in self.global_emotes.items():
-            self.valid_emotes.append(self.build_emote(emote_code, emote_hash))
+        return message_emotes
 
-        streamer = StreamHelper.get_streamer()
-        key = '{streamer}:emotes:ffz_channel_emotes'.format(streamer=streamer)
-        for emote_code, emote_hash in list(RedisManager.get().hgetall(key).items()):
-            self.valid_emotes.append(self.build_emote(emote_code, emote_hash))
+    def build_emote(self, emote_code, emote_hash):
+        return {
+                'code': emote_code,
+                'type': 'bttv',
+                'emote_hash': emote_hash,
+                }
+
+
+class FFZEmoteManager(ThirdPartyEmoteManager):
+    NAME = 'ffz'
+
+    def __init__(self, api=None, snapshot_dir=None):
+        if api is None:
+            from pajbot.apiwrappers import FFZApi
+            api = FFZApi()
+
+        super().__init__(api, snapshot_dir=snapshot_dir)
+
+    def parse_message_words(self, message_words):
+        """ Returns the FFZ emotes found in message_words, see index_message_words """
+        # The index can be swapped by a refresh at any time, the whole message is parsed with the same one
+        emote_index = self.emote_index
+
+        message_emotes = []
+        for word, indices in message_words.items():
+            emote = emote_index.get(word, None)
+            if emote is None:
+                continue
+
+            message_emotes.append({
+                'code': emote['code'],
+                'ffz_id': emote['emote_id'],
+                'start': indices[0],
+                'end': indices[0] + len(word) - 1,
+                'count': len(indices),
+                })
+
+        return message_emotes
 
     def build_emote(self, emote_code, emote_hash):
         return {
                 'code': emote_code,
                 'type': 'ffz',
                 'emote_id': emote_hash,
-                'regex': re.compile('(?<![^ ]){0}(?![^ ])'.format(re.escape(emote_code))),
                 }
 
-    def update_emotes(self):
-        log.debug('Updating FFZ Emotes...')
-
-        self.update_global_emotes()
-        self.update_channel_emotes()
-        self.update_valid_emotes()
-
 
 class EmoteManager:
     def __init__(self, bot):
         # this should probably not even be a dictionary
         self.bot = bot
         self.streamer = bot.streamer
-        self.bttv_emote_manager = BTTVEmoteManager()
-        self.ffz_emote_manager = FFZEmoteManager()
+
+        # Emotes are loaded from the last snapshots and refreshed in the background, so starting the bot never waits for the emote APIs
+        offline = bot.config['main'].getboolean('offline_emotes', False)
+        snapshot_dir = bot.config['main'].get('emote_snapshot_dir', None)
+        self.bttv_emote_manager = BTTVEmoteManager(api=OfflineEmoteApi() if offline else None, snapshot_dir=snapshot_dir)
+        self.ffz_emote_manager = FFZEmoteManager(api=OfflineEmoteApi() if offline else None, snapshot_dir=snapshot_dir)
         redis = RedisManager.get()
         self.subemotes = redis.hgetall('global:emotes:twitch_subemotes')
 
         # Emote current EPM
-        self.epm = {}
+        self.epm = EPMCounter()
 
+        # Key = emote code
+        # Value = highest EPM of the emote, as stored in {streamer}:emotes:epmrecord
+        self.epm_records = {}
         try:
-            # Update BTTV Emotes every 2 hours
-            ScheduleManager.execute_every(60 * 60 * 2, self.bttv_emote_manager.update_emotes)
+            for code, record in redis.zrange('{streamer}:emotes:epmrecord'.format(streamer=self.streamer), 0, -1, withscores=True):
+                self.epm_records[code] = int(record)
+        except:
+            log.exception('Failed to load the EPM records')
+
+        # Key = emote code
+        # Value = number of uses that have not been added to {streamer}:emotes:count yet
+        self.pending_counts = {}
 
-            # Update Twitch emotes every 3 hours
-            ScheduleManager.execute_every(60 * 60 * 3, self.update_emotes)
+        HandlerManager.add_handler('on_tick', self.on_tick)
+
+        try:
+            if not offline:
+                # Refresh the BTTV & FFZ emotes now, at the same time, and then every 2 hours
+                for emote_manager in (self.bttv_emote_manager, self.ffz_emote_manager):
+                    ScheduleManager.execute_now(emote_manager.update_emotes)
+                    ScheduleManager.execute_every(60 * 60 * 2, emote_manager.update_emotes)
+
+                # Update Twitch emotes every 3 hours
+                ScheduleManager.execute_every(60 * 60 * 3, self.update_emotes)
         except:
             pass
 
@@ -269,6 +468,10 @@ class EmoteManager:
                 for code, emote_data in data['emotes'].items():
                     twitch_emotes[code] = emote_data['image_id']
 
+        if not twitch_emotes:
+            log.warning('Got no Twitch emotes, keeping the {} sub emotes we have'.format(len(self.subemotes)))
+            return
+
         with RedisManager.pipeline_context() as pipeline:
             pipeline.delete('global:emotes:twitch_subemotes')
             pipeline.hmset('global:emotes:twitch', twitch_emotes)
@@ -338,81 +541,69 @@ class EmoteManager:
                     log.error('Emote data: {}'.format(emote_data))
                     log.error('Message: {}'.format(message))
 
-        # BTTV Emotes
-        for emote in self.bttv_emote_manager.valid_emotes:
-            num = 0
-            start = -1
-            end = -1
-            for match in emote['regex'].finditer(message):
-                num += 1
-                if num == 1:
-                    start = match.span()[0]
-                    end = match.span()[1] - 1  # don't ask me
-            if num > 0:
-                message_emotes.append({
-                    'code': emote['code'],
-                    'bttv_hash': emote['emote_hash'],
-                    'start': start,
-                    'end': end,
-                    'count': num,
-                    })
-
-        # FFZ Emotes
-        for emote in self.ffz_emote_manager.valid_emotes:
-            num = 0
-            start = -1
-            end = -1
-            for match in emote['regex'].finditer(message):
-                num += 1
-                if num == 1:
-                    start = match.span()[0]
-                    end = match.span()[1] - 1  # don't ask me
-            if num > 0:
-                message_emotes.append({
-                    'code': emote['code'],
-                    'ffz_id': emote['emote_id'],
-                    'start': start,
-                    'end': end,
-                    'count': num,
-                    })
-
-        if len(message_emotes) > 0 or len(new_user_tags) > 0:
-            streamer = StreamHelper.get_streamer()
-            with RedisManager.pipeline_context() as pipeline:
-                if not whisper:
-                    for emote in message_emotes:
-                        pipeline.zincrby('{streamer}:emotes:count'.format(streamer=streamer), emote['code'], emote['count'])
-                        self.epm_incr(emote['code'], emote['count'])
-
-                user_tags = source.get_tags()
-
-                for tag in new_user_tags:
-                    user_tags[tag] = (datetime.datetime.now() + datetime.timedelta(days=15)).timestamp()
-                source.set_tags(user_tags, redis=pipeline)
+        # BTTV & FFZ Emotes
+        message_words = index_message_words(message)
+        message_emotes.extend(self.bttv_emote_manager.parse_message_words(message_words))
+        message_emotes.extend(self.ffz_emote_manager.parse_message_words(message_words))
+
+        if not whisper:
+            for emote in message_emotes:
+                self.pending_counts[emote['code']] = self.pending_counts.get(emote['code'], 0) + emote['count']
+                self.epm_incr(emote['code'], emote['count'])
+
+        if len(new_user_tags) > 0:
+            # Cached in memory and written to redis with the next UserManager.flush, see UserTagCache
+            user_tags = source.get_tags()
+            for tag in new_user_tags:
+                user_tags[tag] = (datetime.datetime.now() + datetime.timedelta(days=15)).timestamp()
+            source.set_tags(user_tags)
 
         return message_emotes
 
+    def flush(self):
+        """ Send the emote counts of the last second to redis, in a single pipeline """
+        if not self.pending_counts:
+            return
+
+        counts, self.pending_counts = self.pending_counts, {}
+        streamer = StreamHelper.get_streamer()
+
+        with RedisManager.pipeline_context() as pipeline:
+            for code, count in counts.items():
+                pipeline.zincrby('{streamer}:emotes:count'.format(streamer=streamer), code, count)
+
     def epm_incr(self, code, count):
-        if code in self.epm:
-            self.epm[code] += count
-        else:
-            self.epm[code] = count
-        ScheduleManager.execute_delayed(60, self.epm_decr, args=[code, count])
+        self.epm.incr(code, count)
 
-    def epm_decr(self, code, count):
-        self.epm[code] -= count
+    def on_tick(self):
+        try:
+            self.flush()
+        except:
+            log.exception('Failed to flush the emote counts')
+
+        new_records = [(code, epm) for code, epm in self.epm.items() if epm > self.epm_records.get(code, 0)]
+        self.epm.tick()
+
+        if not new_records:
+            return
+
+        streamer = StreamHelper.get_streamer()
+        with RedisManager.pipeline_context() as pipeline:
+            for code, epm in new_records:
+                self.epm_records[code] = epm
+                pipeline.zadd('{streamer}:emotes:epmrecord'.format(streamer=streamer), code, epm)
 
     def get_emote_count(self, emote_code):
         redis = RedisManager.get()
         streamer = StreamHelper.get_streamer()
 
-        emote_count = redis.zscore('{streamer}:emotes:count'.format(streamer=streamer), emote_code)
+        emote_count = (redis.zscore('{streamer}:emotes:count'.format(streamer=streamer), emote_code) or 0) + self.pending_counts.get(emote_code, 0)
         if emote_count:
             return int(emote_count)
         return None
 
     def get_emote_epm(self, emote_code):
-        return self.epm.get(emote_code, None)
+        return self.epm.get(emote_code)
 
     def get_emote_epmrecord(self, emote_code):
         redis = RedisManager.get()
@@ -2,6 +2,7 @@ import argparse
 import logging
 from collections import UserList
 
+from pajbot.managers.adminlog import AdminLogManager
 from pajbot.managers.db import DBManager
 from pajbot.models.filter import Filter
 
@@ -66,6 +67,18 @@ class FilterManager(UserList):
         self.db_session.delete(filter)
         self.data.remove(filter)
 
+    def on_regex_timeout(self, filter):
+        """ Disable a regex filter that took too long to run,
+        so it can't stall the processing of every message. """
+        log.warning('Disabling regex filter {} ({}) because it took too long to run'.format(filter.id, filter.filter))
+
+        filter.enabled = False
+        if filter in self.data:
+            self.data.remove(filter)
+        self.commit()
+
+        AdminLogManager.post('Filter timed out', None, filter.name)
+
     def parse_banphrase_arguments(self, message):
         parser = argparse.ArgumentParser()
         parser.add_argument('--length', dest='time', type=int)
@@ -1,22 +1,182 @@
+import json
 import logging
 import operator
+import time
+from collections import deque
 
+from pajbot.managers.redis import RedisManager
+from pajbot.streamhelper import StreamHelper
 from pajbot.utils import find
 
 log = logging.getLogger('pajbot')
 
 
+class HandlerProfiler:
+    """
+    Keeps a rolling latency histogram for every event and handler,
+    and logs handlers that take longer than slow_threshold seconds.
+
+    The histograms cover the last NUM_WINDOWS windows of WINDOW_LENGTH seconds.
+    """
+
+    # Upper bounds of the histogram buckets, in milliseconds
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf')]
+
+    WINDOW_LENGTH = 60
+    NUM_WINDOWS = 5
+
+    # How often the summary is written to redis for the web interface, in seconds
+    PUBLISH_INTERVAL = 10
+
+    def __init__(self, slow_threshold=0.05):
+        self.slow_threshold = slow_threshold
+
+        # (window ID, stats) tuples, oldest first
+        # Key = (event, handler name)
+        # Value = [calls, total seconds, max seconds, bucket counts]
+        self.windows = deque(maxlen=self.NUM_WINDOWS)
+
+        self.last_publish = 0
+
+    def handler_name(handler):
+        return getattr(handler, '__qualname__', None) or repr(handler)
+
+    def describe(arguments):
+        """ Describe what triggered a slow handler, i.e. the message """
+        for argument in arguments:
+            if hasattr(argument, 'message') and hasattr(argument, 'source'):
+                # MessageContext
+                return '{}: {}'.format(getattr(argument.source, 'username', argument.source), argument.message)
+
+        return ', '.join(repr(argument) for argument in arguments)[:200]
+
+    def record(self, event, handler, duration, arguments):
+        window_id = int(time.time() // self.WINDOW_LENGTH)
+        if not self.windows or self.windows[-1][0] != window_id:
+            self.windows.append((window_id, {}))
+
+        name = HandlerProfiler.handler_name(handler)
+        key = (event, name)
+        stats = self.windows[-1][1].get(key, None)
+        if stats is None:
+            stats = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            self.windows[-1][1][key] = stats
+
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+
+        duration_ms = duration * 1000
+        for index, bound in enumerate(self.BUCKETS):
+            if duration_ms <= bound:
+                stats[3][index] += 1
+                break
+
+        if duration > self.slow_threshold:
+            log.warning('Slow handler {} in {}: {:.1f}ms ({})'.format(name, event, duration_ms, HandlerProfiler.describe(arguments)))
+
+    def percentile(self, buckets, percent, maximum_ms):
+        """ Upper bound (in milliseconds) of the bucket the given percentile falls in.
+        The last bucket has no upper bound, the slowest call (maximum_ms) is used for it instead. """
+        total = sum(buckets)
+        if total == 0:
+            return 0
+
+        needed = total * percent / 100.0
+        count = 0
+        for index, bucket in enumerate(buckets):
+            count += bucket
+            if count >= needed:
+                break
+
+        if index == len(self.BUCKETS) - 1:
+            return maximum_ms
+
+        return self.BUCKETS[index]
+
+    def summary(self, event=None):
+        """ Returns a list of handler stats from the last NUM_WINDOWS windows, slowest (by total time) first """
+        oldest_window_id = int(time.time() // self.WINDOW_LENGTH) - self.NUM_WINDOWS + 1
+
+        merged = {}
+        for window_id, window in self.windows:
+            if window_id < oldest_window_id:
+                continue
+
+            for key, (calls, total, maximum, buckets) in window.items():
+                if event is not None and key[0] != event:
+                    continue
+
+                stats = merged.get(key, None)
+                if stats is None:
+                    merged[key] = [calls, total, maximum, list(buckets)]
+                else:
+                    stats[0] += calls
+                    stats[1] += total
+                    stats[2] = max(stats[2], maximum)
+                    stats[3] = [a + b for a, b in zip(stats[3], buckets)]
+
+        handlers = []
+        for (event, name), (calls, total, maximum, buckets) in merged.items():
+            handlers.append({
+                'event': event,
+                'handler': name,
+                'calls': calls,
+                'total_ms': total * 1000,
+                'mean_ms': total / calls * 1000,
+                'p50_ms': self.percentile(buckets, 50, maximum * 1000),
+                'p99_ms': self.percentile(buckets, 99, maximum * 1000),
+                'max_ms': maximum * 1000,
+                'histogram': buckets,
+                })
+
+        handlers.sort(key=lambda h: h['total_ms'], reverse=True)
+        return handlers
+
+    def publish(self, force=False):
+        """ Write the summary to redis, at most every PUBLISH_INTERVAL seconds """
+        now = time.time()
+        if not force and now - self.last_publish < self.PUBLISH_INTERVAL:
+            return
+
+        self.last_publish = now
+        data = {
+                'updated_at': now,
+                'window_seconds': self.WINDOW_LENGTH * self.NUM_WINDOWS,
+                'slow_threshold_ms': self.slow_threshold * 1000,
+                'buckets_ms': [bound if bound != float('inf') else None for bound in self.BUCKETS],
+                'handlers': self.summary(),
+                }
+        try:
+            RedisManager.get().set('{streamer}:handlers:profile'.format(streamer=StreamHelper.get_streamer()), json.dumps(data))
+        except:
+            log.exception('Failed to publish the handler profile')
+
+
 class HandlerManager:
     handlers = {}
 
+    # HandlerProfiler, or None if handlers are not being profiled
+    profiler = None
+
+    # Positional arguments passed from a MessageContext to handlers
+    # that were not added with context=True
+    LEGACY_ARGUMENTS = {
+            'on_pubmsg': lambda context: (context.source, context.message),
+            'on_message': lambda context: (context.source, context.message, context.emotes, context.whisper, context.urls, context.event),
+            }
+
     @staticmethod
     def init_handlers():
         HandlerManager.handlers = {}
 
         # on_pubmsg(source, message)
+        # on_pubmsg(message_context) if added with context=True
         HandlerManager.create_handler('on_pubmsg')
 
         # on_message(source, message, emotes, whisper, urls, event)
+        # on_message(message_context) if added with context=True
         HandlerManager.create_handler('on_message')
 
         # on_usernotice(source, message, tags)
@@ -70,13 +230,30 @@ class HandlerManager:
         # on_tick()
         HandlerManager.create_handler('on_tick')
 
+    def enable_profiling(slow_threshold=0.05):
+        """ Start measuring how long every handler takes.
+        Handlers that take longer than slow_threshold seconds are logged. """
+        if HandlerManager.profiler is None:
+            HandlerManager.profiler = HandlerProfiler(slow_threshold=slow_threshold)
+        else:
+            HandlerManager.profiler.slow_threshold = slow_threshold
+
+        return HandlerManager.profiler
+
+    def disable_profiling():
+        if HandlerManager.profiler is not None:
+            HandlerManager.profiler.publish(force=True)
+        HandlerManager.profiler = None
+
     def create_handler(event):
         """ Create an empty list for the given event """
         HandlerManager.handlers[event] = []
 
-    def add_handler(event, method, priority=0):
+    def add_handler(event, method, priority=0, context=False):
+        """ context=True means the method takes a MessageContext instead of the
+        positional arguments of the event. Only valid for events triggered with trigger_context. """
         try:
-            HandlerManager.handlers[event].append((method, priority))
+            HandlerManager.handlers[event].append((method, priority, context))
             HandlerManager.handlers[event].sort(key=operator.itemgetter(1), reverse=True)
         except KeyError:
             # No handlers for this event found
@@ -100,12 +277,48 @@ class HandlerManager:
             log.error('No handler set for event {}'.format(event))
             return False
 
-        for handler, priority in HandlerManager.handlers[event]:
+        profiler = HandlerManager.profiler
+
+        for handler, priority, context in HandlerManager.handlers[event]:
             res = None
+            if profiler is not None:
+                start = time.perf_counter()
             try:
                 res = handler(*arguments)
             except:
                 log.exception('Unhandled exception from {} in {}'.format(handler, event))
+            if profiler is not None:
+                profiler.record(event, handler, time.perf_counter() - start, arguments)
+
+            if res is False and stop_on_false is True:
+                # Abort if handler returns false and stop_on_false is enabled
+                return False
+
+    def trigger_context(event, message_context, stop_on_false=True):
+        """ Trigger a message event (on_pubmsg, on_message) with a MessageContext.
+        Handlers that were not added with context=True get the old positional arguments. """
+        if event not in HandlerManager.handlers:
+            log.error('No handler set for event {}'.format(event))
+            return False
+
+        legacy_arguments = None
+        profiler = HandlerManager.profiler
+
+        for handler, priority, context in HandlerManager.handlers[event]:
+            res = None
+            if profiler is not None:
+                start = time.perf_counter()
+            try:
+                if context:
+                    res = handler(message_context)
+                else:
+                    if legacy_arguments is None:
+                        legacy_arguments = HandlerManager.LEGACY_ARGUMENTS[event](message_context)
+                    res = handler(*legacy_arguments)
+            except:
+                log.exception('Unhandled exception from {} in {}'.format(handler, event))
+            if profiler is not None:
+                profiler.record(event, handler, time.perf_counter() - start, (message_context, ))
 
             if res is False and stop_on_false is True:
                 # Abort if handler returns false and stop_on_false is enabled
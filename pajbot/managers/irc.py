@@ -1,6 +1,7 @@
 import logging
 
 from pajbot.managers.connection import ConnectionManager
+from pajbot.managers.connection import OutboundQueue
 from pajbot.managers.singleconnection import SingleConnectionManager
 
 log = logging.getLogger(__name__)
@@ -35,6 +36,27 @@ class IRCManager:
     def quit(self):
         pass
 
+    def send_bulk(self, messages, channel, on_sent=None):
+        """ Send moderation commands to many users at once, see ModerationManager.
+        on_sent is called with every message once it has been sent. """
+        for message in messages:
+            self.privmsg(message, channel)
+            if on_sent is not None:
+                on_sent(message)
+
+    def cancel_bulk(self, messages, channel):
+        """ Stop sending the given messages if they are still waiting to be sent.
+        Returns the number of messages that will not be sent. """
+        return 0
+
+    def queue_stats(self):
+        """ Metrics of the outbound message queue, see OutboundQueue.stats """
+        return None
+
+    def whisper_queue_stats(self):
+        """ Metrics of the whisper queue, see WhisperQueue.stats """
+        return None
+
     def _dispatcher(self, connection, event):
         log.warn('Missing implementation of IRCManager::_dispatcher()')
 
@@ -89,19 +111,26 @@ class MultiIRCManager(IRCManager):
         super().__init__(bot)
 
         chub = self.bot.config['main'].get('control_hub', '')
-        self.connection_manager = ConnectionManager(self.bot.reactor, self.bot, streamer=self.bot.streamer, control_hub_channel=chub)
+        num_send_connections = self.bot.config['main'].getint('send_connections', 0)
+        self.connection_manager = ConnectionManager(self.bot.reactor, self.bot, streamer=self.bot.streamer, control_hub_channel=chub,
+                num_send_connections=num_send_connections)
 
         # XXX
         self.bot.execute_every(30, lambda: self.connection_manager.get_main_conn().ping('tmi.twitch.tv'))
 
     def whisper(self, username, message):
-        self.connection_manager.privmsg('#jtv', '/w {} {}'.format(username, message))
+        self.connection_manager.whisper(username, message)
 
     def on_disconnect(self, chatconn, event):
         log.debug('Disconnected from IRC server')
         self.connection_manager.on_disconnect(chatconn)
 
     def _dispatcher(self, connection, event):
+        if getattr(connection, 'send_only', False):
+            # Send-only connections receive whispers too, so only the main connection is passed on to the bot
+            self.connection_manager.on_send_conn_event(connection, event)
+            return
+
         method = getattr(self.bot, 'on_' + event.type, do_nothing)
         method(connection, event)
 
@@ -111,5 +140,21 @@ class MultiIRCManager(IRCManager):
         except Exception:
             log.exception('Exception caught while sending privmsg')
 
+    def send_bulk(self, messages, channel, on_sent=None):
+        # Counted, because twitch counts moderation commands towards the rate limit too
+        for message in messages:
+            self.connection_manager.outbound.push(channel, message, priority=OutboundQueue.PRIORITY_MODERATION, on_sent=on_sent)
+
+    def cancel_bulk(self, messages, channel):
+        return self.connection_manager.outbound.cancel(channel, messages)
+
+    def queue_stats(self):
+        stats = self.connection_manager.outbound.stats()
+        stats['send_connections'] = len([conn for conn in self.connection_manager.send_conns if conn.is_connected()])
+        return stats
+
+    def whisper_queue_stats(self):
+        return self.connection_manager.whispers.stats()
+
     def start(self):
         self.connection_manager.start()
\ No newline at end of file
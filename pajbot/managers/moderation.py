@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class ModerationJob:
+    """
+    A timeout, ban or unban of many users at once, see ModerationManager.moderate_bulk.
+
+    The commands are queued at the highest priority, and sent as fast as the rate limit allows.
+    on_finished is called with the job once all commands have been sent, or when the job is cancelled.
+    """
+
+    ACTIONS = {
+            'timeout': '.timeout {username} {duration} {reason}',
+            'ban': '.ban {username} {reason}',
+            'unban': '.unban {username}',
+            'untimeout': '.untimeout {username}',
+            }
+
+    def __init__(self, id, usernames, action, duration=None, reason='', on_finished=None):
+        if action not in self.ACTIONS:
+            raise ValueError('Unknown moderation action {}'.format(action))
+
+        self.id = id
+        self.action = action
+        self.duration = duration
+        self.reason = reason
+        self.on_finished = on_finished
+
+        # Every user only once, in the order they were given in
+        self.usernames = list(OrderedDict.fromkeys(username.strip().lower() for username in usernames if username.strip()))
+        self.messages = [self.ACTIONS[action].format(username=username, duration=duration, reason=reason).strip() for username in self.usernames]
+
+        self.lock = threading.Lock()
+        self.pending = set(self.messages)
+
+        self.started_at = time.time()
+        self.finished_at = None
+        self.cancelled = False
+
+    @property
+    def num_sent(self):
+        return len(self.messages) - len(self.pending)
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def on_sent(self, message):
+        with self.lock:
+            if message not in self.pending:
+                return
+
+            self.pending.discard(message)
+            if self.pending:
+                return
+
+        self.finish()
+
+    def finish(self):
+        if self.finished_at is not None:
+            return
+
+        self.finished_at = time.time()
+        log.info('Moderation job {} ({}) {}: {}'.format(self.id, self.action, 'cancelled' if self.cancelled else 'finished', self.progress()))
+
+        if self.on_finished is not None:
+            try:
+                self.on_finished(self)
+            except:
+                log.exception('Unhandled exception in on_finished of moderation job {}'.format(self.id))
+
+    def progress(self):
+        """ i.e. 1500/2000 users timed out in 31s """
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        verb = {
+                'timeout': 'timed out',
+                'ban': 'banned',
+                'unban': 'unbanned',
+                'untimeout': 'untimed out',
+                }[self.action]
+
+        return '{}/{} users {} in {:.0f}s'.format(self.num_sent, len(self.messages), verb, elapsed)
+
+
+class ModerationManager:
+    def __init__(self, bot):
+        self.bot = bot
+
+        self.num_jobs = 0
+
+        # Jobs that are still sending, oldest first
+        self.jobs = []
+
+    def moderate_bulk(self, usernames, action, duration=None, reason='', on_finished=None):
+        """
+        Timeout, ban or unban a lot of users as fast as the rate limit allows.
+        Moderation commands are sent before any other message, and over the send connections if there are any.
+
+        Returns a ModerationJob, which can be cancelled with ModerationManager.cancel
+        """
+        self.num_jobs += 1
+
+        def job_finished(job):
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+            if on_finished is not None:
+                on_finished(job)
+
+        job = ModerationJob(self.num_jobs, usernames, action, duration=duration, reason=reason, on_finished=job_finished)
+        log.info('Moderation job {}: {} {} users'.format(job.id, action, len(job.messages)))
+
+        if not job.messages:
+            job.finish()
+            return job
+
+        self.jobs.append(job)
+        self.bot.irc.send_bulk(job.messages, self.bot.channel, on_sent=job.on_sent)
+
+        return job
+
+    def cancel(self, job):
+        """ Stop sending the commands of the job that have not been sent yet """
+        if job.finished:
+            return 0
+
+        with job.lock:
+            job.cancelled = True
+            pending = list(job.pending)
+
+        num_cancelled = self.bot.irc.cancel_bulk(pending, self.bot.channel)
+
+        job.finish()
+        return num_cancelled
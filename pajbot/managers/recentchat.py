@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import deque
+
+import regex as re
+
+log = logging.getLogger(__name__)
+
+
+class RecentChatMessage:
+    def __init__(self, timestamp, username, message):
+        self.timestamp = timestamp
+        self.username = username
+        self.message = message
+        self.lower = message.lower()
+
+
+class RecentChatManager:
+    """
+    The last max_size chat messages, fed from Bot.on_pubmsg.
+    Used to look back at what was said without going through any external logs, i.e. for !nuke.
+
+    Queries go from the newest message backwards, so they only look at the messages in the window they ask for.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+
+        # All messages, oldest first
+        self.messages = deque()
+
+        # Key = username
+        # Value = deque of the messages of that user that are still in self.messages, oldest first
+        self.user_messages = {}
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, username, message, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        recent_message = RecentChatMessage(timestamp, username, message)
+        self.messages.append(recent_message)
+
+        user_messages = self.user_messages.get(username, None)
+        if user_messages is None:
+            user_messages = self.user_messages[username] = deque()
+        user_messages.append(recent_message)
+
+        if len(self.messages) > self.max_size:
+            oldest = self.messages.popleft()
+            oldest_user_messages = self.user_messages[oldest.username]
+            oldest_user_messages.popleft()
+            if not oldest_user_messages:
+                del self.user_messages[oldest.username]
+
+        return recent_message
+
+    def last(self, seconds=None, count=None, username=None, now=None):
+        """ Yields the messages of the last seconds seconds and/or the last count messages, newest first.
+        If username is given, only messages from that user are looked at. """
+        if now is None:
+            now = time.time()
+
+        if username is None:
+            messages = self.messages
+        else:
+            messages = self.user_messages.get(username, ())
+
+        since = now - seconds if seconds is not None else None
+        for index, recent_message in enumerate(reversed(messages)):
+            if count is not None and index >= count:
+                return
+
+            if since is not None and recent_message.timestamp < since:
+                return
+
+            yield recent_message
+
+    def search(self, phrase=None, regex=None, seconds=None, count=None, ignore_case=False, now=None, timeout=None):
+        """
+        Returns the messages in the window (see RecentChatManager.last) that contain phrase,
+        or match regex (a string or a compiled pattern from the regex module), oldest first.
+
+        Raises regex.error if regex is not a valid regular expression, and TimeoutError
+        if matching regex against the messages takes longer than timeout seconds in total.
+        """
+        if regex is not None:
+            if isinstance(regex, str):
+                regex = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+
+            deadline = time.perf_counter() + timeout if timeout is not None else None
+
+            def matches(recent_message):
+                if deadline is None:
+                    return regex.search(recent_message.message) is not None
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError('regex search timed out')
+
+                return regex.search(recent_message.message, timeout=remaining) is not None
+        elif ignore_case:
+            phrase = phrase.lower()
+
+            def matches(recent_message):
+                return phrase in recent_message.lower
+        else:
+            def matches(recent_message):
+                return phrase in recent_message.message
+
+        result = [recent_message for recent_message in self.last(seconds=seconds, count=count, now=now) if matches(recent_message)]
+        result.reverse()
+        return result
+
+    def find_users(self, phrase=None, regex=None, seconds=None, count=None, ignore_case=False, now=None, timeout=None):
+        """ Same as RecentChatManager.search, but returns the usernames of the matching messages, each only once """
+        usernames = []
+        seen = set()
+        for recent_message in self.search(phrase=phrase, regex=regex, seconds=seconds, count=count, ignore_case=ignore_case, now=now, timeout=timeout):
+            if recent_message.username not in seen:
+                seen.add(recent_message.username)
+                usernames.append(recent_message.username)
+
+        return usernames
@@ -1,21 +1,29 @@
 import logging
+import time
 from contextlib import contextmanager
 
 from pajbot.managers.db import DBManager
 from pajbot.models.user import User
+from pajbot.models.user import UserCache
 from pajbot.models.user import UserCombined
-from pajbot.models.user import UserSQLCache
+from pajbot.models.user import UserRedisBuffer
+from pajbot.models.user import UserTagCache
 from pajbot.utils import time_method
 
 log = logging.getLogger(__name__)
 
 
 class UserManager:
-    data = {}
+    # How often changed users are written to the database, in seconds
+    SQL_FLUSH_INTERVAL = 5
+
     _instance = None
 
-    def __init__(self):
-        UserSQLCache.init()
+    def __init__(self, cache_size=10000, cache_ttl=30 * 60):
+        UserCache.init(max_size=cache_size, ttl=cache_ttl)
+        UserRedisBuffer.init()
+        UserTagCache.init(max_size=cache_size)
+        self.last_sql_flush = time.time()
         UserManager._instance = self
 
     def get():
@@ -24,7 +32,32 @@ class UserManager:
     def save(self, user):
         """ Saves all data for a user.
         This means cached data (like his debts) and SQL """
-        self.data[user.username] = user.save()
+        extra = user.save()
+        if any(extra.values()) or UserCache.get(user.username) is not None:
+            # Users without any in-memory state don't need a cache entry
+            UserCache.set_extra(user.username, extra)
+
+    def flush(self, force=False):
+        """ Sends all buffered redis writes for users (and changed user tags) in one pipeline each,
+        and writes changed users to the database every SQL_FLUSH_INTERVAL seconds """
+        try:
+            UserRedisBuffer.flush()
+        except:
+            log.exception('Caught exception while flushing the user redis buffer')
+
+        try:
+            UserTagCache.flush()
+        except:
+            log.exception('Caught exception while flushing the user tags')
+
+        now = time.time()
+        if force or now - self.last_sql_flush >= self.SQL_FLUSH_INTERVAL:
+            self.last_sql_flush = now
+            UserCache.flush()
+
+    def invalidate(self, usernames):
+        """ Call after updating the given users in the database without going through UserCombined """
+        UserCache.invalidate(usernames)
 
     def get_static(username, db_session=None, user_model=None, redis=None):
         return UserCombined(username, db_session=db_session, user_model=user_model, redis=redis)
@@ -32,14 +65,14 @@ class UserManager:
     def get_user(self, username, db_session=None, user_model=None, redis=None):
         """ Return to call UserManager.save(user.username) an the user object manually when done with if. """
         user = UserCombined(username, db_session=db_session, user_model=user_model, redis=redis)
-        user.load(**self.data.get(username, {}))
+        user.load(**UserCache.get_extra(username))
         return user
 
     @contextmanager
     def get_user_context(self, username):
         try:
             user = UserCombined(username)
-            user.load(**self.data.get(username, {}))
+            user.load(**UserCache.get_extra(username))
 
             yield user
         except:
@@ -128,9 +161,12 @@ class UserManager:
     @time_method
     def reset_subs(self):
         """ Returns how many subs were reset """
+        self.flush(force=True)
         with DBManager.create_session_scope() as db_session:
-            return db_session.query(User).filter_by(subscriber=True).\
+            num_reset = db_session.query(User).filter_by(subscriber=True).\
                     update({User.subscriber: False}, synchronize_session=False)
+        UserCache.invalidate(list(UserCache.entries))
+        return num_reset
 
     @time_method
     def update_subs(self, subs):
@@ -138,6 +174,8 @@ class UserManager:
         subs is a list of usernames
         """
 
+        self.flush(force=True)
+        self.invalidate(subs)
         with DBManager.create_session_scope() as db_session:
             subs = set(subs)
             for user in db_session.query(User).filter(User.username.in_(subs)):
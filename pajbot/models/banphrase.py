@@ -1,7 +1,10 @@
 import argparse
 import logging
-import re
+import threading
+import time
+from collections import OrderedDict
 
+import regex as re
 import sqlalchemy
 from sqlalchemy import Boolean
 from sqlalchemy import Column
@@ -11,13 +14,26 @@ from sqlalchemy import String
 from sqlalchemy.orm import relationship
 from unidecode import unidecode
 
+from pajbot.ahocorasick import AhoCorasick
+from pajbot.managers.adminlog import AdminLogManager
 from pajbot.managers.db import Base
 from pajbot.managers.db import DBManager
+from pajbot.managers.redis import RedisManager
+from pajbot.streamhelper import StreamHelper
 from pajbot.utils import find
 
 log = logging.getLogger('pajbot')
 
 
+def format_message(message, lowercase, remove_accents):
+    if lowercase:
+        message = message.lower()
+    if remove_accents:
+        message = unidecode(message)
+
+    return message
+
+
 class Banphrase(Base):
     __tablename__ = 'tb_banphrase'
 
@@ -48,6 +64,10 @@ class Banphrase(Base):
     DEFAULT_TIMEOUT_LENGTH = 300
     DEFAULT_NOTIFY = True
 
+    # Max amount of seconds a regex banphrase is allowed to run on a single message.
+    # If it takes longer than this, a TimeoutError is raised.
+    REGEX_TIMEOUT = 0.1
+
     def __init__(self, **options):
         self.id = None
         self.name = 'No name'
@@ -80,12 +100,9 @@ class Banphrase(Base):
         self.refresh_operator()
 
     def format_message(self, message):
-        if self.case_sensitive is False and self.operator != 'regex':
-            message = message.lower()
-        if self.remove_accents:
-            message = unidecode(message)
-
-        return message
+        return format_message(message,
+                self.case_sensitive is False and self.operator != 'regex',
+                self.remove_accents)
 
     def get_phrase(self):
         if not self.case_sensitive:
@@ -121,7 +138,7 @@ class Banphrase(Base):
         if not self.compiled_regex:
             return False
 
-        return self.compiled_regex.search(self.format_message(message))
+        return self.compiled_regex.search(self.format_message(message), timeout=self.REGEX_TIMEOUT)
 
     def match(self, message, user):
         """
@@ -129,10 +146,13 @@ class Banphrase(Base):
         Otherwise it returns False
         Respects case-sensitiveness option
         """
-        if user and self.sub_immunity is True and user.subscriber is True:
+        if self.is_immune(user):
             return False
         return self.predicate(message)
 
+    def is_immune(self, user):
+        return user and self.sub_immunity is True and user.subscriber is True
+
     def greater_than(self, other):
         if other.permanent:
             if self.permanent:
@@ -217,11 +237,276 @@ class BanphraseData(Base):
         self.edited_by = options.get('edited_by', self.edited_by)
 
 
+class RegexBanphraseGroup:
+    """
+    A group of regex banphrases with the same flags, merged into one pattern
+    with a named group per banphrase.
+    The combined pattern is searched first, and the banphrases are only
+    searched one by one if the combined pattern matched something.
+    """
+
+    # Phrases with inline flags, named groups or backreferences can't be safely merged
+    UNMERGEABLE_RE = re.compile(r'\(\?[a-zA-Z]|\\[0-9]|\\g')
+
+    MAX_GROUP_SIZE = 50
+
+    def __init__(self, members, remove_accents):
+        # List of (index, banphrase) tuples
+        self.members = members
+        self.remove_accents = remove_accents
+        self.group_names = {}
+
+        if len(members) == 1:
+            self.compiled_regex = members[0][1].compiled_regex
+            return
+
+        patterns = []
+        for index, banphrase in members:
+            group_name = 'b{}'.format(index)
+            self.group_names[group_name] = (index, banphrase)
+            patterns.append('(?P<{}>{})'.format(group_name, banphrase.phrase))
+
+        self.compiled_regex = re.compile('|'.join(patterns), flags=members[0][1].compiled_regex.flags)
+
+    def is_mergeable(banphrase):
+        return not banphrase.compiled_regex.groupindex and not RegexBanphraseGroup.UNMERGEABLE_RE.search(banphrase.phrase)
+
+    def create_groups(banphrases):
+        """ Returns a list of RegexBanphraseGroup for the given list of (index, banphrase) tuples """
+        groups = []
+
+        # Key = (case_sensitive, remove_accents)
+        # Value = list of (index, banphrase) tuples
+        mergeable = {}
+
+        for index, banphrase in banphrases:
+            if banphrase.compiled_regex is None:
+                continue
+
+            if not RegexBanphraseGroup.is_mergeable(banphrase):
+                groups.append(RegexBanphraseGroup([(index, banphrase)], banphrase.remove_accents))
+                continue
+
+            variant = (banphrase.case_sensitive, banphrase.remove_accents)
+            mergeable.setdefault(variant, []).append((index, banphrase))
+
+        for (case_sensitive, remove_accents), members in mergeable.items():
+            for i in range(0, len(members), RegexBanphraseGroup.MAX_GROUP_SIZE):
+                chunk = members[i:i + RegexBanphraseGroup.MAX_GROUP_SIZE]
+                try:
+                    groups.append(RegexBanphraseGroup(chunk, remove_accents))
+                except Exception:
+                    log.exception('Unable to merge regex banphrases, falling back to matching them one by one')
+                    for member in chunk:
+                        groups.append(RegexBanphraseGroup([member], remove_accents))
+
+        return groups
+
+
+class BanphraseVerdictCache:
+    """
+    The banphrases that matched each of the last max_size messages checked, least recently checked message evicted first.
+
+    Messages are not normalized before the lookup, case sensitive, exact and regex banphrases can
+    give a different verdict for messages that only differ in case or whitespace.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+
+        # Key = message
+        # Value = tuple of the matching banphrases
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        # Messages are checked from the bot thread, the action queue and web requests
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, message):
+        """ Returns the banphrases that matched the message, or None if the message is not cached """
+        with self.lock:
+            matches = self.entries.get(message, None)
+            if matches is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(message)
+            return matches
+
+    def set(self, message, matches):
+        with self.lock:
+            self.entries[message] = tuple(matches)
+            self.entries.move_to_end(message)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                }
+
+
+class BanphraseMatcher:
+    """
+    Compiled version of a list of banphrases.
+
+    All contains/startswith/endswith/exact banphrases are put into one Aho-Corasick
+    automaton per way the message needs to be formatted (lowercased and/or with accents removed),
+    so every message is only formatted and scanned once per variant instead of once per banphrase.
+    Regex banphrases are merged into a few combined patterns, see RegexBanphraseGroup.
+    Every regex search is limited to Banphrase.REGEX_TIMEOUT seconds, and any regex banphrase
+    that goes over this limit is passed to on_regex_timeout. Without on_regex_timeout, the banphrase
+    is only skipped for that message, and the verdict for that message is not cached.
+
+    The matcher is immutable, the BanphraseManager builds a new one whenever the banphrases change,
+    which also throws away the verdicts cached by check.
+    """
+
+    OPERATORS = ('contains', 'startswith', 'endswith', 'exact')
+
+    def __init__(self, banphrases, on_regex_timeout=None, cache_size=10000):
+        self.on_regex_timeout = on_regex_timeout
+        self.verdicts = BanphraseVerdictCache(max_size=cache_size)
+
+        # Key = (lowercase, remove_accents)
+        # Value = AhoCorasick automaton with (index, banphrase) values
+        self.automatons = {}
+
+        # List of (index, banphrase) tuples
+        self.fallback = []
+
+        regex_banphrases = []
+
+        for index, banphrase in enumerate(banphrases):
+            if banphrase.operator == 'regex':
+                regex_banphrases.append((index, banphrase))
+                continue
+
+            phrase = banphrase.get_phrase()
+            if banphrase.operator not in self.OPERATORS or not phrase:
+                self.fallback.append((index, banphrase))
+                continue
+
+            variant = (not banphrase.case_sensitive, banphrase.remove_accents)
+            if variant not in self.automatons:
+                self.automatons[variant] = AhoCorasick()
+            self.automatons[variant].add(phrase, (index, banphrase))
+
+        for automaton in self.automatons.values():
+            automaton.build()
+
+        self.regex_groups = RegexBanphraseGroup.create_groups(regex_banphrases)
+
+    def find_matches(self, message, user, message_context=None, timed_out=None):
+        """ Returns a list of all banphrases that match the message,
+        in the same order as the list of banphrases the matcher was built from.
+        If a MessageContext is given, its cached formatted messages are used.
+        Regex banphrases that timed out are appended to timed_out if it's given. """
+        if message_context is not None:
+            format = message_context.format_message
+        else:
+            def format(lowercase, remove_accents):
+                return format_message(message, lowercase, remove_accents)
+
+        # Key = index of the banphrase
+        # Value = Banphrase
+        matches = {}
+
+        for (lowercase, remove_accents), automaton in self.automatons.items():
+            formatted_message = format(lowercase, remove_accents)
+            message_length = len(formatted_message)
+
+            for start, end, (index, banphrase) in automaton.iter(formatted_message):
+                if index in matches:
+                    continue
+
+                if banphrase.operator == 'startswith' and start != 0:
+                    continue
+                if banphrase.operator == 'endswith' and end != message_length:
+                    continue
+                if banphrase.operator == 'exact' and (start != 0 or end != message_length):
+                    continue
+
+                if banphrase.is_immune(user):
+                    continue
+
+                matches[index] = banphrase
+
+        for group in self.regex_groups:
+            formatted_message = format(False, group.remove_accents)
+
+            if len(group.members) == 1:
+                index, banphrase = group.members[0]
+                if not banphrase.is_immune(user) and self.regex_search(banphrase, formatted_message, timed_out):
+                    matches[index] = banphrase
+                continue
+
+            try:
+                match = group.compiled_regex.search(formatted_message, timeout=Banphrase.REGEX_TIMEOUT)
+            except TimeoutError:
+                # Search the banphrases one by one to figure out which one is slow
+                match = True
+
+            if not match:
+                continue
+
+            if match is not True:
+                index, banphrase = group.group_names[match.lastgroup]
+                if not banphrase.is_immune(user):
+                    matches[index] = banphrase
+
+            for index, banphrase in group.members:
+                if index in matches or banphrase.is_immune(user):
+                    continue
+
+                if self.regex_search(banphrase, formatted_message, timed_out):
+                    matches[index] = banphrase
+
+        for index, banphrase in self.fallback:
+            if banphrase.match(message, user):
+                matches[index] = banphrase
+
+        return [matches[index] for index in sorted(matches)]
+
+    def check(self, message, user, message_context=None):
+        """ Same as find_matches, but the banphrases that match a message are cached for repeated messages.
+        Sub immunity is applied after the lookup, so the cached verdict is the same for every user. """
+        matches = self.verdicts.get(message)
+        if matches is None:
+            timed_out = []
+            matches = self.find_matches(message, None, message_context=message_context, timed_out=timed_out)
+            if not timed_out:
+                self.verdicts.set(message, matches)
+
+        return [banphrase for banphrase in matches if not banphrase.is_immune(user)]
+
+    def regex_search(self, banphrase, formatted_message, timed_out=None):
+        try:
+            return banphrase.compiled_regex.search(formatted_message, timeout=Banphrase.REGEX_TIMEOUT)
+        except TimeoutError:
+            log.warning('Regex banphrase {} ({}) timed out on message "{}"'.format(banphrase.id, banphrase.phrase, formatted_message[:200]))
+            if timed_out is not None:
+                timed_out.append(banphrase)
+            if self.on_regex_timeout:
+                self.on_regex_timeout(banphrase)
+
+        return None
+
+
 class BanphraseManager:
     def __init__(self, bot):
         self.bot = bot
         self.banphrases = []
         self.enabled_banphrases = []
+        self.matcher = BanphraseMatcher([])
         self.db_session = DBManager.create_session(expire_on_commit=False)
 
         if self.bot:
@@ -258,6 +543,8 @@ class BanphraseManager:
             if banphrase.enabled is False:
                 self.enabled_banphrases.remove(banphrase)
 
+        self.rebuild_matcher()
+
     def on_banphrase_remove(self, data, conn):
         try:
             banphrase_id = int(data['id'])
@@ -276,13 +563,54 @@ class BanphraseManager:
             if removed_banphrase in self.banphrases:
                 self.banphrases.remove(removed_banphrase)
 
+            self.rebuild_matcher()
+
     def load(self):
         self.banphrases = self.db_session.query(Banphrase).all()
         for banphrase in self.banphrases:
             self.db_session.expunge(banphrase)
         self.enabled_banphrases = [banphrase for banphrase in self.banphrases if banphrase.enabled is True]
+        self.rebuild_matcher(changed=False)
         return self
 
+    def rebuild_matcher(self, changed=True):
+        """ Must be called whenever a banphrase is added, removed or edited """
+        # Only the bot disables regex banphrases that time out, anyone can make the web process check a message
+        on_regex_timeout = self.on_regex_timeout if self.bot else None
+        self.matcher = BanphraseMatcher(self.enabled_banphrases, on_regex_timeout=on_regex_timeout)
+
+        if changed and self.bot:
+            BanphraseManager.banphrases_changed()
+
+    def version_key():
+        return '{streamer}:banphrases:version'.format(streamer=StreamHelper.get_streamer())
+
+    def banphrases_changed():
+        """ Lets the web process know it has to load the banphrases again, see BanphraseCheckService """
+        try:
+            RedisManager.get().incr(BanphraseManager.version_key())
+        except:
+            log.exception('Failed to update the banphrase version')
+
+    def on_regex_timeout(self, banphrase):
+        """ Disable a regex banphrase that took too long to run,
+        so it can't stall the processing of every message. """
+        if banphrase.enabled is False:
+            return
+
+        log.warning('Disabling regex banphrase {} ({}) because it took too long to run'.format(banphrase.id, banphrase.phrase))
+
+        banphrase.enabled = False
+        if banphrase in self.enabled_banphrases:
+            self.enabled_banphrases.remove(banphrase)
+        self.rebuild_matcher()
+
+        if banphrase.id is not None:
+            with DBManager.create_session_scope() as db_session:
+                db_session.query(Banphrase).filter_by(id=banphrase.id).update({'enabled': False})
+
+        AdminLogManager.post('Banphrase timed out', None, banphrase.phrase)
+
     def commit(self):
         self.db_session.commit()
 
@@ -301,6 +629,7 @@ class BanphraseManager:
 
         self.banphrases.append(banphrase)
         self.enabled_banphrases.append(banphrase)
+        self.rebuild_matcher()
 
         return banphrase, True
 
@@ -308,6 +637,7 @@ class BanphraseManager:
         self.banphrases.remove(banphrase)
         if banphrase in self.enabled_banphrases:
             self.enabled_banphrases.remove(banphrase)
+        self.rebuild_matcher()
 
         self.db_session.expunge(banphrase.data)
         self.db_session.delete(banphrase)
@@ -346,19 +676,14 @@ class BanphraseManager:
             notification_msg = 'You have been {punishment} because your message matched the "{banphrase.name}" banphrase.'.format(punishment=punishment, banphrase=banphrase)
             self.bot.whisper(user.username, notification_msg)
 
-    def check_message(self, message, user):
+    def check_message(self, message, user, message_context=None):
+        """ Returns the greatest banphrase (see Banphrase.greater_than) that matches the message,
+        or False if no banphrase matches. """
         matched_banphrase = None
-        for banphrase in self.enabled_banphrases:
-            if banphrase.match(message, user):
-                if matched_banphrase:
-                    if banphrase.greater_than(matched_banphrase):
-                        matched_banphrase = banphrase
-                        continue
-
+        for banphrase in self.matcher.check(message, user, message_context=message_context):
+            if matched_banphrase is None or banphrase.greater_than(matched_banphrase):
                 matched_banphrase = banphrase
 
-        # match = find(lambda banphrase: banphrase.match(message, user), self.enabled_banphrases)
-
         return matched_banphrase or False
 
     def find_match(self, message, id=None):
@@ -416,3 +741,66 @@ class BanphraseManager:
         log.info(options)
 
         return options, response
+
+
+class BanphraseCheckService:
+    """
+    Answers "is this message banned?" for the web API, with one BanphraseManager for the whole web process.
+    The banphrases are loaded and compiled once, and loaded again after the bot or the web
+    changed them (see BanphraseManager.banphrases_changed), so verdicts are cached across requests.
+    Regex banphrases that time out are only skipped for that message, the web process never disables them.
+    """
+
+    # Twitch chat messages are at most 500 characters long
+    MAX_MESSAGE_LENGTH = 500
+
+    # Max number of /banphrases/check requests per minute from the same IP address, 0 = no limit.
+    # Set from banphrase_check_rate_limit in the [web] config section
+    rate_limit = 6000
+
+    manager = None
+    version = None
+    lock = threading.Lock()
+
+    def get_manager():
+        try:
+            version = RedisManager.get().get(BanphraseManager.version_key())
+        except:
+            log.exception('Failed to get the banphrase version')
+            version = BanphraseCheckService.version
+
+        with BanphraseCheckService.lock:
+            if BanphraseCheckService.manager is None or version != BanphraseCheckService.version:
+                old_manager = BanphraseCheckService.manager
+                BanphraseCheckService.manager = BanphraseManager(None).load()
+                BanphraseCheckService.version = version
+
+                if old_manager is not None:
+                    old_manager.db_session.close()
+
+            return BanphraseCheckService.manager
+
+    def check_messages(messages):
+        """ Returns the greatest matching banphrase (or False) for every message """
+        manager = BanphraseCheckService.get_manager()
+        return [manager.check_message(message, None) for message in messages]
+
+    def rate_limited(ip, now=None):
+        """ Counts a request from ip, returns True if ip made more than rate_limit requests this minute """
+        if BanphraseCheckService.rate_limit <= 0:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        key = '{streamer}:banphrases:check:requests:{ip}:{minute}'.format(streamer=StreamHelper.get_streamer(), ip=ip, minute=int(now // 60))
+        try:
+            pipeline = RedisManager.get().pipeline()
+            pipeline.incr(key)
+            pipeline.expire(key, 60)
+            num_requests = pipeline.execute()[0]
+        except:
+            log.exception('Failed to count the banphrase check requests from {}'.format(ip))
+            return False
+
+        return num_requests > BanphraseCheckService.rate_limit
@@ -1,7 +1,7 @@
 import json
 import logging
-import re
 
+import regex as re
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import Integer
@@ -31,6 +31,10 @@ class Filter(Base):
     DEFAULT_TIMEOUT_LENGTH = 300
     DEFAULT_NOTIFY = True
 
+    # Max amount of seconds a regex filter is allowed to run on a single message.
+    # If it takes longer than this, a TimeoutError is raised.
+    REGEX_TIMEOUT = 0.1
+
     def __init__(self, action, filter, **options):
         self.id = None
         self.name = 'Filter'
@@ -82,11 +86,11 @@ class Filter(Base):
 
     def match(self, source, message):
         if not self.source or self.source == source:
-            return self.regex.match(message)
+            return self.regex.match(message, timeout=self.REGEX_TIMEOUT)
 
     def search(self, source, message):
         if not self.source or self.source == source.username:
-            return self.regex.search(message)
+            return self.regex.search(message, timeout=self.REGEX_TIMEOUT)
 
         return None
 
@@ -0,0 +1,104 @@
+import logging
+
+from unidecode import unidecode
+
+log = logging.getLogger(__name__)
+
+
+class MessageContext:
+    """
+    Everything we know about a single chat message.
+
+    Built once per message in Bot.on_pubmsg/Bot.on_whisper and passed to every
+    on_pubmsg/on_message handler that was added with context=True.
+    The different versions of the message (lowercased, split into words etc.)
+    are only computed the first time they are used, and then cached.
+    """
+
+    def __init__(self, bot, source, message, event, whisper=False):
+        self.bot = bot
+        self.source = source
+        self.message = message
+        self.event = event
+        self.whisper = whisper
+
+        self._tags = None
+        self._lower = None
+        self._unidecoded = None
+        self._words = None
+        self._words_lower = None
+        self._urls = None
+        self._emotes = None
+        self._lower_unidecoded = None
+
+    @property
+    def tags(self):
+        """ IRCv3 tags of the message as a dictionary """
+        if self._tags is None:
+            self._tags = {}
+            if self.event is not None and self.event.tags:
+                for tag in self.event.tags:
+                    self._tags[tag['key']] = tag['value']
+
+        return self._tags
+
+    @property
+    def lower(self):
+        if self._lower is None:
+            self._lower = self.message.lower()
+
+        return self._lower
+
+    @property
+    def unidecoded(self):
+        if self._unidecoded is None:
+            self._unidecoded = unidecode(self.message)
+
+        return self._unidecoded
+
+    @property
+    def words(self):
+        """ The message split on spaces """
+        if self._words is None:
+            self._words = self.message.split(' ')
+
+        return self._words
+
+    @property
+    def words_lower(self):
+        """ The lowercased message split on spaces """
+        if self._words_lower is None:
+            self._words_lower = self.lower.split(' ')
+
+        return self._words_lower
+
+    @property
+    def urls(self):
+        if self._urls is None:
+            self._urls = self.bot.find_unique_urls(self.message)
+
+        return self._urls
+
+    @property
+    def emotes(self):
+        """ Emotes in the message, see EmoteManager.parse_message_twitch_emotes """
+        if self._emotes is None:
+            self._emotes = self.bot.emotes.parse_message_twitch_emotes(self.source, self.message, self.tags.get('emotes', None), self.whisper)
+
+        return self._emotes
+
+    def format_message(self, lowercase, remove_accents):
+        """ Same as pajbot.models.banphrase.format_message, but cached """
+        if not lowercase and not remove_accents:
+            return self.message
+
+        if not remove_accents:
+            return self.lower
+
+        if not lowercase:
+            return self.unidecoded
+
+        if self._lower_unidecoded is None:
+            self._lower_unidecoded = unidecode(self.lower)
+
+        return self._lower_unidecoded
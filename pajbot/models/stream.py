@@ -17,6 +17,7 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import reconstructor
 from sqlalchemy.orm import relationship
 
+from pajbot.managers.chatstats import ChatStats
 from pajbot.managers.db import Base
 from pajbot.managers.db import DBManager
 from pajbot.managers.handler import HandlerManager
@@ -172,6 +173,7 @@ class StreamManager:
     NUM_OFFLINES_REQUIRED = 10
     STATUS_CHECK_INTERVAL = 20  # seconds
     VIDEO_URL_CHECK_INTERVAL = 60 * 5  # seconds
+    CHAT_STATS_PUBLISH_INTERVAL = 10  # seconds
 
     def fetch_video_url_stage1(self):
         if self.online is False:
@@ -225,12 +227,16 @@ class StreamManager:
         self.game = 'Loading...'
         self.title = 'Loading...'
 
+        # Most used emotes and words, fed from Bot.parse_message
+        self.chat_stats = ChatStats()
+
         self.bot.execute_every(self.STATUS_CHECK_INTERVAL,
                 self.bot.action_queue.add,
                 (self.refresh_stream_status_stage1, ))
         self.bot.execute_every(self.VIDEO_URL_CHECK_INTERVAL,
                 self.bot.action_queue.add,
                 (self.refresh_video_url_stage1, ))
+        self.bot.execute_every(self.CHAT_STATS_PUBLISH_INTERVAL, self.publish_chat_stats)
 
         """
         This will load the latest stream so we can post an accurate
@@ -351,6 +357,7 @@ class StreamManager:
             db_session.expunge_all()
 
             if new_stream:
+                self.chat_stats.reset_stream()
                 self.bot.say('dank__doge SoBayed')
                 HandlerManager.trigger('on_stream_start', stop_on_false=False)
 
@@ -487,6 +494,11 @@ class StreamManager:
         if self.current_stream_chunk.video_url is None:
             return 'No video URL fetched for this chunk yet, try in 5 minutes'
 
+        if 'description' not in options:
+            top_emotes = self.get_chat_stats_value('emotes_1m')
+            if top_emotes is not None:
+                options['description'] = 'Top emotes: {}'.format(top_emotes)[:128]
+
         try:
             highlight = StreamChunkHighlight(self.current_stream_chunk, **options)
 
@@ -552,6 +564,28 @@ class StreamManager:
 
         return (num_rows == 1)
 
+    def publish_chat_stats(self):
+        """ Make the chat stats available to the web interface (/api/v1/chatstats) """
+        try:
+            RedisManager.get().set('{streamer}:chat_stats'.format(streamer=self.bot.streamer),
+                    json.dumps(self.chat_stats.summary(), separators=(',', ':')))
+        except:
+            log.exception('Failed to publish the chat stats')
+
+    def get_chat_stats_value(self, key, extra={}):
+        """ $(stats:emotes_10m) = the 5 most used emotes of the last 10 minutes, i.e. PogChamp (412), Kappa (120)
+        See ChatStats.WINDOWS for the windows, words can be used instead of emotes """
+        kind, _, window = key.partition('_')
+        try:
+            top = self.chat_stats.top(kind, window)
+        except ValueError:
+            return None
+
+        if not top:
+            return None
+
+        return ', '.join('{} ({:,d})'.format(item, count) for item, count in top)
+
     def get_stream_value(self, key, extra={}):
         return getattr(self, key, None)
 
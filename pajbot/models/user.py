@@ -1,6 +1,9 @@
 import datetime
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 
 import sqlalchemy
@@ -13,7 +16,6 @@ from pajbot.exc import FailedCommand
 from pajbot.managers.db import Base
 from pajbot.managers.db import DBManager
 from pajbot.managers.redis import RedisManager
-from pajbot.managers.schedule import ScheduleManager
 from pajbot.managers.time import TimeManager
 from pajbot.streamhelper import StreamHelper
 from pajbot.utils import time_method  # NOQA
@@ -67,35 +69,498 @@ class User(Base):
         return user
 
 
+class UserCacheEntry:
+    def __init__(self, username):
+        self.username = username
+
+        # The detached User model, or None if it hasn't been loaded
+        self.model = None
+
+        # State that is only kept in memory (debts, moderator, timed_out, timeout_end)
+        self.extra = {}
+
+        # Column values that were set while the model was not loaded.
+        # They are applied when the model is loaded, or on the next flush.
+        # Key = column name
+        # Value = new value
+        self.pending = {}
+
+        self.last_access = time.time()
+
+    def pinned(self):
+        """ Entries with state that only exists in memory are not evicted
+        for being the least recently used """
+        if self.extra.get('debts', None):
+            return True
+
+        try:
+            timeout_end = self.extra.get('timeout_end', None)
+            return self.extra.get('timed_out', False) is True and timeout_end is not None and timeout_end > datetime.datetime.now()
+        except:
+            return False
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user models and in-memory user state.
+
+    Models are loaded once and then shared by every UserCombined object for that
+    user. Changed models are marked dirty when the user is saved, and written to
+    the database in a single transaction when flush is called.
+    Entries that have not been used for `ttl` seconds, or that are pushed out
+    because the cache has more than `max_size` entries, are written back before
+    they are dropped.
+    The cache is only used when enabled, i.e. in the bot process.
+    It's used from the reactor thread, the main thread queue and the action queue threads,
+    so every public method holds the lock.
+    """
+
+    enabled = False
+    max_size = 10000
+    ttl = 30 * 60
+
+    # Reentrant, the public methods call each other
+    lock = threading.RLock()
+
+    # Key = username
+    # Value = UserCacheEntry, least recently used first
+    entries = OrderedDict()
+
+    # Usernames of entries with changes that have not been written to the database yet
+    dirty = set()
+
+    # Entries that were dropped from the cache before their changes were written
+    # Key = username
+    # Value = UserCacheEntry
+    evicted = {}
+
+    def init(max_size=10000, ttl=30 * 60):
+        UserCache.enabled = True
+        UserCache.max_size = max_size
+        UserCache.ttl = ttl
+
+    def get(username):
+        """ Returns the UserCacheEntry for the given username, or None if it's not cached """
+        with UserCache.lock:
+            entry = UserCache.entries.get(username, None)
+            now = time.time()
+            if entry is None:
+                entry = UserCache.evicted.pop(username, None)
+                if entry is None:
+                    return None
+
+                # The entry was evicted but not written back yet, keep using it
+                UserCache.entries[username] = entry
+                UserCache.dirty.add(username)
+                UserCache.enforce_size()
+            elif entry.last_access + UserCache.ttl < now and not entry.pinned():
+                UserCache.evict(username)
+                return None
+            else:
+                UserCache.entries.move_to_end(username)
+
+            entry.last_access = now
+            return entry
+
+    def get_or_create(username):
+        with UserCache.lock:
+            entry = UserCache.get(username)
+            if entry is None:
+                entry = UserCacheEntry(username)
+                UserCache.entries[username] = entry
+                UserCache.enforce_size()
+
+            return entry
+
+    def get_model(username):
+        with UserCache.lock:
+            entry = UserCache.get(username)
+            if entry is None:
+                return None
+
+            return entry.model
+
+    def get_extra(username):
+        with UserCache.lock:
+            entry = UserCache.get(username)
+            if entry is None:
+                return {}
+
+            return entry.extra
+
+    def set_model(model):
+        with UserCache.lock:
+            entry = UserCache.get_or_create(model.username)
+            entry.model = model
+            if entry.pending:
+                UserCache.apply_pending(model, entry.pending)
+                entry.pending = {}
+                UserCache.dirty.add(model.username)
+
+    def set_pending(username, values):
+        """ Set column values for a user without loading its model """
+        with UserCache.lock:
+            entry = UserCache.get_or_create(username)
+            if entry.model is not None:
+                UserCache.apply_pending(entry.model, values)
+            else:
+                entry.pending.update(values)
+            UserCache.dirty.add(username)
+
+    def apply_pending(model, values):
+        for key, value in values.items():
+            setattr(model, key, value)
+
+    def set_extra(username, extra):
+        with UserCache.lock:
+            UserCache.get_or_create(username).extra = extra
+
+    def mark_dirty(model):
+        with UserCache.lock:
+            entry = UserCache.get_or_create(model.username)
+            entry.model = model
+            UserCache.dirty.add(model.username)
+
+    def pop_model(username):
+        """ Removes the model from the cache and returns it if it has unsaved changes.
+        Used when the user is about to be modified outside of the cache, in another session. """
+        with UserCache.lock:
+            entry = UserCache.evicted.pop(username, None)
+            if entry is not None:
+                # The entry was evicted but not written back yet
+                UserCache.entries[username] = entry
+                UserCache.dirty.add(username)
+            else:
+                entry = UserCache.entries.get(username, None)
+                if entry is None:
+                    return None
+
+            model = entry.model if username in UserCache.dirty else None
+            entry.model = None
+
+            if not entry.pending:
+                UserCache.dirty.discard(username)
+
+            return model
+
+    def invalidate(usernames):
+        """ Forget the models of the given users, so they're loaded from the database next time.
+        Changes that have not been flushed are lost, so call flush first. """
+        with UserCache.lock:
+            for username in usernames:
+                entry = UserCache.entries.get(username, None)
+                if entry is not None:
+                    entry.model = None
+                    if entry.pending:
+                        # Pending values are applied on top of the fresh model
+                        continue
+                UserCache.evicted.pop(username, None)
+                UserCache.dirty.discard(username)
+
+    def evict(username):
+        entry = UserCache.entries.pop(username)
+        if username in UserCache.dirty:
+            UserCache.dirty.discard(username)
+            UserCache.evicted[username] = entry
+
+    def enforce_size():
+        # Pinned entries are moved to the back of the line, so give up after one pass
+        checked = 0
+        while len(UserCache.entries) > UserCache.max_size and checked < len(UserCache.entries):
+            username, entry = next(iter(UserCache.entries.items()))
+            if entry.pinned():
+                UserCache.entries.move_to_end(username)
+                checked += 1
+            else:
+                UserCache.evict(username)
+
+    def expire():
+        """ Evict entries that have not been used for `ttl` seconds """
+        expire_before = time.time() - UserCache.ttl
+        for username, entry in list(UserCache.entries.items()):
+            if entry.last_access >= expire_before:
+                # Entries are ordered by last access, so the rest are newer
+                break
+            if not entry.pinned():
+                UserCache.evict(username)
+
+    def flush():
+        """ Writes all dirty and evicted models to the database in one transaction.
+        Returns the number of users written """
+        with UserCache.lock:
+            UserCache.expire()
+
+            dirty = UserCache.dirty
+            evicted = UserCache.evicted
+            entries = [UserCache.entries[username] for username in dirty] + list(evicted.values())
+            models = [entry.model for entry in entries if entry.model is not None]
+            pending_entries = {entry.username: entry for entry in entries if entry.model is None and entry.pending}
+
+            UserCache.dirty = set()
+            UserCache.evicted = {}
+
+            if not models and not pending_entries:
+                return 0
+
+            loaded_models = {}
+            try:
+                with DBManager.create_session_scope(expire_on_commit=False) as db_session:
+                    for model in models:
+                        db_session.add(model)
+
+                    if pending_entries:
+                        # Load all users that only have pending values in a single query
+                        loaded_models = {user.username: user for user in db_session.query(User).filter(User.username.in_(pending_entries))}
+                        for username, entry in pending_entries.items():
+                            model = loaded_models.get(username, None)
+                            if model is None:
+                                model = User(username)
+                                db_session.add(model)
+                                loaded_models[username] = model
+                            UserCache.apply_pending(model, entry.pending)
+            except:
+                log.exception('Caught exception while flushing {} users to the database'.format(len(models) + len(pending_entries)))
+
+                # Try again on the next flush
+                UserCache.dirty |= set(username for username in dirty if username in UserCache.entries)
+                for username, entry in evicted.items():
+                    if username not in UserCache.entries:
+                        UserCache.evicted[username] = entry
+                return 0
+
+            for username, model in loaded_models.items():
+                entry = pending_entries[username]
+                entry.pending = {}
+                if entry.model is None:
+                    entry.model = model
+
+            return len(models) + len(pending_entries)
+
+
+class UserRedisBuffer:
+    """
+    Write-behind buffer for the UserRedis setters.
+
+    Writes are collapsed per user and key, and sent to redis in a single
+    pipeline when flush is called (once per tick from the bot).
+    The buffer is only used when enabled, i.e. in the bot process.
+    """
+
+    enabled = False
+
+    # Key = (redis key, username)
+    # Value = (redis command, argument)
+    pending = {}
+
+    def init():
+        UserRedisBuffer.enabled = True
+
+    def write(redis_key, username, command, argument=None):
+        UserRedisBuffer.pending[(redis_key, username)] = (command, argument)
+
+    def overlay(redis_key, username, value):
+        """ Returns value, as it will be in redis once the pending write for this key is flushed """
+        try:
+            command, argument = UserRedisBuffer.pending[(redis_key, username)]
+        except KeyError:
+            return value
+
+        if command in ('zrem', 'hdel'):
+            return None
+
+        return argument
+
+    def flush():
+        """ Returns how many writes were sent to redis """
+        if not UserRedisBuffer.pending:
+            return 0
+
+        pending = UserRedisBuffer.pending
+        UserRedisBuffer.pending = {}
+
+        with RedisManager.pipeline_context() as pipeline:
+            for (redis_key, username), (command, argument) in pending.items():
+                if command in ('zrem', 'hdel'):
+                    getattr(pipeline, command)(redis_key, username)
+                else:
+                    getattr(pipeline, command)(redis_key, username, argument)
+
+        return len(pending)
+
+
+class UserTagCache:
+    """
+    In-memory copy of the user tags in global:usertags, so reading the tags of a user
+    is a dict lookup instead of a redis round trip and a JSON decode.
+
+    Tags are kept per tag with their expiry timestamp, and expired tags are dropped when they're read.
+    Users whose tags changed are written back in one pipeline when flush is called (once per tick from the bot).
+    Users are loaded again after TTL seconds, in case another process changed their tags.
+    The cache is only used when enabled, i.e. in the bot process.
+    """
+
+    enabled = False
+    max_size = 10000
+    TTL = 10 * 60
+
+    # Key = username
+    # Value = [time the tags were loaded, dict of tag -> expiry timestamp], least recently used first
+    entries = OrderedDict()
+
+    # Usernames whose tags changed since the last flush
+    dirty = set()
+
+    def init(max_size=10000):
+        UserTagCache.enabled = True
+        UserTagCache.max_size = max_size
+
+    def decode(value):
+        if not value:
+            return {}
+
+        try:
+            return json.loads(value)
+        except ValueError:
+            log.warning('Invalid user tags: {}'.format(value))
+            return {}
+
+    def load(usernames, redis=None):
+        """ Load the tags of the given users that are not cached yet, with a single hmget.
+        Returns a dict of username -> dict of tag -> expiry timestamp of the tags that have not expired, for every given user.
+        Users with changes that have not been flushed are not loaded again, their cached tags are the whole state. """
+        now = time.time()
+
+        # Key = username
+        # Value = dict of tag -> expiry timestamp
+        tags_per_user = {}
+
+        missing = []
+        for username in usernames:
+            entry = UserTagCache.entries.get(username, None)
+            if entry is not None and (username in UserTagCache.dirty or entry[0] + UserTagCache.TTL >= now):
+                tags_per_user[username] = entry[1]
+            else:
+                missing.append(username)
+
+        if missing:
+            if redis is None:
+                redis = RedisManager.get()
+
+            for username, value in zip(missing, redis.hmget('global:usertags', missing)):
+                tags = UserTagCache.decode(value)
+                UserTagCache.entries[username] = [now, tags]
+                UserTagCache.entries.move_to_end(username)
+                tags_per_user[username] = tags
+
+            UserTagCache.enforce_size()
+
+        return {username: {tag: expiry for tag, expiry in tags.items() if expiry > now} for username, tags in tags_per_user.items()}
+
+    def get(username, now=None):
+        """ Returns a dict of tag -> expiry timestamp of the tags of the user that have not expired """
+        if now is None:
+            now = time.time()
+
+        UserTagCache.load([username])
+        entry = UserTagCache.entries[username]
+        UserTagCache.entries.move_to_end(username)
+
+        tags = entry[1]
+        expired = [tag for tag, expiry in tags.items() if expiry <= now]
+        for tag in expired:
+            del tags[tag]
+
+        return dict(tags)
+
+    def set(username, tags):
+        """ Replace all tags of the user """
+        UserTagCache.entries[username] = [time.time(), dict(tags)]
+        UserTagCache.entries.move_to_end(username)
+        UserTagCache.dirty.add(username)
+        UserTagCache.enforce_size()
+
+    def add(username, tag, expiry):
+        UserTagCache.load([username])
+        UserTagCache.entries[username][1][tag] = expiry
+        UserTagCache.dirty.add(username)
+
+    def enforce_size():
+        if len(UserTagCache.entries) <= UserTagCache.max_size:
+            return
+
+        # Users with changes are kept until they're flushed, they're moved to the back instead
+        for _ in range(len(UserTagCache.entries)):
+            if len(UserTagCache.entries) <= UserTagCache.max_size:
+                break
+
+            username, entry = UserTagCache.entries.popitem(last=False)
+            if username in UserTagCache.dirty:
+                UserTagCache.entries[username] = entry
+
+    def flush():
+        """ Returns how many users were written to redis """
+        if not UserTagCache.dirty:
+            return 0
+
+        dirty = UserTagCache.dirty
+        UserTagCache.dirty = set()
+
+        now = time.time()
+        with RedisManager.pipeline_context() as pipeline:
+            for username in dirty:
+                entry = UserTagCache.entries.get(username, None)
+                if entry is None:
+                    continue
+
+                tags = {tag: expiry for tag, expiry in entry[1].items() if expiry > now}
+                if tags:
+                    pipeline.hset('global:usertags', username, json.dumps(tags, separators=(',', ':')))
+                else:
+                    pipeline.hdel('global:usertags', username)
+
+        return len(dirty)
+
+
 class NoCacheHit(Exception):
     pass
 
 
 class UserSQLCache:
-    cache = {}
+    """
+    Column values of the users that were saved in this process, for processes where the UserCache is disabled.
+    Reading them, or setting the subscriber flag to what it already is, does not load the user then.
+    Values are forgotten after ttl seconds, and all of them once there are max_size users.
+    """
 
-    def init():
-        ScheduleManager.execute_every(30 * 60, UserSQLCache._clear_cache)
+    max_size = 10000
+    ttl = 30 * 60
+
+    KEYS = ('id', 'level', 'subscriber')
 
-    def _clear_cache():
-        UserSQLCache.cache = {}
+    # Key = username
+    # Value = (time the values were saved, dict of column name -> value)
+    cache = {}
 
     def save(user):
-        UserSQLCache.cache[user.username] = {
-                'id': user.id,
-                'level': user.level,
-                'subscriber': user.subscriber,
-                }
+        if len(UserSQLCache.cache) >= UserSQLCache.max_size:
+            UserSQLCache.cache = {}
 
-    def get(username, value):
-        if username not in UserSQLCache.cache:
+        UserSQLCache.cache[user.username] = (time.time(), {key: getattr(user, key) for key in UserSQLCache.KEYS})
+
+    def get(username, key):
+        try:
+            saved_at, values = UserSQLCache.cache[username]
+        except KeyError:
             raise NoCacheHit('User not in cache')
 
-        if value not in UserSQLCache.cache[username]:
+        if saved_at + UserSQLCache.ttl < time.time():
+            del UserSQLCache.cache[username]
+            raise NoCacheHit('User expired from cache')
+
+        if key not in values:
             raise NoCacheHit('Value not in cache')
 
-        # log.debug('Returning {}:{} from cache'.format(username, value))
-        return UserSQLCache.cache[username][value]
+        return values[key]
 
 
 class UserSQL:
@@ -105,6 +570,9 @@ class UserSQL:
         self.model_loaded = user_model is not None
         self.shared_db_session = db_session
 
+        # Column values that were set before the model was loaded
+        self.pending_values = {}
+
     def select_or_create(db_session, username):
         user = db_session.query(User).filter_by(username=username).one_or_none()
         if user is None:
@@ -124,35 +592,101 @@ class UserSQL:
         # print_traceback()
 
         if self.shared_db_session:
-            user = UserSQL.select_or_create(self.shared_db_session, self.username)
+            user = None
+            if UserCache.enabled:
+                # The user is modified in the shared session from here on.
+                # Any unsaved changes from the cache are saved along with it.
+                user = UserCache.pop_model(self.username)
+                if user is not None:
+                    self.shared_db_session.add(user)
+
+            if user is None:
+                user = UserSQL.select_or_create(self.shared_db_session, self.username)
         else:
-            with DBManager.create_session_scope(expire_on_commit=False) as db_session:
-                user = UserSQL.select_or_create(db_session, self.username)
-                db_session.expunge(user)
+            user = UserCache.get_model(self.username) if UserCache.enabled else None
+            if user is None:
+                with DBManager.create_session_scope(expire_on_commit=False) as db_session:
+                    user = UserSQL.select_or_create(db_session, self.username)
+                    db_session.expunge(user)
+
+                if UserCache.enabled:
+                    UserCache.set_model(user)
 
         self.user_model = user
 
-    def sql_save(self, save_to_db=True):
+        if self.pending_values:
+            UserCache.apply_pending(user, self.pending_values)
+            self.pending_values = {}
+
+    def sql_get(self, key):
+        """ Get a column value, from the UserSQLCache if the model is not loaded and the UserCache is disabled """
+        if not self.model_loaded and not UserCache.enabled:
+            try:
+                return UserSQLCache.get(self.username, key)
+            except NoCacheHit:
+                pass
+
+        self.sql_load()
+        return getattr(self.user_model, key)
+
+    def sql_set(self, key, value):
+        """ Set a column value, without loading the model if it's not cached yet """
+        if not self.model_loaded and UserCache.enabled and not self.shared_db_session:
+            if UserCache.get_model(self.username) is None:
+                self.pending_values[key] = value
+                return
+
+        if not self.model_loaded and not UserCache.enabled:
+            try:
+                if UserSQLCache.get(self.username, key) == value:
+                    return
+            except NoCacheHit:
+                pass
+
+        self.sql_load()
+        if getattr(self.user_model, key) != value:
+            setattr(self.user_model, key, value)
+
+    def sql_dirty(self):
+        """ Returns True if there is anything that needs to be saved """
         if not self.model_loaded:
+            return len(self.pending_values) > 0
+
+        state = sqlalchemy.inspect(self.user_model)
+        return state.key is None or state.modified
+
+    def sql_save(self, save_to_db=True):
+        if not self.sql_dirty():
+            if self.model_loaded and not UserCache.enabled:
+                UserSQLCache.save(self.user_model)
             return
 
         try:
-            if save_to_db and not self.shared_db_session:
-                with DBManager.create_session_scope(expire_on_commit=False) as db_session:
-                    # log.debug('Calling db_session.add on {}'.format(self.user_model))
-                    db_session.add(self.user_model)
+            if not self.model_loaded:
+                if UserCache.enabled and not self.shared_db_session:
+                    # Written to the database on the next UserCache.flush, without loading the model now
+                    UserCache.set_pending(self.username, self.pending_values)
+                    self.pending_values = {}
+                    return
+
+                self.sql_load()
 
-            UserSQLCache.save(self.user_model)
+            if save_to_db and not self.shared_db_session:
+                if UserCache.enabled:
+                    # Written to the database on the next UserCache.flush
+                    UserCache.mark_dirty(self.user_model)
+                else:
+                    with DBManager.create_session_scope(expire_on_commit=False) as db_session:
+                        # log.debug('Calling db_session.add on {}'.format(self.user_model))
+                        db_session.add(self.user_model)
+
+                    UserSQLCache.save(self.user_model)
         except:
             log.exception('Caught exception in sql_save while saving {}'.format(self.user_model))
 
     @property
     def id(self):
-        try:
-            return UserSQLCache.get(self.username, 'id')
-        except NoCacheHit:
-            self.sql_load()
-            return self.user_model.id
+        return self.sql_get('id')
 
     @id.setter
     def id(self, value):
@@ -161,11 +695,7 @@ class UserSQL:
 
     @property
     def level(self):
-        try:
-            return UserSQLCache.get(self.username, 'level')
-        except NoCacheHit:
-            self.sql_load()
-            return self.user_model.level
+        return self.sql_get('level')
 
     @level.setter
     def level(self, value):
@@ -174,11 +704,8 @@ class UserSQL:
 
     @property
     def minutes_in_chat_online(self):
-        try:
-            return UserSQLCache.get(self.username, 'minutes_in_chat_online')
-        except NoCacheHit:
-            self.sql_load()
-            return self.user_model.minutes_in_chat_online
+        self.sql_load()
+        return self.user_model.minutes_in_chat_online
 
     @minutes_in_chat_online.setter
     def minutes_in_chat_online(self, value):
@@ -187,11 +714,8 @@ class UserSQL:
 
     @property
     def minutes_in_chat_offline(self):
-        try:
-            return UserSQLCache.get(self.username, 'minutes_in_chat_offline')
-        except NoCacheHit:
-            self.sql_load()
-            return self.user_model.minutes_in_chat_offline
+        self.sql_load()
+        return self.user_model.minutes_in_chat_offline
 
     @minutes_in_chat_offline.setter
     def minutes_in_chat_offline(self, value):
@@ -200,23 +724,11 @@ class UserSQL:
 
     @property
     def subscriber(self):
-        try:
-            return UserSQLCache.get(self.username, 'subscriber')
-        except NoCacheHit:
-            self.sql_load()
-            return self.user_model.subscriber
+        return self.sql_get('subscriber')
 
     @subscriber.setter
     def subscriber(self, value):
-        try:
-            old_value = UserSQLCache.get(self.username, 'subscriber')
-            if old_value == value:
-                return
-        except NoCacheHit:
-            pass
-
-        self.sql_load()
-        self.user_model.subscriber = value
+        self.sql_set('subscriber', value)
 
     @property
     def points(self):
@@ -297,9 +809,13 @@ class UserRedis:
 
     def load_redis_data(self, data):
         self.redis_loaded = True
+        streamer = StreamHelper.get_streamer()
         full_keys = list(UserRedis.FULL_KEYS)
         for value in data:
             key = full_keys.pop(0)
+            if UserRedisBuffer.pending:
+                # Writes that have not been flushed yet are newer than what's in redis
+                value = UserRedisBuffer.overlay('{streamer}:users:{key}'.format(streamer=streamer, key=key), self.username, value)
             if key in UserRedis.SS_KEYS:
                 self.values[key] = self.fix_ss(key, value)
             elif key in UserRedis.HASH_KEYS:
@@ -318,6 +834,16 @@ class UserRedis:
             data = pipeline.execute()
             self.load_redis_data(data)
 
+    def redis_write(self, key, command, argument=None):
+        """ Write a value to redis, through the UserRedisBuffer if it's enabled """
+        redis_key = '{streamer}:users:{key}'.format(streamer=StreamHelper.get_streamer(), key=key)
+        if UserRedisBuffer.enabled:
+            UserRedisBuffer.write(redis_key, self.username, command, argument)
+        elif command in ('zrem', 'hdel'):
+            getattr(self.redis, command)(redis_key, self.username)
+        else:
+            getattr(self.redis, command)(redis_key, self.username, argument)
+
     def fix_ss(self, key, value):
         try:
             val = int(value)
@@ -356,9 +882,9 @@ class UserRedis:
         if self.save_to_redis:
             # Set redis value
             if value != 0:
-                self.redis.zadd('{streamer}:users:num_lines'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+                self.redis_write('num_lines', 'zadd', value)
             else:
-                self.redis.zrem('{streamer}:users:num_lines'.format(streamer=StreamHelper.get_streamer()), self.username)
+                self.redis_write('num_lines', 'zrem')
 
     @property
     def tokens(self):
@@ -376,9 +902,9 @@ class UserRedis:
         if self.save_to_redis:
             # Set redis value
             if value != 0:
-                self.redis.zadd('{streamer}:users:tokens'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+                self.redis_write('tokens', 'zadd', value)
             else:
-                self.redis.zrem('{streamer}:users:tokens'.format(streamer=StreamHelper.get_streamer()), self.username)
+                self.redis_write('tokens', 'zrem')
 
     @property
     def num_lines_rank(self):
@@ -404,7 +930,7 @@ class UserRedis:
         self.values['last_seen'] = value
 
         # Set redis value
-        self.redis.hset('{streamer}:users:last_seen'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+        self.redis_write('last_seen', 'hset', value)
 
     def set_last_seen(self, value):
         # Set cached value
@@ -412,13 +938,13 @@ class UserRedis:
         self.values['last_seen'] = value
 
         # Set redis value
-        self.redis.hset('{streamer}:users:last_seen'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+        self.redis_write('last_seen', 'hset', value)
 
     def _set_last_seen(self, value):
         # Set cached value
         self.values['last_seen'] = value
 
-        self.redis.hset('{streamer}:users:last_seen'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+        self.redis_write('last_seen', 'hset', value)
 
     @property
     def _last_active(self):
@@ -435,7 +961,7 @@ class UserRedis:
         self.values['last_active'] = value
 
         # Set redis value
-        self.redis.hset('{streamer}:users:last_active'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+        self.redis_write('last_active', 'hset', value)
 
     @property
     def username_raw(self):
@@ -449,9 +975,9 @@ class UserRedis:
 
         # Set redis value
         if value != self.username:
-            self.redis.hset('{streamer}:users:username_raw'.format(streamer=StreamHelper.get_streamer()), self.username, value)
+            self.redis_write('username_raw', 'hset', value)
         else:
-            self.redis.hdel('{streamer}:users:username_raw'.format(streamer=StreamHelper.get_streamer()), self.username)
+            self.redis_write('username_raw', 'hdel')
 
     @property
     def ignored(self):
@@ -465,9 +991,9 @@ class UserRedis:
 
         if value is True:
             # Set redis value
-            self.redis.hset('{streamer}:users:ignored'.format(streamer=StreamHelper.get_streamer()), self.username, 1)
+            self.redis_write('ignored', 'hset', 1)
         else:
-            self.redis.hdel('{streamer}:users:ignored'.format(streamer=StreamHelper.get_streamer()), self.username)
+            self.redis_write('ignored', 'hdel')
 
     @property
     def banned(self):
@@ -481,9 +1007,9 @@ class UserRedis:
 
         if value is True:
             # Set redis value
-            self.redis.hset('{streamer}:users:banned'.format(streamer=StreamHelper.get_streamer()), self.username, 1)
+            self.redis_write('banned', 'hset', 1)
         else:
-            self.redis.hdel('{streamer}:users:banned'.format(streamer=StreamHelper.get_streamer()), self.username)
+            self.redis_write('banned', 'hdel')
 
 
 class UserCombined(UserRedis, UserSQL):
@@ -534,6 +1060,9 @@ class UserCombined(UserRedis, UserSQL):
                 }
 
     def get_tags(self, redis=None):
+        if UserTagCache.enabled:
+            return UserTagCache.get(self.username)
+
         if redis is None:
             redis = RedisManager.get()
         val = redis.hget('global:usertags', self.username)
@@ -562,6 +1091,9 @@ class UserCombined(UserRedis, UserSQL):
         self._last_active = value
 
     def set_tags(self, value, redis=None):
+        if UserTagCache.enabled:
+            return UserTagCache.set(self.username, value)
+
         if redis is None:
             redis = RedisManager.get()
         return redis.hset('global:usertags', self.username, json.dumps(value, separators=(',', ':')))
@@ -62,7 +62,9 @@ class AsciiProtectionModule(BaseModule):
             return True
         return False
 
-    def on_pubmsg(self, source, message):
+    def on_pubmsg(self, message_context):
+        source = message_context.source
+        message = message_context.message
         if len(message) > self.settings['min_msg_length'] and source.level < self.settings['bypass_level'] and source.moderator is False:
             if AsciiProtectionModule.check_message(message) is not False:
                 duration, punishment = self.bot.timeout_warn(source, self.settings['timeout_length'], reason='Too many ASCII characters')
@@ -73,7 +75,7 @@ class AsciiProtectionModule(BaseModule):
                 return False
 
     def enable(self, bot):
-        HandlerManager.add_handler('on_pubmsg', self.on_pubmsg)
+        HandlerManager.add_handler('on_pubmsg', self.on_pubmsg, context=True)
         self.bot = bot
 
     def disable(self, bot):
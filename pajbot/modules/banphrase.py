@@ -18,17 +18,25 @@ class BanphraseModule(BaseModule):
     CATEGORY = 'Filter'
     SETTINGS = []
 
-    def is_message_bad(self, source, msg_raw, event):
-        msg_lower = msg_raw.lower()
+    def is_message_bad(self, message_context):
+        source = message_context.source
+        msg_raw = message_context.message
+        msg_lower = message_context.lower
+        event = message_context.event
 
-        res = self.bot.banphrase_manager.check_message(msg_raw, source)
+        res = self.bot.banphrase_manager.check_message(msg_raw, source, message_context=message_context)
         if res is not False:
             self.bot.banphrase_manager.punish(source, res)
             return True
 
-        for f in self.bot.filters:
+        for f in list(self.bot.filters):
             if f.type == 'regex':
-                m = f.search(source, msg_lower)
+                try:
+                    m = f.search(source, msg_lower)
+                except TimeoutError:
+                    self.bot.filters.on_regex_timeout(f)
+                    continue
+
                 if m:
                     log.debug('Matched regex filter \'{0}\''.format(f.name))
                     f.run(self.bot, source, msg_raw, event, {'match': m})
@@ -43,18 +51,19 @@ class BanphraseModule(BaseModule):
 
     def enable(self, bot):
         self.bot = bot
-        HandlerManager.add_handler('on_message', self.on_message, priority=150)
+        HandlerManager.add_handler('on_message', self.on_message, priority=150, context=True)
 
     def disable(self, bot):
         HandlerManager.remove_handler('on_message', self.on_message)
 
-    def on_message(self, source, message, emotes, whisper, urls, event):
-        if whisper:
+    def on_message(self, message_context):
+        if message_context.whisper:
             return
+        source = message_context.source
         if source.level >= 500 or source.moderator:
             return
 
-        if self.is_message_bad(source, message, event):
+        if self.is_message_bad(message_context):
             # we matched a filter.
             # return False so no more code is run for this message
             return False
@@ -94,6 +103,7 @@ class BanphraseModule(BaseModule):
             log.info(banphrase)
             DBManager.session_add_expunge(banphrase)
             bot.banphrase_manager.commit()
+            bot.banphrase_manager.rebuild_matcher()
             bot.whisper(source.username, 'Updated your banphrase (ID: {banphrase.id}) with ({what})'.format(banphrase=banphrase, what=', '.join([key for key in options if key != 'added_by'])))
             AdminLogManager.post('Banphrase edited', source, phrase)
 
@@ -3,6 +3,7 @@ import datetime
 import logging
 
 import pajbot.models
+from pajbot.managers.handler import HandlerManager
 from pajbot.modules import BaseModule
 from pajbot.modules import ModuleType
 from pajbot.modules.basic import BasicCommandsModule
@@ -125,6 +126,79 @@ class DebugModule(BaseModule):
             bot.whisper(source.username, 'Usage: !debug user USERNAME')
             return False
 
+    def debug_handlers(self, **options):
+        message = options['message']
+        bot = options['bot']
+        source = options['source']
+
+        argument = message.split(' ')[0].strip().lower() if message else None
+
+        if argument == 'on':
+            HandlerManager.enable_profiling(slow_threshold=bot.slow_handler_threshold)
+            bot.whisper(source.username, 'Handler profiling enabled')
+            return
+        elif argument == 'off':
+            HandlerManager.disable_profiling()
+            bot.whisper(source.username, 'Handler profiling disabled')
+            return
+
+        if HandlerManager.profiler is None:
+            bot.whisper(source.username, 'Handler profiling is disabled. Enable it with !debug handlers on')
+            return False
+
+        handlers = HandlerManager.profiler.summary(event=argument)[:5]
+        if len(handlers) == 0:
+            bot.whisper(source.username, 'No handlers have been called in the last {} minutes'.format(
+                HandlerManager.profiler.WINDOW_LENGTH * HandlerManager.profiler.NUM_WINDOWS // 60))
+            return
+
+        # Whispers are cut off at 500 characters, so only the handlers that fit are listed
+        response = ''
+        for handler in handlers:
+            line = '{handler} ({event}): {calls} calls, {total_ms:.0f}ms total, p50 {p50_ms:g}ms, p99 {p99_ms:g}ms, max {max_ms:.1f}ms'.format(**handler)
+            if response and len(response) + len(line) + 2 > 500:
+                break
+            response = line if not response else response + ', ' + line
+
+        bot.whisper(source.username, response[:500])
+
+    def debug_queue(self, **options):
+        message = options['message']
+        bot = options['bot']
+        source = options['source']
+
+        if message and message.split(' ')[0].strip().lower() == 'whispers':
+            stats = bot.irc.whisper_queue_stats()
+            if stats is None:
+                bot.whisper(source.username, 'This connection does not use a whisper queue')
+                return False
+
+            bot.whisper(source.username, '{depth} whispers queued for {recipients} users, oldest {oldest_wait_s:.1f}s, '
+                    '{available} whispers available, {sent} sent, {merged} merged, {dropped} dropped, '
+                    'wait p50 {wait_p50_s:.1f}s, p99 {wait_p99_s:.1f}s, max {wait_max_s:.1f}s'.format(**stats))
+            return
+
+        stats = bot.irc.queue_stats()
+        if stats is None:
+            bot.whisper(source.username, 'This connection does not use an outbound queue')
+            return False
+
+        bot.whisper(source.username, '{depth} queued ({moderation} moderation, {chat} chat, {whisper} whispers), oldest {oldest_wait_s:.1f}s, '
+                '{available}/{limit} messages available, {sent} sent, {coalesced} duplicates dropped, '
+                'wait p50 {wait_p50_s:.1f}s, p99 {wait_p99_s:.1f}s, max {wait_max_s:.1f}s, {send_connections} send connections'.format(**dict(stats, **stats['depth_per_priority'])))
+
+    def debug_links(self, **options):
+        bot = options['bot']
+        source = options['source']
+
+        module = bot.module_manager['linkchecker']
+        if module is None:
+            bot.whisper(source.username, 'The link checker is not enabled')
+            return False
+
+        bot.whisper(source.username, '{depth} links queued, oldest {oldest_age_s:.1f}s, {in_flight} being checked by {workers} workers, '
+                '{checked} checked, {coalesced} duplicates, {failed_open} let through and {failed_closed} timed out without a check'.format(**module.check_queue.stats()))
+
     def load_commands(self, **options):
         self.commands['debug'] = pajbot.models.command.Command.multiaction_command(
                 level=100,
@@ -160,5 +234,40 @@ class DebugModule(BaseModule):
                                 chat='user:!debug tags pajbot\n'
                                 'bot>user: pajbot have the following tags: pajlada_sub until 2016-04-28',
                                 description='').parse(),
-                            ])
+                            ]),
+                    'handlers': pajbot.models.command.Command.raw_command(self.debug_handlers,
+                        level=500,
+                        description='Show the slowest handlers of the last few minutes, or turn handler profiling on/off',
+                        examples=[
+                            pajbot.models.command.CommandExample(None, 'Show the slowest handlers',
+                                chat='user:!debug handlers on_message\n'
+                                'bot>user: LinkCheckerModule.on_message (on_message): 1402 calls, 812ms total, p50 0.25ms, p99 10ms, max 31.2ms',
+                                description='').parse(),
+                            pajbot.models.command.CommandExample(None, 'Turn handler profiling on',
+                                chat='user:!debug handlers on\n'
+                                'bot>user: Handler profiling enabled',
+                                description='').parse(),
+                            ]),
+                    'queue': pajbot.models.command.Command.raw_command(self.debug_queue,
+                        level=500,
+                        description='Show how many messages (or whispers) are waiting to be sent, and how long they waited',
+                        examples=[
+                            pajbot.models.command.CommandExample(None, 'Show the outbound queue',
+                                chat='user:!debug queue\n'
+                                'bot>user: 12 queued (0 moderation, 12 chat, 0 whispers), oldest 4.2s, 0/90 messages available, 1520 sent, 3 duplicates dropped, wait p50 0.0s, p99 6.1s, max 8.3s, 0 send connections',
+                                description='').parse(),
+                            pajbot.models.command.CommandExample(None, 'Show the whisper queue',
+                                chat='user:!debug queue whispers\n'
+                                'bot>user: 130 whispers queued for 122 users, oldest 31.0s, 0 whispers available, 406 sent, 18 merged, 0 dropped, wait p50 0.0s, p99 29.8s, max 31.0s',
+                                description='').parse(),
+                            ]),
+                    'links': pajbot.models.command.Command.raw_command(self.debug_links,
+                        level=500,
+                        description='Show how many links are waiting to be checked by the link checker',
+                        examples=[
+                            pajbot.models.command.CommandExample(None, 'Show the link check queue',
+                                chat='user:!debug links\n'
+                                'bot>user: 3 links queued, oldest 1.2s, 4 being checked by 4 workers, 310 checked, 52 duplicates, 0 let through and 0 timed out without a check',
+                                description='').parse(),
+                            ]),
                     })
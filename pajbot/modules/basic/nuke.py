@@ -1,8 +1,6 @@
 import logging
-import re
-import requests
-import datetime
-import sys
+
+import regex as re
 
 import pajbot.models
 from pajbot.managers.adminlog import AdminLogManager
@@ -24,6 +22,15 @@ class NukeModule(BaseModule):
     CATEGORY = 'Feature'
     PARENT_MODULE = BasicCommandsModule
 
+    # Max amount of seconds a nuke regex is allowed to run over the recent chat
+    REGEX_TIMEOUT = 1
+
+    def __init__(self):
+        super().__init__()
+
+        # Nukes that are still timing out users
+        self.jobs = []
+
     def nuke_command(self, **options):
         message = options['message']
         bot = options['bot']
@@ -32,75 +39,102 @@ class NukeModule(BaseModule):
         self.actually_nuke(message, bot, source)
 
     def actually_nuke(self, message, bot, source):
+        if message in ('stop', 'status'):
+            if not self.jobs:
+                bot.whisper(source.username, 'There is no nuke in progress.')
+                return
+
+            for job in list(self.jobs):
+                if message == 'stop':
+                    bot.moderation.cancel(job)
+                else:
+                    bot.whisper(source.username, 'Nuke in progress: {}'.format(job.progress()))
+            return
+
         if message and len(message) > 0:
             message_split = []
 
             try:
-                if message.startswith('\''):
+                if message.startswith("'"):
                     filteredMessage = re.search(r'\'(.+?(?<!\\))\'(.*)', message)
                     message_split.append(filteredMessage.group(1))
                     message_split.extend(filteredMessage.group(2).strip().split(' '))
                 else:
                     message_split = message.split(' ')
-            except IndexError as e:
+            except (AttributeError, IndexError) as e:
                 bot.whisper(source.username, 'Error with syntax: {}.'.format(e))
+                return
 
-            if len(message_split) >= 1:
-                phrase = message_split[0]
-                if not message_split[1].isdigit():
-                    bot.whisper(source.username, 'Duration must be numbers in seconds only.')
+            seconds = None
+            if '--last' in message_split:
+                index = message_split.index('--last')
+                try:
+                    seconds = self.parse_lookback(message_split[index + 1])
+                except (IndexError, ValueError):
+                    bot.whisper(source.username, 'Usage: --last 120s (or 5m, 1h)')
                     return
-                duration = int(message_split[1])
-
-                if len(message_split) == 3:
-                    if message_split[2].isdigit():
-                        messages = int(message_split[2])
-                else:
-                    messages = 200
+                del message_split[index:index + 2]
 
-            today = datetime.date.today()
-            url = 'https://overrustlelogs.net/Admiralbulldog' \
-                  ' chatlog/{:%B %Y}/{:%Y-%m-%d}.txt'.format(today, today)
-            log.debug(url)
-
-            r = requests.get(url)
-            if r.status_code != 200:
-                log.warning('Error with getting log')
-                bot.whisper(source.username, 'Error with getting channel log. Contact DatGuy1 for help.')
+            if len(message_split) < 2 or not message_split[1].isdigit():
+                bot.whisper(source.username, 'Duration must be numbers in seconds only.')
                 return
 
-            non_bmp_map = dict.fromkeys(range(0x10000, sys.maxunicode + 1), 0xfffd)
-            splitText = r.text.translate(non_bmp_map).splitlines()[-messages:][:-1]
+            phrase = message_split[0]
+            duration = int(message_split[1])
 
-            badUsers = []
+            messages = None
+            if len(message_split) >= 3 and message_split[2].isdigit():
+                messages = int(message_split[2])
+            elif seconds is None:
+                messages = 200
 
-            for fullMessage in splitText:
-                messageContent = re.findall(r'[^: ]*: (.*)', fullMessage)[0]
+            try:
                 if phrase.startswith('r/'):
-                    try:
-                        if re.search(phrase[2:], messageContent):
-                            badUsers.append(re.findall(r'[^\]]*] ([^:]*)', fullMessage)[0])
-                    except:
-                        bot.whisper(source.username, 'Invalid regex')
-                        return False
+                    badUsers = bot.recent_chat.find_users(regex=phrase[2:], seconds=seconds, count=messages, timeout=self.REGEX_TIMEOUT)
                 else:
-                    if phrase in messageContent:
-                        badUsers.append(re.findall(r'[^\]]*] ([^:]*)', fullMessage)[0])
-
-            badUsers = list(set(badUsers))
+                    badUsers = bot.recent_chat.find_users(phrase=phrase, seconds=seconds, count=messages)
+            except re.error:
+                bot.whisper(source.username, 'Invalid regex')
+                return False
+            except TimeoutError:
+                bot.whisper(source.username, 'The regex took longer than {} seconds to run through the chat, nobody was nuked'.format(self.REGEX_TIMEOUT))
+                return False
+
+            # The nuke command itself is in the recent chat too
+            if source.username in badUsers:
+                badUsers.remove(source.username)
 
             reason = '{} nuked {} users for the phrase "{}" for {}'.format(source.username, len(badUsers),
                                                                            phrase, self.format_time(duration))
-            i = 1
-            for timeoutUser in badUsers:
-                bot.execute_delayed(0.25 * i, bot._timeout, (timeoutUser, duration, reason))
-                i += 1
+
+            def nuke_finished(job):
+                if job in self.jobs:
+                    self.jobs.remove(job)
+                bot.whisper(source.username, 'Nuke {}: {}'.format('stopped' if job.cancelled else 'done', job.progress()))
+
+            job = bot.moderate_bulk(badUsers, 'timeout', duration=duration, reason=reason, on_finished=nuke_finished)
+            if not job.finished:
+                self.jobs.append(job)
 
             AdminLogManager.add_entry('Users nuked', source, reason.replace(source.username, '').strip().capitalize())
 
         else:
             bot.whisper(source.username, 'You did not include enough arguments. Contact DatGuy1 for help.')
 
+    def parse_lookback(self, value):
+        """ 120s, 5m, 1h or 120 (seconds) to a number of seconds """
+        multipliers = {
+                's': 1,
+                'm': 60,
+                'h': 3600,
+                }
+
+        value = value.lower()
+        if value[-1:] in multipliers:
+            return int(value[:-1]) * multipliers[value[-1]]
+
+        return int(value)
+
     def format_time(self, totalSeconds):
         res = ''
 
@@ -169,20 +203,30 @@ class NukeModule(BaseModule):
             description='Nuke a specific string',
             examples=[
                 pajbot.models.command.CommandExample(None,
-                    'Nuke the last 30 messages that have \'TriHard\' in them for 1 minute',
-                    chat='user:!nuke TriHard 60 30\n'
+                    "Nuke the last 30 messages that have 'TriHard' in them for 1 minute",
+                    chat='user:!oldnuke TriHard 60 30\n'
                     'bot:DatGuy1 nuked 3 users for the phrase "TriHard" in the last 30 messages for 1 minutes',
-                    description='Nuke the last 30 messages that have \'TriHard\' in them for 1 minute').parse(),
+                    description="Nuke the last 30 messages that have 'TriHard' in them for 1 minute").parse(),
                 pajbot.models.command.CommandExample(None,
-                    'Nuke the last 100 messages that have \'I like boats\' in them for 3 minutes',
-                    chat='user:!nuke \'I like boats\' 180 100\n'
+                    "Nuke the last 100 messages that have 'I like boats' in them for 3 minutes",
+                    chat="user:!oldnuke 'I like boats' 180 100\n"
                     'bot:DatGuy1 nuked 5 users for the phrase "I like boats" in the last 100 messages for 3 minutes',
-                    description='Nuke the last 100 messages that have \'I like boats\' in them for 3 minutes').parse(),
+                    description="Nuke the last 100 messages that have 'I like boats' in them for 3 minutes").parse(),
                 pajbot.models.command.CommandExample(None,
-                    'Nuke the last 100 messages that match the \'\bnam\' regex for 1 hour',
-                    chat='user:!nuke r/\bnam 3600 100\n'
+                    "Nuke the last 100 messages that match the '\bnam' regex for 1 hour",
+                    chat='user:!oldnuke r/\bnam 3600 100\n'
                     'bot:DatGuy1 nuked 5 users for the phrase "\bnam" in the last 100 messages for 1 hours',
-                    description='Nuke the last 100 messages that match the \'\bnam\' regex for 1 hour').parse()
+                    description="Nuke the last 100 messages that match the '\bnam' regex for 1 hour").parse(),
+                pajbot.models.command.CommandExample(None,
+                    "Nuke everyone who said 'TriHard' in the last 2 minutes for 10 minutes",
+                    chat='user:!oldnuke TriHard 600 --last 120s\n'
+                    'bot>user:Nuke done: 12/12 users timed out in 0s',
+                    description='The time window can be given in seconds (s), minutes (m) or hours (h)').parse(),
+                pajbot.models.command.CommandExample(None,
+                    'Stop the nuke that is in progress',
+                    chat='user:!oldnuke stop\n'
+                    'bot>user:Nuke stopped: 310/2000 users timed out in 4s',
+                    description='Users that have not been timed out yet are not timed out').parse(),
                 ])
         self.commands['tcpurge'] = pajbot.models.command.Command.raw_command(self.monkeypurge,
                 level = 500,
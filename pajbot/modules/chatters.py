@@ -5,6 +5,7 @@ from pajbot.managers.db import DBManager
 from pajbot.managers.redis import RedisManager
 from pajbot.managers.user import UserManager
 from pajbot.models.user import User
+from pajbot.models.user import UserTagCache
 from pajbot.modules import BaseModule
 from pajbot.utils import time_method
 
@@ -40,6 +41,9 @@ class ChattersModule(BaseModule):
 
         self.bot.stream_manager.update_chatters(chatters, self.update_chatters_interval)
 
+        # Write any cached changes first, the cached models are invalidated after the bulk update
+        UserManager.get().flush(force=True)
+
         with RedisManager.pipeline_context() as pipeline:
             with DBManager.create_session_scope() as db_session:
                 user_models = UserManager.get().bulk_load_user_models(chatters, db_session)
@@ -55,6 +59,13 @@ class ChattersModule(BaseModule):
                 else:
                     more_update_data['minutes_in_chat_offline'] = self.update_chatters_interval
 
+                # Key = username
+                # Value = dict of tag -> expiry timestamp
+                chatter_tags = {}
+                if self.bot.streamer == 'forsenlol':
+                    # Load the tags of every chatter with a single hmget
+                    chatter_tags = UserTagCache.load(chatters)
+
                 points_to_give_out = {}
                 dt_now = datetime.datetime.now().timestamp()
                 for user in users:
@@ -63,8 +74,7 @@ class ChattersModule(BaseModule):
                     num_points = points
                     if user.subscriber:
                         num_points *= 5
-                    # TODO: Load user tags during the pipeline redis data fetch
-                    if self.bot.streamer == 'forsenlol' and 'trumpsc_sub' in user.get_tags():
+                    if 'trumpsc_sub' in chatter_tags.get(user.username, {}):
                         num_points *= 0.5
 
                     num_points = int(num_points)
@@ -89,6 +99,8 @@ class ChattersModule(BaseModule):
 
                 pipeline.execute()
 
+        UserManager.get().invalidate(chatters)
+
     """ NON-BATCHED VERSION
     @time_method
     def update_chatters_stage2(self, chatters):
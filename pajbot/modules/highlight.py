@@ -30,9 +30,14 @@ class HighlightModule(BaseModule):
             self.bot.banphrase_manager.punish(source, res)
             return True
 
-        for f in self.bot.filters:
+        for f in list(self.bot.filters):
             if f.type == 'regex':
-                m = f.search(source, msg_lower)
+                try:
+                    m = f.search(source, msg_lower)
+                except TimeoutError:
+                    self.bot.filters.on_regex_timeout(f)
+                    continue
+
                 if m:
                     log.debug('Matched regex filter \'{0}\''.format(f.name))
                     f.run(self.bot, source, msg_raw, event, {'match': m})
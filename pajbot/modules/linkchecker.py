@@ -1,7 +1,11 @@
 import argparse
 import logging
+import re
+import threading
 import time
 import urllib.parse
+from collections import deque
+from collections import OrderedDict
 
 import requests
 from bs4 import BeautifulSoup
@@ -13,11 +17,11 @@ from sqlalchemy.dialects.mysql import TEXT
 import pajbot.managers
 import pajbot.models
 from pajbot.actions import Action
-from pajbot.actions import ActionQueue
 from pajbot.apiwrappers import SafeBrowsingAPI
 from pajbot.managers.adminlog import AdminLogManager
 from pajbot.managers.db import Base
 from pajbot.managers.db import DBManager
+from pajbot.managers.redis import RedisManager
 from pajbot.modules import BaseModule
 from pajbot.modules import ModuleSetting
 
@@ -59,10 +63,32 @@ def is_same_url(x, y):
     return parsed_x.netloc == parsed_y.netloc and parsed_x.path.strip('/') == parsed_y.path.strip('/') and parsed_x.query == parsed_y.query
 
 
+# Every match of Bot.url_regex has a dot followed by a letter or a digit (or is localhost/),
+# so messages and words without one can't contain a URL
+URL_PREFILTER = re.compile(r'\.\w|localhost/', re.IGNORECASE)
+
+# The www. in Bot.url_regex matches any character, it's the only way for a match to contain whitespace
+URL_ACROSS_WORDS = re.compile(r'www\s', re.IGNORECASE)
+
+
+def find_url_matches(regex, message):
+    """ Returns the same matches as regex.finditer(message) for Bot.url_regex.
+
+    Messages that can't contain a URL are skipped, and the regex is only run on the words
+    that can contain one instead of at every position of the message.
+    """
+    if URL_PREFILTER.search(message) is None:
+        return []
+
+    if URL_ACROSS_WORDS.search(message) is not None:
+        return list(regex.finditer(message))
+
+    return [match for word in message.split() if URL_PREFILTER.search(word) is not None for match in regex.finditer(word)]
+
+
 def find_unique_urls(regex, message):
-    _urls = regex.finditer(message)
     urls = []
-    for i in _urls:
+    for i in find_url_matches(regex, message):
         url = i.group(0)
         if not (url.startswith('http://') or url.startswith('https://')):
             url = 'http://' + url
@@ -80,21 +106,345 @@ class Url:
 
 
 class LinkCheckerCache:
-    def __init__(self):
-        self.cache = {}
-        return
+    """
+    Verdicts of recently checked URLs: True if the URL is safe, False if it's bad.
+
+    At most max_size URLs are kept in memory, the least recently used one is dropped first.
+    Every verdict expires after the TTL it was stored with. Expiry is checked when the URL is looked up,
+    instead of with a timer per URL.
+
+    If redis is set, verdicts are also stored in redis with the same TTL ({redis_prefix}{url} = 1 or 0),
+    so they survive restarts and can be read by the web process.
+    Redis is only asked about URLs that are not in memory.
+
+    Every redis verdict is stored with the generation of safe or bad verdicts it was made in
+    ({redis_prefix}generation:safe and :bad). Clearing verdicts only increments a generation,
+    verdicts from an older generation are ignored and expire on their own.
+    """
+
+    def __init__(self, max_size=10000, redis=None, redis_prefix='linkchecker:cache:'):
+        self.max_size = max_size
+        self.redis = redis
+        self.redis_prefix = redis_prefix
+
+        # Key = normalized url
+        # Value = [safe, expires_at], least recently used first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def normalize(url):
+        return url.strip('/').lower()
+
+    def get(self, url, now=None):
+        """ Returns True if the url is safe, False if it's bad, or None if there is no verdict for it """
+        if now is None:
+            now = time.time()
+        key = LinkCheckerCache.normalize(url)
+
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is not None:
+                if entry[1] > now:
+                    self.cache.move_to_end(key)
+                    return entry[0]
 
-    def __getitem__(self, url):
-        return self.cache[url.strip('/').lower()]
+                del self.cache[key]
 
-    def __setitem__(self, url, safe):
-        self.cache[url.strip('/').lower()] = safe
+        if self.redis is None:
+            return None
 
-    def __contains__(self, url):
-        return url.strip('/').lower() in self.cache
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.get(self.redis_prefix + key)
+            pipeline.pttl(self.redis_prefix + key)
+            pipeline.get(self.generation_key(True))
+            pipeline.get(self.generation_key(False))
+            value, ttl, safe_generation, bad_generation = pipeline.execute()
+        except:
+            log.exception('LinkChecker: Failed to get the verdict of {0} from redis'.format(url))
+            return None
+
+        if value is None or ttl is None or ttl <= 0:
+            return None
+
+        # Values are "1:generation" or "0:generation"
+        verdict, _, generation = value.partition(':')
+        safe = verdict == '1'
+        if (generation or '0') != ((safe_generation if safe else bad_generation) or '0'):
+            return None
+
+        self.set_local(key, safe, now + ttl / 1000)
+        return safe
+
+    def generation_key(self, safe):
+        return '{0}generation:{1}'.format(self.redis_prefix, 'safe' if safe else 'bad')
+
+    def set(self, url, safe, ttl, now=None):
+        """ Store the verdict of url for ttl seconds """
+        if now is None:
+            now = time.time()
+        key = LinkCheckerCache.normalize(url)
+
+        self.set_local(key, safe, now + ttl)
+
+        if self.redis is not None:
+            try:
+                # A clear between these two calls leaves a verdict from the old generation, which is ignored
+                generation = self.redis.get(self.generation_key(safe)) or '0'
+                self.redis.set(self.redis_prefix + key, '{0}:{1}'.format('1' if safe else '0', generation), ex=max(1, int(ttl)))
+            except:
+                log.exception('LinkChecker: Failed to store the verdict of {0} in redis'.format(url))
 
-    def __delitem__(self, url):
-        del self.cache[url.strip('/').lower()]
+    def set_local(self, key, safe, expires_at):
+        with self.lock:
+            self.cache[key] = [safe, expires_at]
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def delete(self, url):
+        key = LinkCheckerCache.normalize(url)
+
+        with self.lock:
+            self.cache.pop(key, None)
+
+        if self.redis is not None:
+            try:
+                self.redis.delete(self.redis_prefix + key)
+            except:
+                log.exception('LinkChecker: Failed to delete the verdict of {0} from redis'.format(url))
+
+    def clear(self, safe=None):
+        """ Forget all verdicts, or only the safe (safe=True) or bad (safe=False) ones.
+        Used when the blacklist or whitelist changes. """
+        with self.lock:
+            if safe is None:
+                self.cache.clear()
+            else:
+                for key in [key for key, entry in self.cache.items() if entry[0] == safe]:
+                    del self.cache[key]
+
+        if self.redis is not None:
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                if safe is None or safe is True:
+                    pipeline.incr(self.generation_key(True))
+                if safe is None or safe is False:
+                    pipeline.incr(self.generation_key(False))
+                pipeline.execute()
+            except:
+                log.exception('LinkChecker: Failed to clear the verdicts in redis')
+
+
+class LinkCheckJob:
+    """
+    A URL that is queued to be checked, or being checked, by the LinkCheckQueue.
+
+    The job is also the action of the check: running it runs the actions of
+    every message the URL was posted in, including messages that come in while it's being checked.
+    """
+
+    def __init__(self, key, url, host, action, queued_at):
+        self.key = key
+        self.url = url
+        self.host = host
+        self.queued_at = queued_at
+
+        self.actions = [] if action is None else [action]
+        self.bad = False
+        self.lock = threading.Lock()
+
+    def add_action(self, action):
+        if action is None:
+            return
+
+        with self.lock:
+            if not self.bad:
+                self.actions.append(action)
+                return
+
+        # The URL has been found to be bad already
+        action.run()
+
+    def run(self):
+        with self.lock:
+            self.bad = True
+            actions, self.actions = self.actions, []
+
+        for action in actions:
+            action.run()
+
+
+class LinkCheckQueue:
+    """
+    Checks URLs with check(url, action, session) on a pool of worker threads.
+
+    A URL that is already queued or being checked is not checked again, its action is added to that check instead.
+    At most per_host_limit URLs of the same host are checked at the same time, URLs of other hosts go first.
+    URLs that do not fit in the queue (max_depth), or that waited for more than max_lag seconds, are not checked.
+    If fail_closed is True their actions are run as if they were bad links, otherwise they're let through.
+
+    Every worker has its own requests.Session that follows at most max_redirects redirects,
+    so connections to the same hosts are reused.
+    """
+
+    def __init__(self, check, max_depth=500, per_host_limit=2, max_lag=30, fail_closed=False, max_redirects=5):
+        self.check = check
+        self.max_depth = max_depth
+        self.per_host_limit = per_host_limit
+        self.max_lag = max_lag
+        self.fail_closed = fail_closed
+        self.max_redirects = max_redirects
+
+        # Jobs waiting for a worker, oldest first
+        self.queue = deque()
+
+        # Key = normalized url
+        # Value = LinkCheckJob that is queued or being checked
+        self.jobs = {}
+
+        # Key = host
+        # Value = number of URLs of that host being checked
+        self.hosts_in_flight = {}
+
+        self.condition = threading.Condition()
+        self.workers = []
+
+        self.num_checked = 0
+        self.num_coalesced = 0
+        self.num_failed_open = 0
+        self.num_failed_closed = 0
+
+    def start(self, num_workers):
+        """ Start workers until there are num_workers of them """
+        with self.condition:
+            while len(self.workers) < num_workers:
+                thread = threading.Thread(target=self.work, name='LinkCheckerThread_{}'.format(len(self.workers)))
+                thread.daemon = True
+                self.workers.append(thread)
+                thread.start()
+
+    def create_session(self):
+        session = requests.Session()
+        session.max_redirects = self.max_redirects
+        return session
+
+    def add(self, url, action=None, now=None):
+        """ Queue url to be checked. Returns False if the queue is full and the URL was failed right away """
+        if now is None:
+            now = time.time()
+        key = LinkCheckerCache.normalize(url)
+
+        with self.condition:
+            job = self.jobs.get(key, None)
+            if job is None and len(self.queue) < self.max_depth:
+                self.jobs[key] = LinkCheckJob(key, url, urllib.parse.urlparse(url).netloc.lower(), action, now)
+                self.queue.append(self.jobs[key])
+                self.condition.notify()
+                return True
+            elif job is not None:
+                self.num_coalesced += 1
+
+        if job is not None:
+            job.add_action(action)
+            return True
+
+        log.warning('LinkChecker: The check queue is full, not checking {0}'.format(url))
+        self.fail(url, action)
+        return False
+
+    def fail(self, url, action):
+        """ Apply the lag policy to a URL that is not going to be checked """
+        if self.fail_closed:
+            self.num_failed_closed += 1
+            if action is not None:
+                action.run()
+        else:
+            self.num_failed_open += 1
+
+    def take_job(self, now):
+        """ Has to be called with self.condition held.
+        Returns the oldest job whose host is not at the per-host limit (or None),
+        and the jobs that waited for too long and should be failed """
+        lagging = []
+        while self.queue and self.max_lag > 0 and now - self.queue[0].queued_at > self.max_lag:
+            job = self.queue.popleft()
+            del self.jobs[job.key]
+            lagging.append(job)
+
+        for index, job in enumerate(self.queue):
+            if self.hosts_in_flight.get(job.host, 0) < self.per_host_limit:
+                del self.queue[index]
+                self.hosts_in_flight[job.host] = self.hosts_in_flight.get(job.host, 0) + 1
+                return job, lagging
+
+        return None, lagging
+
+    def next_job(self, now=None):
+        """ Returns the next job to check, or None if there is none right now """
+        if now is None:
+            now = time.time()
+
+        with self.condition:
+            job, lagging = self.take_job(now)
+
+        for lagging_job in lagging:
+            log.warning('LinkChecker: Not checking {0}, it was queued {1:.0f}s ago'.format(lagging_job.url, now - lagging_job.queued_at))
+            self.fail(lagging_job.url, lagging_job)
+
+        return job
+
+    def finish(self, job):
+        with self.condition:
+            self.jobs.pop(job.key, None)
+            in_flight = self.hosts_in_flight.get(job.host, 1) - 1
+            if in_flight > 0:
+                self.hosts_in_flight[job.host] = in_flight
+            else:
+                self.hosts_in_flight.pop(job.host, None)
+
+            self.num_checked += 1
+
+            # A worker might be waiting for this host
+            self.condition.notify_all()
+
+    def work(self):
+        session = self.create_session()
+
+        while True:
+            job = self.next_job()
+            if job is None:
+                with self.condition:
+                    # Wake up every now and then to fail jobs that are lagging behind
+                    self.condition.wait(1)
+                continue
+
+            try:
+                self.check(job.url, job, session)
+            except:
+                log.exception('Unhandled exception while checking {0}'.format(job.url))
+            finally:
+                self.finish(job)
+
+    def stats(self, now=None):
+        if now is None:
+            now = time.time()
+
+        with self.condition:
+            return {
+                    'depth': len(self.queue),
+                    'in_flight': len(self.jobs) - len(self.queue),
+                    'oldest_age_s': now - self.queue[0].queued_at if self.queue else 0.0,
+                    'workers': len(self.workers),
+                    'checked': self.num_checked,
+                    'coalesced': self.num_coalesced,
+                    'failed_open': self.num_failed_open,
+                    'failed_closed': self.num_failed_closed,
+                    }
 
 
 class LinkCheckerLink:
@@ -114,6 +464,123 @@ class LinkCheckerLink:
             return x.startswith(y + '/') or x == y
 
 
+class LinkTrieNode:
+    def __init__(self):
+        # Key = domain label or path segment
+        # Value = LinkTrieNode
+        self.children = {}
+
+        # Domain nodes: the root LinkTrieNode of the paths of this domain, or None
+        self.paths = None
+
+        # Path nodes: items added with this domain and path
+        self.items = []
+
+
+class LinkTrie:
+    """
+    Items (i.e. BlacklistedLinks) by domain and path. Finds the items whose domain and path
+    match a URL in O(domain labels + path segments) instead of going through every item.
+
+    Domains are stored by their labels in reverse (test.pajlada.se -> se, pajlada, test)
+    so all subdomains of a domain are below it, and every domain has a trie of path segments.
+    Matches the same links as LinkCheckerLink.is_subdomain and LinkCheckerLink.is_subpath.
+    """
+
+    def __init__(self):
+        self.root = LinkTrieNode()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def domain_labels(domain):
+        return reversed(domain.split('.'))
+
+    def path_segments(path):
+        """ '/a/b' -> ['a', 'b'] """
+        if path.startswith('/'):
+            path = path[1:]
+        if not path:
+            return []
+        return path.split('/')
+
+    def path_node(self, domain, path, create=False):
+        if domain.startswith('www.'):
+            domain = domain[4:]
+
+        # A path is a prefix of another if it's equal to it with or without a slash at the end
+        if path.endswith('/'):
+            path = path[:-1]
+
+        if path and not path.startswith('/'):
+            # Paths of URLs always start with a slash, so this could never match anything
+            return None
+
+        node = self.root
+        for label in LinkTrie.domain_labels(domain):
+            child = node.children.get(label, None)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = LinkTrieNode()
+            node = child
+
+        if node.paths is None:
+            if not create:
+                return None
+            node.paths = LinkTrieNode()
+        node = node.paths
+
+        for segment in LinkTrie.path_segments(path):
+            child = node.children.get(segment, None)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[segment] = LinkTrieNode()
+            node = child
+
+        return node
+
+    def add(self, domain, path, item):
+        node = self.path_node(domain, path, create=True)
+        if node is None:
+            log.warning('LinkChecker: Ignoring link with invalid path {0}{1}'.format(domain, path))
+            return
+
+        node.items.append(item)
+        self.size += 1
+
+    def remove(self, domain, path, item):
+        node = self.path_node(domain, path)
+        if node is None or item not in node.items:
+            return False
+
+        node.items.remove(item)
+        self.size -= 1
+        return True
+
+    def find(self, domain, path):
+        """ Yields the items whose domain is domain or a parent domain of it,
+        and whose path is path or a parent path of it """
+        segments = LinkTrie.path_segments(path)
+
+        node = self.root
+        for label in LinkTrie.domain_labels(domain):
+            node = node.children.get(label, None)
+            if node is None:
+                return
+
+            if node.paths is not None:
+                path_node = node.paths
+                yield from path_node.items
+                for segment in segments:
+                    path_node = path_node.children.get(segment, None)
+                    if path_node is None:
+                        break
+                    yield from path_node.items
+
+
 class BlacklistedLink(Base, LinkCheckerLink):
     __tablename__ = 'tb_link_blacklist'
 
@@ -173,28 +640,132 @@ class LinkCheckerModule(BaseModule):
                     'min_value': 1,
                     'max_value': 3600,
                     }),
+            ModuleSetting(
+                key='cache_safe_ttl',
+                label='Remember safe links for (seconds)',
+                type='number',
+                required=True,
+                placeholder='Seconds',
+                default=60,
+                constraints={
+                    'min_value': 1,
+                    'max_value': 86400,
+                    }),
+            ModuleSetting(
+                key='cache_unsafe_ttl',
+                label='Remember bad links for (seconds)',
+                type='number',
+                required=True,
+                placeholder='Seconds',
+                default=600,
+                constraints={
+                    'min_value': 1,
+                    'max_value': 86400,
+                    }),
+            ModuleSetting(
+                key='check_workers',
+                label='Number of links checked at the same time',
+                type='number',
+                required=True,
+                placeholder='Number of links',
+                default=4,
+                constraints={
+                    'min_value': 1,
+                    'max_value': 32,
+                    }),
+            ModuleSetting(
+                key='check_host_limit',
+                label='Number of links of the same site checked at the same time',
+                type='number',
+                required=True,
+                placeholder='Number of links',
+                default=2,
+                constraints={
+                    'min_value': 1,
+                    'max_value': 32,
+                    }),
+            ModuleSetting(
+                key='check_max_lag',
+                label='Give up on links that have not been checked after (seconds, 0 = never)',
+                type='number',
+                required=True,
+                placeholder='Seconds',
+                default=30,
+                constraints={
+                    'min_value': 0,
+                    'max_value': 3600,
+                    }),
+            ModuleSetting(
+                key='check_lag_policy',
+                label='Links that were given up on',
+                type='options',
+                required=True,
+                default='Let them through',
+                options=[
+                    'Let them through',
+                    'Time out the user',
+                    ]),
+            ModuleSetting(
+                key='cache_in_redis',
+                label='Remember checked links in redis across restarts',
+                type='boolean',
+                required=True,
+                default=False),
             ]
 
     def __init__(self):
         super().__init__()
+        self.bot = None
         self.db_session = None
         self.links = {}
 
-        self.blacklisted_links = []
-        self.whitelisted_links = []
+        self.blacklisted_links = LinkTrie()
+        self.whitelisted_links = LinkTrie()
+
+        self.super_whitelisted_domains = LinkTrie()
+        for domain in self.super_whitelist:
+            self.super_whitelisted_domains.add(domain, '/', domain)
 
-        self.cache = LinkCheckerCache()  # cache[url] = True means url is safe, False means the link is bad
+        self.cache = LinkCheckerCache()
 
-        self.action_queue = ActionQueue()
-        self.action_queue.start()
+        self.check_queue = LinkCheckQueue(self.check_url)
+
+    def load(self, **options):
+        super().load(**options)
+
+        # Settings changed on the web only load the module again
+        self.apply_settings()
+
+        return self
+
+    def apply_settings(self):
+        """ Pass the settings to the check queue and the cache.
+        The module can be enabled before its settings are loaded, the default settings are used until then. """
+        settings = dict(self.default_settings)
+        settings.update(self.settings)
+
+        self.check_queue.per_host_limit = settings['check_host_limit']
+        self.check_queue.max_lag = settings['check_max_lag']
+        self.check_queue.fail_closed = settings['check_lag_policy'] == 'Time out the user'
+
+        if self.bot is None:
+            return
+
+        self.check_queue.start(settings['check_workers'])
+
+        if settings['cache_in_redis'] is True:
+            self.cache.redis = RedisManager.get()
+            self.cache.redis_prefix = '{streamer}:linkchecker:cache:'.format(streamer=self.bot.streamer)
+        else:
+            self.cache.redis = None
 
     def enable(self, bot):
         self.bot = bot
         pajbot.managers.handler.HandlerManager.add_handler('on_message', self.on_message, priority=100)
         pajbot.managers.handler.HandlerManager.add_handler('on_commit', self.on_commit)
-        if bot:
-            self.run_later = bot.execute_delayed
+        self.apply_settings()
 
+        if bot:
             if 'safebrowsingapi' in bot.config['main']:
                 # XXX: This should be loaded as a setting instead.
                 # There needs to be a setting for settings to have them as "passwords"
@@ -208,13 +779,13 @@ class LinkCheckerModule(BaseModule):
             self.db_session.close()
             self.db_session = None
         self.db_session = DBManager.create_session()
-        self.blacklisted_links = []
+        self.blacklisted_links = LinkTrie()
         for link in self.db_session.query(BlacklistedLink):
-            self.blacklisted_links.append(link)
+            self.blacklisted_links.add(link.domain, link.path, link)
 
-        self.whitelisted_links = []
+        self.whitelisted_links = LinkTrie()
         for link in self.db_session.query(WhitelistedLink):
-            self.whitelisted_links.append(link)
+            self.whitelisted_links.add(link.domain, link.path, link)
 
     def disable(self, bot):
         pajbot.managers.handler.HandlerManager.remove_handler('on_message', self.on_message)
@@ -224,8 +795,8 @@ class LinkCheckerModule(BaseModule):
             self.db_session.commit()
             self.db_session.close()
             self.db_session = None
-            self.blacklisted_links = []
-            self.whitelisted_links = []
+            self.blacklisted_links = LinkTrie()
+            self.whitelisted_links = LinkTrie()
 
     def reload(self):
 
@@ -254,11 +825,7 @@ class LinkCheckerModule(BaseModule):
                         parsed_url = Url(url)
                         if len(parsed_url.parsed.netloc.split('.')) < 2:
                             continue
-                        whitelisted = False
-                        for whitelist in self.super_whitelist:
-                            if is_subdomain(parsed_url.parsed.netloc, whitelist):
-                                whitelisted = True
-                                break
+                        whitelisted = any(True for _ in self.super_whitelisted_domains.find(parsed_url.parsed.netloc, '/'))
                         if whitelisted is False:
                             self.bot.timeout(source.username, 30, reason=ban_reason)
                             if source.minutes_in_chat_online > 60:
@@ -271,24 +838,16 @@ class LinkCheckerModule(BaseModule):
                 # First we perform a basic check
                 if self.simple_check(url, action) == self.RET_FURTHER_ANALYSIS:
                     # If the basic check returns no relevant data, we queue up a proper check on the URL
-                    self.action_queue.add(self.check_url, args=[url, action])
+                    self.check_queue.add(url, action)
 
     def on_commit(self):
         if self.db_session is not None:
             self.db_session.commit()
 
-    def delete_from_cache(self, url):
-        if url in self.cache:
-            log.debug('LinkChecker: Removing url {0} from cache'.format(url))
-            del self.cache[url]
-
     def cache_url(self, url, safe):
-        if url in self.cache and self.cache[url] == safe:
-            return
-
         log.debug('LinkChecker: Caching url {0} as {1}'.format(url, 'SAFE' if safe is True else 'UNSAFE'))
-        self.cache[url] = safe
-        self.run_later(20, self.delete_from_cache, (url, ))
+        ttl = self.settings['cache_safe_ttl'] if safe is True else self.settings['cache_unsafe_ttl']
+        self.cache.set(url, safe, ttl)
 
     def counteract_bad_url(self, url, action=None, want_to_cache=True, want_to_blacklist=False):
         log.debug('LinkChecker: BAD URL FOUND {0}'.format(url.url))
@@ -322,7 +881,9 @@ class LinkCheckerModule(BaseModule):
 
         link = BlacklistedLink(domain, path, level)
         self.db_session.add(link)
-        self.blacklisted_links.append(link)
+        self.blacklisted_links.add(link.domain, link.path, link)
+        # Links that were safe might be blacklisted now
+        self.cache.clear(safe=True)
         self.db_session.commit()
 
     def whitelist_url(self, url, parsed_url=None):
@@ -345,7 +906,9 @@ class LinkCheckerModule(BaseModule):
 
         link = WhitelistedLink(domain, path)
         self.db_session.add(link)
-        self.whitelisted_links.append(link)
+        self.whitelisted_links.add(link.domain, link.path, link)
+        # Links that were bad might be whitelisted now
+        self.cache.clear(safe=False)
         self.db_session.commit()
 
     def is_blacklisted(self, url, parsed_url=None, sublink=False):
@@ -360,13 +923,11 @@ class LinkCheckerModule(BaseModule):
         if len(domain_split) < 2:
             return False
 
-        for link in self.blacklisted_links:
-            if link.is_subdomain(domain):
-                if link.is_subpath(path):
-                    if not sublink:
-                        return True
-                    elif link.level >= 1:  # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
-                        return True
+        for link in self.blacklisted_links.find(domain, path):
+            if not sublink:
+                return True
+            elif link.level >= 1:  # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
+                return True
 
         return False
 
@@ -382,10 +943,8 @@ class LinkCheckerModule(BaseModule):
         if len(domain_split) < 2:
             return False
 
-        for link in self.whitelisted_links:
-            if link.is_subdomain(domain):
-                if link.is_subpath(path):
-                    return True
+        for link in self.whitelisted_links.find(domain, path):
+            return True
 
         return False
 
@@ -401,9 +960,10 @@ class LinkCheckerModule(BaseModule):
         -1 = Link is bad
         0 = Link needs further analysis
         """
-        if url.url in self.cache:
+        safe = self.cache.get(url.url)
+        if safe is not None:
             log.debug('LinkChecker: Url {0} found in cache'.format(url.url))
-            if not self.cache[url.url]:  # link is bad
+            if not safe:  # link is bad
                 self.counteract_bad_url(url, action, False, False)
                 return self.RET_BAD_LINK
             return self.RET_GOOD_LINK
@@ -430,18 +990,18 @@ class LinkCheckerModule(BaseModule):
 
         return self.basic_check(url, action)
 
-    def check_url(self, url, action):
+    def check_url(self, url, action, session=requests):
         url = Url(url)
         if len(url.parsed.netloc.split('.')) < 2:
             # The URL is broken, ignore it
             return
 
         try:
-            self._check_url(url, action)
+            self._check_url(url, action, session)
         except:
             log.exception('LinkChecker unhanled exception while _check_url')
 
-    def _check_url(self, url, action):
+    def _check_url(self, url, action, session):
         log.debug('LinkChecker: Checking url {0}'.format(url.url))
 
         # XXX: The basic check is currently performed twice on links found in messages. Solve
@@ -454,7 +1014,12 @@ class LinkCheckerModule(BaseModule):
         connection_timeout = 2
         read_timeout = 1
         try:
-            r = requests.head(url.url, allow_redirects=True, timeout=connection_timeout)
+            r = session.head(url.url, allow_redirects=True, timeout=connection_timeout)
+        except requests.exceptions.TooManyRedirects:
+            # The session stops following redirects early, a link behind a longer chain could not be checked
+            log.warning('Too many redirects while checking {0}'.format(url.url))
+            self.check_queue.fail(url.url, action)
+            return
         except:
             self.cache_url(url.url, True)
             return
@@ -475,7 +1040,7 @@ class LinkCheckerModule(BaseModule):
                 return
 
         if self.safeBrowsingAPI:
-            if self.safeBrowsingAPI.check_url(redirected_url.url):  # harmful url detected
+            if self.safeBrowsingAPI.check_url(redirected_url.url, session=session):  # harmful url detected
                 log.debug('Bad url because google api')
                 self.counteract_bad_url(url, action, want_to_blacklist=False)
                 self.counteract_bad_url(redirected_url, want_to_blacklist=False)
@@ -488,7 +1053,7 @@ class LinkCheckerModule(BaseModule):
 
         html = ''
         try:
-            response = requests.get(url=url.url, stream=True, timeout=(connection_timeout, read_timeout))
+            response = session.get(url=url.url, stream=True, timeout=(connection_timeout, read_timeout))
 
             content_length = response.headers.get('Content-Length')
             if content_length and int(response.headers.get('Content-Length')) > maximum_size:
@@ -517,6 +1082,10 @@ class LinkCheckerModule(BaseModule):
             log.warning('Reading timed out while checking {0}'.format(url.url))
             self.cache_url(url.url, True)
             return
+        except requests.exceptions.TooManyRedirects:
+            log.warning('Too many redirects while checking {0}'.format(url.url))
+            self.check_queue.fail(url.url, action)
+            return
         except:
             log.exception('Unhandled exception')
             return
@@ -556,7 +1125,7 @@ class LinkCheckerModule(BaseModule):
                 continue
 
             try:
-                r = requests.head(url.url, allow_redirects=True, timeout=connection_timeout)
+                r = session.head(url.url, allow_redirects=True, timeout=connection_timeout)
             except:
                 continue
 
@@ -572,7 +1141,7 @@ class LinkCheckerModule(BaseModule):
                     continue
 
             if self.safeBrowsingAPI:
-                if self.safeBrowsingAPI.check_url(redirected_url.url):  # harmful url detected
+                if self.safeBrowsingAPI.check_url(redirected_url.url, session=session):  # harmful url detected
                     log.debug('Evil sublink {0} by google API'.format(url))
                     self.counteract_bad_url(original_url, action)
                     self.counteract_bad_url(original_redirected_url)
@@ -726,7 +1295,8 @@ class LinkCheckerModule(BaseModule):
             link = self.db_session.query(BlacklistedLink).filter_by(id=id).one_or_none()
 
             if link:
-                self.blacklisted_links.remove(link)
+                self.blacklisted_links.remove(link.domain, link.path, link)
+                self.cache.clear(safe=False)
                 self.db_session.delete(link)
                 self.db_session.commit()
             else:
@@ -754,7 +1324,8 @@ class LinkCheckerModule(BaseModule):
             link = self.db_session.query(WhitelistedLink).filter_by(id=id).one_or_none()
 
             if link:
-                self.whitelisted_links.remove(link)
+                self.whitelisted_links.remove(link.domain, link.path, link)
+                self.cache.clear(safe=True)
                 self.db_session.delete(link)
                 self.db_session.commit()
             else:
@@ -81,12 +81,13 @@ class PyramidModule(BaseModule):
         self.going_down = False
         self.regex = re.compile(' +')
 
-    def on_pubmsg(self, source, message):
+    def on_pubmsg(self, message_context):
+        source = message_context.source
         if source.username == 'twitchnotify' or source.username == 'moobot' or source.username == 'admiralbullbot':
             return
 
         try:
-            msg_parts = message.split(' ')
+            msg_parts = message_context.words
             if len(self.data) > 0:
                 cur_len = len(msg_parts)
                 last_len = len(self.data[-1])
@@ -155,7 +156,7 @@ class PyramidModule(BaseModule):
             log.exception('Unhandled exception in pyramid parser')
 
     def enable(self, bot):
-        HandlerManager.add_handler('on_pubmsg', self.on_pubmsg)
+        HandlerManager.add_handler('on_pubmsg', self.on_pubmsg, context=True)
         self.bot = bot
 
     def disable(self, bot):
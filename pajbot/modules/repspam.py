@@ -273,14 +273,16 @@ class RepspamModule(BaseModule):
 
     def enable(self, bot):
         self.bot = bot
-        HandlerManager.add_handler('on_message', self.on_message, priority=150)
+        HandlerManager.add_handler('on_message', self.on_message, priority=150, context=True)
 
     def disable(self, bot):
         HandlerManager.remove_handler('on_message', self.on_message)
 
-    def on_message(self, source, message, emotes, whisper, urls, event):
-        if whisper:
+    def on_message(self, message_context):
+        if message_context.whisper:
             return
+        source = message_context.source
+        message = message_context.message
         if source.level >= 420 or source.moderator:
             return
 
@@ -289,7 +291,7 @@ class RepspamModule(BaseModule):
         suffix_tree.append_string(message)
 
         word_freq = []
-        word_list = message.split(' ')
+        word_list = message_context.words
         if len(word_list) <= 1:
             # Not enough words to see if it's repetitive this way
             return
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Counts the SQL statements the user handling of Bot.on_pubmsg costs per 1000 chat messages.
+
+Usage: python3 -m pajbot.scripts.bench_users --messages 10000 --users 500
+
+Every message goes through UserManager.get_user_context like in Bot.on_pubmsg, sets the
+subscriber/moderator flags from the message tags like Bot.parse_message, and a small part
+of the messages are commands that read the level and points of the user.
+The benchmark runs twice:
+ - uncached: the UserCache disabled, like in processes other than the bot (only the UserSQLCache is used)
+ - cached: the UserCache enabled, flushed every 5 seconds of simulated chat
+Only SQL is counted, redis is not used.
+"""
+
+import argparse
+import bisect
+import itertools
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+log = logging.getLogger('pajbot')
+
+
+def generate_messages(num_messages, num_users, command_ratio, seed=1337):
+    """ Returns a list of (username, subscriber, is_command) tuples.
+    A few users type most of the messages, like in a real chat. """
+    rng = random.Random(seed)
+    usernames = ['user{}'.format(i) for i in range(num_users)]
+    weights = [1.0 / (i + 1) for i in range(num_users)]
+    subscribers = set(username for username in usernames if rng.random() < 0.2)
+
+    cumulative_weights = list(itertools.accumulate(weights))
+
+    messages = []
+    for _ in range(num_messages):
+        username = usernames[bisect.bisect(cumulative_weights, rng.random() * cumulative_weights[-1])]
+        messages.append((username, username in subscribers, rng.random() < command_ratio))
+
+    return messages
+
+
+def replay(messages, use_cache, messages_per_second):
+    import pajbot.models.user  # NOQA
+    from sqlalchemy import create_engine
+    from sqlalchemy import event
+    from sqlalchemy.orm import sessionmaker
+
+    from pajbot.managers.db import DBManager
+    from pajbot.managers.user import UserManager
+    from pajbot.models.user import User
+    from pajbot.models.user import UserCache
+    from pajbot.models.user import UserRedisBuffer
+    from pajbot.models.user import UserSQLCache
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        DBManager.engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'))
+        DBManager.Session = sessionmaker(bind=DBManager.engine, autoflush=False)
+        User.__table__.create(DBManager.engine)
+
+        UserCache.entries = OrderedDict()
+        UserCache.dirty = set()
+        UserCache.evicted = {}
+        UserSQLCache.cache = {}
+        users = UserManager()
+        UserCache.enabled = use_cache
+        UserRedisBuffer.enabled = False
+
+        counters = {
+                'statements': 0,
+                'transactions': 0,
+                }
+
+        def on_execute(*args):
+            counters['statements'] += 1
+
+        def on_commit(*args):
+            counters['transactions'] += 1
+
+        event.listen(DBManager.engine, 'before_cursor_execute', on_execute)
+        event.listen(DBManager.engine, 'commit', on_commit)
+
+        messages_per_flush = messages_per_second * UserManager.SQL_FLUSH_INTERVAL
+        start = time.perf_counter()
+        for index, (username, subscriber, is_command) in enumerate(messages):
+            with users.get_user_context(username) as source:
+                source.subscriber = subscriber
+                source.moderator = False
+                if source.timed_out is True:
+                    source.timed_out = False
+
+                if is_command and source.level >= 100:
+                    source.points += 1
+
+            if use_cache and (index + 1) % messages_per_flush == 0:
+                UserCache.flush()
+
+        if use_cache:
+            UserCache.flush()
+        elapsed = time.perf_counter() - start
+
+        DBManager.engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+        UserCache.enabled = False
+
+    per_thousand = 1000.0 / len(messages)
+    return {
+            'statements': counters['statements'] * per_thousand,
+            'transactions': counters['transactions'] * per_thousand,
+            'messages_per_second': len(messages) / elapsed,
+            }
+
+
+def run(args):
+    messages = generate_messages(args.messages, args.users, args.command_ratio)
+
+    print('Replaying {} messages from {} users'.format(len(messages), len(set(m[0] for m in messages))))
+    print('{:<10} {:>18} {:>20} {:>14}'.format('mode', 'statements/1000', 'transactions/1000', 'messages/s'))
+    for mode, use_cache in (('uncached', False), ('cached', True)):
+        result = replay(messages, use_cache, args.messages_per_second)
+        print('{:<10} {:>18.1f} {:>20.1f} {:>14.0f}'.format(mode, result['statements'], result['transactions'], result['messages_per_second']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--command-ratio', type=float, default=0.03)
+    parser.add_argument('--messages-per-second', type=int, default=20)
+
+    run(parser.parse_args())
@@ -1,10 +1,12 @@
 from flask_restful import Api
 
 import pajbot.web.routes.api.banphrases
+import pajbot.web.routes.api.chatstats
 import pajbot.web.routes.api.clr
 import pajbot.web.routes.api.commands
 import pajbot.web.routes.api.common
 import pajbot.web.routes.api.email
+import pajbot.web.routes.api.handlers
 import pajbot.web.routes.api.modules
 import pajbot.web.routes.api.pleblist
 import pajbot.web.routes.api.social
@@ -62,3 +64,9 @@ def init(app):
 
     # /streamelements
     pajbot.web.routes.api.streamelements.init(api)
+
+    # /handlers
+    pajbot.web.routes.api.handlers.init(api)
+
+    # /chatstats
+    pajbot.web.routes.api.chatstats.init(api)
@@ -1,5 +1,7 @@
 import logging
+import time
 
+from flask import request
 from flask_restful import reqparse
 from flask_restful import Resource
 
@@ -7,10 +9,12 @@ import pajbot.modules
 import pajbot.utils
 import pajbot.web.utils
 from pajbot.managers.adminlog import AdminLogManager
-from pajbot.models.banphrase import BanphraseManager
 from pajbot.managers.db import DBManager
 from pajbot.models.banphrase import Banphrase
+from pajbot.models.banphrase import BanphraseCheckService
+from pajbot.models.banphrase import BanphraseManager
 from pajbot.models.sock import SocketClientManager
+from pajbot.web import app
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +30,7 @@ class APIBanphraseRemove(Resource):
             db_session.delete(banphrase)
             db_session.delete(banphrase.data)
             SocketClientManager.send('banphrase.remove', {'id': banphrase.id})
+            BanphraseManager.banphrases_changed()
             return {'success': 'good job'}, 200
 
 
@@ -64,6 +69,7 @@ class APIBanphraseToggle(Resource):
                     'Enabled' if row.enabled else 'Disabled',
                     row.phrase)
             SocketClientManager.send('banphrase.update', payload)
+            BanphraseManager.banphrases_changed()
             return {'success': 'successful toggle', 'new_state': new_state}
 
 
@@ -77,8 +83,6 @@ class APIBanphraseTest(Resource):
     def post(self, **options):
         args = self.post_parser.parse_args()
 
-        banphrase_manager = BanphraseManager(None).load()
-
         try:
             message = str(args['message'])
         except (ValueError, KeyError):
@@ -87,19 +91,61 @@ class APIBanphraseTest(Resource):
         if len(message) == 0:
             return {'error': 'Parameter `message` cannot be empty.'}, 400
 
+        if len(message) > BanphraseCheckService.MAX_MESSAGE_LENGTH:
+            return {'error': 'Parameter `message` can be at most {} characters long.'.format(BanphraseCheckService.MAX_MESSAGE_LENGTH)}, 400
+
+        start = time.perf_counter()
+        res = BanphraseCheckService.check_messages([message])[0]
+
         ret = {
                 'banned': False,
-                'input_message': message
+                'input_message': message,
+                'took_ms': (time.perf_counter() - start) * 1000,
                 }
 
-        res = banphrase_manager.check_message(message, None)
-
         if res is not False:
             ret['banned'] = True
-            ret['banphrase_data'] = res
+            ret['banphrase_data'] = res.jsonify()
 
         return ret
 
+
+class APIBanphraseCheck(Resource):
+    # Max number of messages that can be checked in one request
+    MAX_MESSAGES = 100
+
+    def __init__(self):
+        super().__init__()
+
+        self.post_parser = reqparse.RequestParser()
+        self.post_parser.add_argument('messages', required=True, action='append')
+
+    def post(self, **options):
+        if BanphraseCheckService.rate_limited(request.remote_addr):
+            return {'error': 'Too many requests, at most {} per minute are allowed.'.format(BanphraseCheckService.rate_limit)}, 429
+
+        args = self.post_parser.parse_args()
+
+        messages = [str(message) for message in args['messages']]
+        if len(messages) > self.MAX_MESSAGES:
+            return {'error': 'At most {} messages can be checked at once.'.format(self.MAX_MESSAGES)}, 400
+
+        if any(len(message) > BanphraseCheckService.MAX_MESSAGE_LENGTH for message in messages):
+            return {'error': 'Messages can be at most {} characters long.'.format(BanphraseCheckService.MAX_MESSAGE_LENGTH)}, 400
+
+        start = time.perf_counter()
+        results = BanphraseCheckService.check_messages(messages)
+
+        return {
+                'results': [{
+                    'banned': res is not False,
+                    'banphrase_data': res.jsonify() if res is not False else None,
+                    } for res in results],
+                'took_ms': (time.perf_counter() - start) * 1000,
+                'cache': BanphraseCheckService.manager.matcher.verdicts.stats(),
+                }
+
+
 class APIBanphraseDump(Resource):
     def __init__(self):
         super().__init__()
@@ -117,5 +163,9 @@ def init(api):
     # Test a message against banphrases
     api.add_resource(APIBanphraseTest, '/banphrases/test')
 
+    # Test a list of messages against banphrases
+    BanphraseCheckService.rate_limit = app.bot_config['web'].getint('banphrase_check_rate_limit', BanphraseCheckService.rate_limit)
+    api.add_resource(APIBanphraseCheck, '/banphrases/check')
+
     # Dump
     # api.add_resource(APIBanphraseDump, '/banphrases/dump')
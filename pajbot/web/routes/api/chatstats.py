@@ -0,0 +1,24 @@
+import json
+
+from flask_restful import Resource
+
+from pajbot.managers.redis import RedisManager
+from pajbot.streamhelper import StreamHelper
+
+
+class APIChatStats(Resource):
+    def get(self, **options):
+        """ Most used emotes and words of the last minute, the last 10 minutes and the current stream,
+        see StreamManager.publish_chat_stats """
+        redis = RedisManager.get()
+        data = redis.get('{streamer}:chat_stats'.format(streamer=StreamHelper.get_streamer()))
+        if data is None:
+            return {
+                    'error': 'No chat stats available'
+                    }, 404
+
+        return json.loads(data)
+
+
+def init(api):
+    api.add_resource(APIChatStats, '/chatstats')
@@ -0,0 +1,25 @@
+import json
+
+from flask_restful import Resource
+
+import pajbot.web.utils
+from pajbot.managers.redis import RedisManager
+from pajbot.streamhelper import StreamHelper
+
+
+class APIHandlerProfile(Resource):
+    @pajbot.web.utils.requires_level(500)
+    def get(self, **options):
+        """ Latency of every handler in the bot, see HandlerProfiler.publish """
+        redis = RedisManager.get()
+        data = redis.get('{streamer}:handlers:profile'.format(streamer=StreamHelper.get_streamer()))
+        if data is None:
+            return {
+                    'error': 'Handler profiling is not enabled'
+                    }, 404
+
+        return json.loads(data)
+
+
+def init(api):
+    api.add_resource(APIHandlerProfile, '/handlers')
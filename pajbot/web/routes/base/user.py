@@ -1,5 +1,9 @@
+import datetime
+
+from flask import abort
 from flask import render_template
 
+from pajbot.managers.chatlog import ChatLog
 from pajbot.managers.db import DBManager
 from pajbot.managers.user import UserManager
 from pajbot.models.roulette import Roulette
@@ -31,7 +35,31 @@ def init(app):
                     roulette_stats=roulette_stats,
                     dotabet_stats=dotabet_stats,
                     roulettes=roulettes,
-                    bets=recent_bets)
+                    bets=recent_bets,
+                    chat_log=app.bot_config['main'].get('chat_log_dir', None) is not None)
+
+    @app.route('/user/<username>/logs')
+    def user_logs(username):
+        chat_log_dir = app.bot_config['main'].get('chat_log_dir', None)
+        if chat_log_dir is None:
+            abort(404)
+
+        with DBManager.create_session_scope() as db_session:
+            user = UserManager.find_static(username, db_session=db_session)
+            if not user:
+                return render_template('no_user.html'), 404
+
+            messages = []
+            for timestamp, _, message in ChatLog(chat_log_dir).user_messages(user.username, days=7, limit=500):
+                messages.append({
+                    'time': datetime.datetime.utcfromtimestamp(timestamp),
+                    'message': message,
+                    })
+            messages.reverse()
+
+            return render_template('user_logs.html',
+                    user=user,
+                    messages=messages)
 
 def get_bets(app, user):
     with DBManager.create_session_scope() as db_session:
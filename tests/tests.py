@@ -56,6 +56,1375 @@ class TestURLMethods(unittest2.TestCase):
         # TODO: The protocol of a URL is entirely thrown away, this behaviour should probably be changed.
         self.assertEqual(find_unique_urls(regex, 'https://pajlada.se/ https://pajlada.se'), {'https://pajlada.se/', 'https://pajlada.se'})
 
+        self.assertEqual(find_unique_urls(regex, 'no links here FeelsGoodMan'), set())
+        self.assertEqual(find_unique_urls(regex, 'localhost/test'), {'http://localhost/test'})
+        self.assertEqual(find_unique_urls(regex, '(foo.bar/baz?a=1#b) user@1.2.3.4:80/x'), {'http://(foo.bar/baz?a=1#b', 'http://user@1.2.3.4:80/x'})
+
+    def test_find_url_matches_fuzz(self):
+        from pajbot.modules.linkchecker import find_url_matches
+        from pajbot.bot import Bot
+        import random
+        import re
+
+        regex = re.compile(Bot.url_regex_str, re.IGNORECASE)
+        pieces = ['a', 'Z', '1', '.', '/', '-', ':', '@', '?', '#', '(', ')', '[', ']', ' ', '  ', '\t', '\n', '\u00a0', '\u3000',
+                  'www', 'WWW.', 'http://', 'https://', 'localhost', '.com', '.se', '192.168.0.1', 'é', 'Kappa', 'forsen.tv/']
+
+        rng = random.Random(1337)
+        for _ in range(3000):
+            message = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 25)))
+            self.assertEqual([match.group(0) for match in find_url_matches(regex, message)],
+                             [match.group(0) for match in regex.finditer(message)], repr(message))
+
+
+class TestEmoteMethods(unittest2.TestCase):
+    def test_index_message_words(self):
+        from pajbot.managers.emote import index_message_words
+
+        self.assertEqual(index_message_words(''), {})
+        self.assertEqual(index_message_words('Kappa'), {'Kappa': [0]})
+        self.assertEqual(index_message_words('Kappa 123 Kappa'), {'Kappa': [0, 10], '123': [6]})
+        self.assertEqual(index_message_words('  Kappa  Keepo '), {'Kappa': [2], 'Keepo': [9]})
+        self.assertEqual(list(index_message_words('b a b c')), ['b', 'a', 'c'])
+
+        # Only spaces separate words, same as the old (?<![^ ])CODE(?![^ ]) regex
+        self.assertEqual(index_message_words('Kappa,Keepo'), {'Kappa,Keepo': [0]})
+
+
+class TestEPMCounter(unittest2.TestCase):
+    def test_sliding_window(self):
+        from pajbot.managers.emote import EPMCounter
+
+        epm = EPMCounter()
+        epm.incr('Kappa', 2)
+        epm.incr('Keepo', 1)
+        for _ in range(30):
+            epm.tick()
+        epm.incr('Kappa', 3)
+
+        self.assertEqual(epm.get('Kappa'), 5)
+        self.assertEqual(epm.get('Keepo'), 1)
+        self.assertIsNone(epm.get('PogChamp'))
+
+        for _ in range(30):
+            epm.tick()
+
+        # The first second fell out of the window, emotes without any uses left are dropped
+        self.assertEqual(epm.get('Kappa'), 3)
+        self.assertIsNone(epm.get('Keepo'))
+        self.assertEqual(len(epm), 1)
+
+        for _ in range(30):
+            epm.tick()
+        self.assertEqual(len(epm), 0)
+
+
+class TestEmoteManager(unittest2.TestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed, see requirements/bench.txt')
+
+        import configparser
+
+        from pajbot.managers.emote import EmoteManager
+        from pajbot.managers.handler import HandlerManager
+        from pajbot.managers.redis import RedisManager
+        from pajbot.streamhelper import StreamHelper
+
+        class Bot:
+            streamer = 'pajlada'
+            config = configparser.ConfigParser()
+            config.read_dict({'main': {'offline_emotes': '1'}})
+
+        self.redis = RedisManager.redis
+        RedisManager.redis = fakeredis.FakeRedis(decode_responses=True)
+        RedisManager.redis.flushall()
+        StreamHelper.init_streamer('pajlada')
+        HandlerManager.init_handlers()
+
+        self.emotes = EmoteManager(Bot())
+
+    def tearDown(self):
+        from pajbot.managers.redis import RedisManager
+
+        RedisManager.redis = self.redis
+
+    def test_emote_tm(self):
+        self.emotes.parse_message_twitch_emotes(None, 'Kappa 123 Kappa', '25:0-4,10-14', False)
+        self.emotes.parse_message_twitch_emotes(None, 'Kappa', '25:0-4', True)
+
+        # Whispers don't count
+        self.assertEqual(self.emotes.get_emote_epm('Kappa'), 2)
+        self.assertIsNone(self.emotes.get_emote_epm('Keepo'))
+
+        # $(etm:Kappa)
+        from pajbot.bot import Bot
+
+        class EmoteBot:
+            emotes = self.emotes
+
+        self.assertEqual(Bot.get_emote_tm(EmoteBot(), 'Kappa'), '2')
+        self.assertIsNone(Bot.get_emote_tm(EmoteBot(), 'Keepo'))
+
+    def test_count_batching(self):
+        from pajbot.managers.redis import RedisManager
+
+        self.emotes.parse_message_twitch_emotes(None, 'Kappa 123 Kappa', '25:0-4,10-14', False)
+        self.emotes.parse_message_twitch_emotes(None, 'Kappa Keepo', '25:0-4/1902:6-10', False)
+
+        # Nothing is sent to redis until the next tick, one count per emote is sent then
+        self.assertEqual(self.emotes.pending_counts, {'Kappa': 3, 'Keepo': 1})
+        self.assertIsNone(RedisManager.get().zscore('pajlada:emotes:count', 'Kappa'))
+        self.assertEqual(self.emotes.get_emote_count('Kappa'), 3)
+
+        self.emotes.on_tick()
+        self.assertEqual(self.emotes.pending_counts, {})
+        self.assertEqual(RedisManager.get().zscore('pajlada:emotes:count', 'Kappa'), 3)
+        self.assertEqual(self.emotes.get_emote_count('Kappa'), 3)
+        self.assertEqual(self.emotes.get_emote_count('Keepo'), 1)
+
+        self.emotes.parse_message_twitch_emotes(None, 'Kappa', '25:0-4', False)
+        self.assertEqual(self.emotes.get_emote_count('Kappa'), 4)
+        self.emotes.flush()
+        self.assertEqual(RedisManager.get().zscore('pajlada:emotes:count', 'Kappa'), 4)
+
+
+class TestThirdPartyEmoteManager(unittest2.TestCase):
+    def setUp(self):
+        import tempfile
+
+        from pajbot.managers.redis import RedisManager
+        from pajbot.streamhelper import StreamHelper
+
+        self.directory = tempfile.mkdtemp()
+        self.redis = RedisManager.redis
+        RedisManager.redis = None
+        StreamHelper.init_streamer('pajlada')
+
+    def tearDown(self):
+        import shutil
+
+        from pajbot.managers.redis import RedisManager
+
+        shutil.rmtree(self.directory)
+        RedisManager.redis = self.redis
+
+    def test_snapshot(self):
+        from pajbot.managers.emote import BTTVEmoteManager
+        from pajbot.managers.emote import OfflineEmoteApi
+        from pajbot.managers.emote import index_message_words
+
+        class UnreachableApi:
+            def get_global_emotes(self):
+                raise AssertionError('The API must not be called on startup')
+
+        # Nothing to load yet
+        api = OfflineEmoteApi(global_emotes=[{'code': 'FeelsGoodMan', 'emote_hash': 'a'}], channel_emotes=[{'code': 'forsenPls', 'emote_hash': 'b'}])
+        manager = BTTVEmoteManager(api=api, snapshot_dir=self.directory)
+        self.assertEqual(manager.emote_index, {})
+        self.assertIsNone(manager.updated_at)
+
+        manager.update_emotes()
+        self.assertEqual(sorted(manager.emote_index), ['FeelsGoodMan', 'forsenPls'])
+        self.assertIsNotNone(manager.updated_at)
+
+        # A refresh that fails keeps the emotes
+        api.global_emotes = None
+        api.channel_emotes = None
+        manager.update_emotes()
+        self.assertEqual(sorted(manager.emote_index), ['FeelsGoodMan', 'forsenPls'])
+
+        # Only the call that failed keeps its emotes
+        api.global_emotes = [{'code': 'FeelsBadMan', 'emote_hash': 'c'}]
+        manager.update_emotes()
+        self.assertEqual(sorted(manager.emote_index), ['FeelsBadMan', 'forsenPls'])
+
+        # Starting again loads the snapshot without calling the API
+        restarted_manager = BTTVEmoteManager(api=UnreachableApi(), snapshot_dir=self.directory)
+        self.assertEqual(restarted_manager.channel_emotes, {'forsenPls': 'b'})
+        emotes = restarted_manager.parse_message_words(index_message_words('forsenPls FeelsBadMan forsenPls'))
+        self.assertEqual([(emote['code'], emote['bttv_hash'], emote['count']) for emote in emotes], [('forsenPls', 'b', 2), ('FeelsBadMan', 'c', 1)])
+
+        # A channel that removed all of its emotes has none left
+        api.channel_emotes = []
+        manager.update_emotes()
+        self.assertEqual(manager.channel_emotes, {})
+        self.assertEqual(sorted(manager.emote_index), ['FeelsBadMan'])
+
+
+class TestChatStats(unittest2.TestCase):
+    def test_space_saving(self):
+        from pajbot.managers.chatstats import SpaceSaving
+
+        top = SpaceSaving(3)
+        for item in ['a', 'b', 'a', 'c', 'a', 'b', 'd', 'a', 'b', 'e']:
+            top.add(item)
+
+        self.assertEqual(len(top), 3)
+        self.assertEqual(top.top(2), [('a', 4), ('b', 3)])
+
+        # Counts are never lower than the real count
+        for item, count in top.top(3):
+            self.assertGreaterEqual(count, ['a', 'b', 'a', 'c', 'a', 'b', 'd', 'a', 'b', 'e'].count(item))
+
+    def test_windows(self):
+        from pajbot.managers.chatstats import ChatStats
+
+        stats = ChatStats()
+        kappa = {'code': 'Kappa', 'count': 2}
+        pogchamp = {'code': 'PogChamp', 'count': 1}
+
+        stats.add_message(['kappa', 'hello', 'hello', 'chat'], [kappa], now=1000)
+        stats.add_message(['pogchamp', 'hello'], [pogchamp], now=1300)
+        stats.add_message(['pogchamp'], [pogchamp], now=1310)
+
+        self.assertEqual(stats.top('emotes', '1m', now=1320), [('PogChamp', 2)])
+        self.assertEqual(stats.top('emotes', '10m', now=1320), [('Kappa', 2), ('PogChamp', 2)])
+        self.assertEqual(stats.top('words', '10m', now=1320), [('hello', 2), ('chat', 1)])
+        self.assertEqual(stats.top('emotes', '10m', now=1700), [('PogChamp', 2)])
+        self.assertEqual(stats.top('emotes', 'stream', now=1700), [('Kappa', 2), ('PogChamp', 2)])
+
+        stats.reset_stream()
+        self.assertEqual(stats.top('emotes', 'stream'), [])
+        self.assertRaises(ValueError, stats.top, 'emotes', '5m')
+
+
+class TestBanphraseMatcher(unittest2.TestCase):
+    def test_aho_corasick(self):
+        from pajbot.ahocorasick import AhoCorasick
+
+        automaton = AhoCorasick()
+        automaton.add('he', 'he')
+        automaton.add('she', 'she')
+        automaton.add('hers', 'hers')
+        automaton.add('', 'empty')
+        automaton.build()
+
+        self.assertEqual(len(automaton), 3)
+        self.assertEqual(sorted(automaton.iter('ushers')), [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')])
+        self.assertEqual(list(automaton.iter('xyz')), [])
+
+    def test_operators(self):
+        import pajbot.models.user  # noqa
+        from pajbot.models.banphrase import Banphrase
+        from pajbot.models.banphrase import BanphraseMatcher
+
+        banphrases = [
+                Banphrase(phrase='Kappa', operator='contains', sub_immunity=False),
+                Banphrase(phrase='!test', operator='startswith', sub_immunity=False),
+                Banphrase(phrase='xD', operator='endswith', case_sensitive=True, sub_immunity=False),
+                Banphrase(phrase='cafe', operator='exact', remove_accents=True, sub_immunity=False),
+                Banphrase(phrase='^a+$', operator='regex', sub_immunity=False),
+                ]
+        matcher = BanphraseMatcher(banphrases)
+
+        self.assertEqual(matcher.find_matches('hello KAPPA', None), [banphrases[0]])
+        self.assertEqual(matcher.find_matches('!test kappa', None), [banphrases[0], banphrases[1]])
+        self.assertEqual(matcher.find_matches('a !test', None), [])
+        self.assertEqual(matcher.find_matches('lol xD', None), [banphrases[2]])
+        self.assertEqual(matcher.find_matches('lol XD', None), [])
+        self.assertEqual(matcher.find_matches('Café', None), [banphrases[3]])
+        self.assertEqual(matcher.find_matches('café au lait', None), [])
+        self.assertEqual(matcher.find_matches('aaa', None), [banphrases[4]])
+
+    def test_regex(self):
+        import pajbot.models.user  # noqa
+        from pajbot.models.banphrase import Banphrase
+        from pajbot.models.banphrase import BanphraseMatcher
+
+        banphrases = [Banphrase(phrase=phrase, operator='regex', sub_immunity=False) for phrase in ['b(c|d)', 'fo+', r'(e)\1', '(x+x+)+y']]
+        timed_out = []
+        matcher = BanphraseMatcher(banphrases, on_regex_timeout=timed_out.append)
+
+        self.assertEqual(matcher.find_matches('BD foo', None), [banphrases[0], banphrases[1]])
+        self.assertEqual(matcher.find_matches('ee', None), [banphrases[2]])
+        self.assertEqual(matcher.find_matches('nothing', None), [])
+        self.assertEqual(timed_out, [])
+
+        self.assertEqual(matcher.find_matches('x' * 5000, None), [])
+        self.assertEqual(timed_out, [banphrases[3]])
+
+    def test_check_rate_limit(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed, see requirements/bench.txt')
+
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.banphrase import BanphraseCheckService
+        from pajbot.streamhelper import StreamHelper
+
+        old_redis = RedisManager.redis
+        rate_limit = BanphraseCheckService.rate_limit
+        RedisManager.redis = fakeredis.FakeRedis(decode_responses=True)
+        RedisManager.redis.flushall()
+        StreamHelper.init_streamer('pajlada')
+        try:
+            self.assertEqual(rate_limit, 6000)
+            BanphraseCheckService.rate_limit = 3
+            self.assertEqual([BanphraseCheckService.rate_limited('1.2.3.4', now=60) for _ in range(4)], [False, False, False, True])
+            self.assertFalse(BanphraseCheckService.rate_limited('5.6.7.8', now=60))
+
+            # Every minute starts over
+            self.assertFalse(BanphraseCheckService.rate_limited('1.2.3.4', now=120))
+
+            BanphraseCheckService.rate_limit = 0
+            self.assertFalse(BanphraseCheckService.rate_limited('1.2.3.4', now=60))
+        finally:
+            RedisManager.redis = old_redis
+            BanphraseCheckService.rate_limit = rate_limit
+
+    def test_web_regex_timeout(self):
+        import pajbot.models.user  # noqa
+        from pajbot.models.banphrase import Banphrase
+        from pajbot.models.banphrase import BanphraseManager
+
+        banphrases = [Banphrase(phrase=phrase, operator='regex', sub_immunity=False) for phrase in ['fo+', '(x+x+)+y']]
+
+        # Without a bot, a regex banphrase that times out is only skipped and never disabled
+        manager = BanphraseManager(None)
+        manager.enabled_banphrases = list(banphrases)
+        manager.rebuild_matcher(changed=False)
+        self.assertIsNone(manager.matcher.on_regex_timeout)
+
+        self.assertEqual(manager.matcher.check('x' * 5000, None), [])
+        self.assertIsNone(manager.matcher.verdicts.get('x' * 5000))
+        self.assertEqual(manager.enabled_banphrases, banphrases)
+        self.assertIsNot(banphrases[1].enabled, False)
+
+        self.assertEqual(manager.matcher.check('foo', None), [banphrases[0]])
+        self.assertEqual(list(manager.matcher.verdicts.get('foo')), [banphrases[0]])
+
+    def test_verdict_cache(self):
+        import pajbot.models.user  # noqa
+        from pajbot.models.banphrase import Banphrase
+        from pajbot.models.banphrase import BanphraseMatcher
+
+        class Sub:
+            subscriber = True
+
+        banphrases = [
+                Banphrase(phrase='Kappa', operator='contains', sub_immunity=False),
+                Banphrase(phrase='Keepo', operator='contains', sub_immunity=True),
+                ]
+        matcher = BanphraseMatcher(banphrases, cache_size=2)
+
+        self.assertEqual(matcher.check('Kappa Keepo', None), banphrases)
+        self.assertEqual(matcher.verdicts.stats(), {'size': 1, 'hits': 0, 'misses': 1})
+
+        # The cached verdict still applies sub immunity
+        self.assertEqual(matcher.check('Kappa Keepo', Sub()), [banphrases[0]])
+        self.assertEqual(matcher.check('Keepo', Sub()), [])
+        self.assertEqual(matcher.check('Keepo', None), [banphrases[1]])
+        self.assertEqual(matcher.verdicts.stats(), {'size': 2, 'hits': 2, 'misses': 2})
+
+        matcher.check('hello', None)
+        self.assertEqual(len(matcher.verdicts), 2)
+        self.assertNotIn('Kappa Keepo', matcher.verdicts.entries)
+
+
+class TestMessageContext(unittest2.TestCase):
+    def test_message_context(self):
+        from pajbot.models.message import MessageContext
+
+        message_context = MessageContext(None, None, 'Hello Wörld  Kappa', None)
+
+        self.assertEqual(message_context.lower, 'hello wörld  kappa')
+        self.assertEqual(message_context.unidecoded, 'Hello World  Kappa')
+        self.assertEqual(message_context.words, ['Hello', 'Wörld', '', 'Kappa'])
+        self.assertEqual(message_context.words_lower, ['hello', 'wörld', '', 'kappa'])
+        self.assertEqual(message_context.tags, {})
+        self.assertEqual(message_context.format_message(True, True), 'hello world  kappa')
+        self.assertIs(message_context.words, message_context.words)
+
+    def test_trigger_context(self):
+        from pajbot.managers.handler import HandlerManager
+        from pajbot.models.message import MessageContext
+
+        calls = []
+
+        def legacy_handler(source, message):
+            calls.append(('legacy', source, message))
+
+        def context_handler(message_context):
+            calls.append(('context', message_context.message))
+            return False
+
+        def never_called(message_context):
+            calls.append(('never', ))
+
+        HandlerManager.init_handlers()
+        HandlerManager.add_handler('on_pubmsg', legacy_handler, priority=100)
+        HandlerManager.add_handler('on_pubmsg', context_handler, priority=50, context=True)
+        HandlerManager.add_handler('on_pubmsg', never_called, priority=0, context=True)
+
+        res = HandlerManager.trigger_context('on_pubmsg', MessageContext(None, 'pajlada', 'xD', None))
+        self.assertIs(res, False)
+        self.assertEqual(calls, [('legacy', 'pajlada', 'xD'), ('context', 'xD')])
+
+
+class TestHandlerProfiler(unittest2.TestCase):
+    def test_profiler(self):
+        from pajbot.managers.handler import HandlerManager
+        from pajbot.managers.handler import HandlerProfiler
+
+        def fast_handler(source, message):
+            pass
+
+        HandlerManager.init_handlers()
+        HandlerManager.add_handler('on_pubmsg', fast_handler)
+        profiler = HandlerManager.enable_profiling(slow_threshold=10)
+        try:
+            for i in range(10):
+                HandlerManager.trigger('on_pubmsg', 'pajlada', 'xD')
+            profiler.record('on_pubmsg', fast_handler, 0.02, ('pajlada', 'xD'))
+
+            summary = profiler.summary(event='on_pubmsg')
+            self.assertEqual(len(summary), 1)
+            self.assertEqual(summary[0]['handler'], 'TestHandlerProfiler.test_profiler.<locals>.fast_handler')
+            self.assertEqual(summary[0]['calls'], 11)
+            self.assertEqual(summary[0]['p50_ms'], 0.1)
+            self.assertEqual(summary[0]['p99_ms'], 25)
+            self.assertGreaterEqual(summary[0]['max_ms'], 20)
+            self.assertEqual(profiler.summary(event='on_message'), [])
+
+            self.assertEqual(HandlerProfiler.describe(('pajlada', 'xD')), "'pajlada', 'xD'")
+
+            # The last bucket has no upper bound, the slowest call is reported instead of infinity
+            profiler.record('on_pubmsg', fast_handler, 2.5, ('pajlada', 'xD'))
+            summary = profiler.summary(event='on_pubmsg')
+            self.assertAlmostEqual(summary[0]['p99_ms'], 2500)
+            self.assertEqual(summary[0]['p50_ms'], 0.1)
+        finally:
+            HandlerManager.profiler = None
+
+    def test_debug_command(self):
+        import pajbot.models.user  # NOQA
+        from pajbot.managers.handler import HandlerManager
+        from pajbot.modules.basic.debug import DebugModule
+
+        class Bot:
+            slow_handler_threshold = 0.2
+
+            def __init__(self):
+                self.whispers = []
+
+            def whisper(self, username, message):
+                self.whispers.append(message)
+
+        class Source:
+            username = 'pajlada'
+
+        bot = Bot()
+        try:
+            # !debug handlers on uses the slow_handler_ms from the config, like the bot does
+            DebugModule().debug_handlers(message='on', bot=bot, source=Source())
+            self.assertEqual(HandlerManager.profiler.slow_threshold, 0.2)
+            self.assertEqual(bot.whispers, ['Handler profiling enabled'])
+        finally:
+            HandlerManager.profiler = None
+
+
+class TestOutboundQueue(unittest2.TestCase):
+    def setUp(self):
+        from pajbot.managers.connection import OutboundQueue
+        from pajbot.managers.connection import RateLimiter
+
+        self.sent = []
+        self.scheduled = []
+        self.queue = OutboundQueue(
+                lambda channel, message: self.sent.append(message),
+                RateLimiter(lambda: 2, 30),
+                lambda delay, function: self.scheduled.append(delay))
+
+    def test_rate_limit(self):
+        self.queue.push('#pajlada', 'a', now=0)
+        self.queue.push('#pajlada', 'b', now=1)
+        self.queue.push('#pajlada', 'c', now=2)
+        self.queue.push('#pajlada', 'd', now=3)
+
+        self.assertEqual(self.sent, ['a', 'b'])
+        self.assertEqual(self.scheduled, [28])
+        self.assertEqual(len(self.queue), 2)
+
+        self.queue.drain(now=30)
+        self.assertEqual(self.sent, ['a', 'b', 'c'])
+        self.assertEqual(self.scheduled, [28, 1])
+
+        self.queue.drain(now=31)
+        self.assertEqual(self.sent, ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(self.queue), 0)
+
+        stats = self.queue.stats(now=31)
+        self.assertEqual(stats['sent'], 4)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(stats['wait_max_s'], 28)
+
+    def test_priority_and_coalescing(self):
+        self.queue.push('#pajlada', 'a', now=0)
+        self.queue.push('#pajlada', 'b', now=0)
+        self.queue.push('#jtv', '/w pajlada hi', now=0)
+        self.queue.push('#pajlada', 'c', now=0)
+        self.queue.push('#pajlada', 'c', now=0)
+        self.queue.push('#pajlada', '.timeout troll 600', counted=False, now=0)
+        self.queue.push('#pajlada', '.timeout troll 600', counted=False, now=0)
+
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.queue.stats(now=0)['coalesced'], 2)
+
+        # The timeout is not counted, so it does not take the place of a chat message
+        self.queue.drain(now=30)
+        self.assertEqual(self.sent, ['a', 'b', '.timeout troll 600', 'c', '/w pajlada hi'])
+
+    def test_no_connection(self):
+        from pajbot.managers.connection import OutboundQueue
+        from pajbot.managers.connection import RateLimiter
+
+        queue = OutboundQueue(lambda channel, message: False, RateLimiter(lambda: 2, 30), lambda delay, function: self.scheduled.append(delay))
+        queue.push('#pajlada', 'a', now=0)
+        queue.push('#pajlada', 'b', now=0)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(self.scheduled, [OutboundQueue.RETRY_DELAY])
+
+
+class TestSendConnections(unittest2.TestCase):
+    def test_pool(self):
+        import threading
+        from pajbot.managers.connection import Connection
+        from pajbot.managers.connection import ConnectionManager
+
+        class FakeConnection(Connection):
+            def __init__(self, reactor, send_only=False):
+                super().__init__(reactor, send_only=send_only)
+                self.connected = True
+                self.joined = []
+                self.messages = []
+
+            def join(self, channel, key=''):
+                self.joined.append(channel)
+
+            def ping(self, target, target2=''):
+                pass
+
+            def privmsg(self, target, text):
+                self.messages.append((target, text))
+
+            def disconnect(self, message=''):
+                self.connected = False
+
+        class FakeReactor:
+            mutex = threading.RLock()
+            connections = []
+
+        class FakeBot:
+            def execute_delayed(self, delay, function, arguments=()):
+                pass
+
+        manager = ConnectionManager(FakeReactor(), FakeBot(), 'pajlada', '', num_send_connections=2)
+        manager.make_new_connection = lambda send_only=False: FakeConnection(FakeReactor, send_only=send_only)
+        manager.main_conn = FakeConnection(FakeReactor)
+        manager.main_conn.in_channel = True
+
+        manager.maintain_send_connections()
+        self.assertEqual(len(manager.send_conns), 2)
+        self.assertEqual(manager.send_conns[0].joined, ['#pajlada'])
+
+        for i in range(4):
+            manager.send_message('#pajlada', str(i))
+        self.assertEqual([len(conn.messages) for conn in manager.send_conns], [2, 2])
+        self.assertEqual(manager.main_conn.messages, [])
+
+        # A connection that stopped answering pings is replaced
+        first, second = manager.send_conns
+        first.last_pong -= ConnectionManager.PONG_TIMEOUT + 1
+        manager.maintain_send_connections()
+        self.assertNotIn(first, manager.send_conns)
+        self.assertIn(second, manager.send_conns)
+        self.assertEqual(len(manager.send_conns), 2)
+
+        # Without healthy send connections, messages are sent from the main connection
+        for conn in manager.send_conns:
+            conn.connected = False
+        manager.send_message('#pajlada', 'hi')
+        self.assertEqual(manager.main_conn.messages, [('#pajlada', 'hi')])
+
+
+class TestWhisperQueue(unittest2.TestCase):
+    def setUp(self):
+        from pajbot.managers.connection import CombinedRateLimiter
+        from pajbot.managers.connection import RateLimiter
+        from pajbot.managers.connection import WhisperQueue
+
+        self.sent = []
+        self.scheduled = []
+        self.queue = WhisperQueue(
+                lambda username, message: self.sent.append((username, message)),
+                CombinedRateLimiter(RateLimiter(lambda: 2, 1), RateLimiter(lambda: 3, 60)),
+                lambda delay, function: self.scheduled.append(delay))
+
+    def test_limits(self):
+        for username in ('a', 'b', 'c', 'd'):
+            self.queue.push(username, 'hi', now=0)
+
+        self.assertEqual(self.sent, [('a', 'hi'), ('b', 'hi')])
+        self.assertEqual(self.scheduled, [1])
+
+        # The per-minute limit is reached before the per-second one
+        self.queue.drain(now=1)
+        self.assertEqual(self.sent, [('a', 'hi'), ('b', 'hi'), ('c', 'hi')])
+        self.assertEqual(self.scheduled, [1, 59])
+
+        self.queue.drain(now=60)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.stats(now=60)['wait_max_s'], 60)
+
+    def test_merge(self):
+        from pajbot.managers.connection import WhisperQueue
+
+        self.queue.push('a', 'first', now=0)
+        self.queue.push('b', 'first', now=0)
+        self.queue.push('a', 'second', now=0)
+        self.queue.push('a', 'third', now=0)
+        self.queue.push('c', 'first', now=0)
+        self.queue.push('a', 'x' * WhisperQueue.MAX_LENGTH, now=0)
+
+        # The first whispers to a and b were sent right away
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.queue.stats(now=0)['merged'], 1)
+
+        self.queue.drain(now=1)
+        self.queue.drain(now=60)
+        self.assertEqual(self.sent, [
+            ('a', 'first'),
+            ('b', 'first'),
+            ('a', 'second | third'),
+            ('c', 'first'),
+            ('a', 'x' * WhisperQueue.MAX_LENGTH),
+            ])
+
+    def test_backlog(self):
+        from pajbot.managers.connection import WhisperQueue
+
+        queue = WhisperQueue(lambda username, message: False, self.queue.limiter, lambda delay, function: None)
+        queue.MAX_BACKLOG = 2
+
+        self.assertTrue(queue.push('a', 'hi', now=0))
+        self.assertTrue(queue.push('b', 'hi', now=0))
+        self.assertFalse(queue.push('c', 'hi', now=0))
+        self.assertTrue(queue.push('a', 'again', now=0))
+        self.assertEqual(queue.stats(now=0)['dropped'], 1)
+
+
+class TestModerationManager(unittest2.TestCase):
+    def setUp(self):
+        from pajbot.managers.connection import OutboundQueue
+        from pajbot.managers.connection import RateLimiter
+        from pajbot.managers.irc import MultiIRCManager
+
+        self.sent = []
+        queue = OutboundQueue(
+                lambda channel, message: self.sent.append(message),
+                RateLimiter(lambda: 3, 30),
+                lambda delay, function: None)
+
+        class FakeConnectionManager:
+            outbound = queue
+
+        class FakeIRC(MultiIRCManager):
+            def __init__(self):
+                self.connection_manager = FakeConnectionManager()
+
+        class FakeBot:
+            channel = '#pajlada'
+            irc = FakeIRC()
+
+        self.queue = queue
+        self.bot = FakeBot()
+
+    def test_moderate_bulk(self):
+        import time
+        from pajbot.managers.moderation import ModerationManager
+
+        finished = []
+        moderation = ModerationManager(self.bot)
+        self.queue.push('#pajlada', 'Hello')
+        job = moderation.moderate_bulk(['a', 'B', 'b', ' ', 'c', 'd'], 'timeout', duration=60, reason='nuked', on_finished=finished.append)
+
+        self.assertEqual(job.usernames, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.sent, ['Hello', '.timeout a 60 nuked', '.timeout b 60 nuked'])
+        self.assertEqual(job.num_sent, 2)
+        self.assertEqual(moderation.jobs, [job])
+
+        # Moderation commands go before chat messages
+        self.queue.push('#pajlada', 'Chat message')
+        self.queue.drain(now=time.time() + 31)
+        self.assertEqual(self.sent[3:], ['.timeout c 60 nuked', '.timeout d 60 nuked', 'Chat message'])
+
+        self.assertEqual(finished, [job])
+        self.assertFalse(job.cancelled)
+        self.assertEqual(moderation.jobs, [])
+        self.assertTrue(job.progress().startswith('4/4 users timed out'))
+
+    def test_cancel(self):
+        from pajbot.managers.moderation import ModerationManager
+
+        finished = []
+        moderation = ModerationManager(self.bot)
+        job = moderation.moderate_bulk(['user{}'.format(i) for i in range(10)], 'ban', reason='bye', on_finished=finished.append)
+
+        self.assertEqual(job.num_sent, 3)
+        self.assertEqual(moderation.cancel(job), 7)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(finished, [job])
+        self.assertTrue(job.cancelled)
+        self.assertEqual(moderation.cancel(job), 0)
+
+
+class TestRecentChat(unittest2.TestCase):
+    def test_recent_chat(self):
+        import regex
+        from pajbot.managers.recentchat import RecentChatManager
+
+        recent_chat = RecentChatManager(max_size=4)
+        recent_chat.add('a', 'TriHard 7', timestamp=100)
+        recent_chat.add('b', 'hello', timestamp=110)
+        recent_chat.add('c', 'trihard', timestamp=120)
+        recent_chat.add('a', 'TriHard TriHard', timestamp=130)
+        recent_chat.add('d', 'xD TriHard', timestamp=140)
+
+        # The oldest message was pushed out
+        self.assertEqual(len(recent_chat), 4)
+        self.assertEqual([m.message for m in recent_chat.last(username='a')], ['TriHard TriHard'])
+        self.assertNotIn('b', [m.username for m in recent_chat.last(count=3)])
+
+        self.assertEqual(recent_chat.find_users(phrase='TriHard'), ['a', 'd'])
+        self.assertEqual(recent_chat.find_users(phrase='TriHard', ignore_case=True), ['c', 'a', 'd'])
+        self.assertEqual(recent_chat.find_users(phrase='TriHard', seconds=10, now=145), ['d'])
+        self.assertEqual(recent_chat.find_users(phrase='TriHard', count=1), ['d'])
+        self.assertEqual(recent_chat.find_users(regex=r'^TriHard'), ['a'])
+        self.assertEqual([m.timestamp for m in recent_chat.search(regex=r'(?i)^trihard')], [120, 130])
+
+        with self.assertRaises(regex.error):
+            recent_chat.search(regex='(')
+
+        recent_chat.add('e', '1', timestamp=150)
+        recent_chat.add('e', '2', timestamp=160)
+        recent_chat.add('e', '3', timestamp=170)
+        self.assertEqual(sorted(recent_chat.user_messages), ['d', 'e'])
+
+        recent_chat.add('f', 'x' * 5000, timestamp=180)
+        with self.assertRaises(TimeoutError):
+            recent_chat.search(regex='(x+x+)+y', timeout=0.1)
+
+
+class TestChatLog(unittest2.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_chat_log(self):
+        import calendar
+        import datetime
+        import os
+        from pajbot.managers.chatlog import ChatLog
+        from pajbot.managers.chatlog import ChatLogWriter
+
+        day = calendar.timegm(datetime.date(2017, 3, 1).timetuple())
+        chat_log = ChatLog(self.directory)
+        writer = ChatLogWriter(chat_log)
+
+        writer.add('pajlada', 'Kappa 123', timestamp=day + 10)
+        writer.add('forsen', 'forsenE', timestamp=day + 20)
+        writer.add('pajlada', 'hello\tworld', timestamp=day + 130)
+        writer.flush()
+        writer.add('forsen', 'Kappa', timestamp=day + 3600)
+        writer.flush()
+
+        segment = chat_log.segment(datetime.date(2017, 3, 1))
+        self.assertFalse(segment.compressed)
+        self.assertEqual(segment.users, {'pajlada': [0, 2], 'forsen': [0, 60]})
+
+        end = day + 86400 * 2
+        self.assertEqual(chat_log.user_messages('pajlada', end=end), [(day + 10, 'pajlada', 'Kappa 123'), (day + 130, 'pajlada', 'hello\tworld')])
+        self.assertEqual(chat_log.user_messages('pajlada', start=day + 60, end=end), [(day + 130, 'pajlada', 'hello\tworld')])
+        self.assertEqual(chat_log.user_messages('pajlada', end=end, limit=1), [(day + 130, 'pajlada', 'hello\tworld')])
+
+        # The first message of the next day rolls the segment
+        writer.add('forsen', 'next day Kappa', timestamp=day + 86400 + 5)
+        writer.close()
+
+        segment = chat_log.segment(datetime.date(2017, 3, 1))
+        self.assertTrue(segment.compressed)
+        self.assertFalse(os.path.exists(segment.log_path))
+        self.assertEqual(chat_log.dates(), [datetime.date(2017, 3, 1), datetime.date(2017, 3, 2)])
+
+        self.assertEqual(chat_log.user_messages('pajlada', end=end), [(day + 10, 'pajlada', 'Kappa 123'), (day + 130, 'pajlada', 'hello\tworld')])
+        end = day + 86400 + 60
+        self.assertEqual([line[2] for line in chat_log.search(phrase='Kappa', end=end, days=2)], ['Kappa 123', 'Kappa', 'next day Kappa'])
+        self.assertEqual([line[2] for line in chat_log.search(phrase='Kappa', end=end, days=1)], ['next day Kappa'])
+        self.assertEqual([line[2] for line in chat_log.search(phrase='Kappa', start=day + 60, end=end, days=2, limit=2)], ['Kappa', 'next day Kappa'])
+        self.assertEqual([line[2] for line in chat_log.search(regex='^forsen', end=end, days=2)], ['forsenE'])
+        self.assertEqual(chat_log.user_messages('nobody', end=end), [])
+
+        writer = ChatLogWriter(chat_log)
+        writer.add('pajlada', 'x' * 5000, timestamp=day + 86400 + 30)
+        writer.close()
+        with self.assertRaises(TimeoutError):
+            chat_log.search(regex='(x+x+)+y', end=end, days=2, timeout=0.1)
+
+
+class TestLinkTrie(unittest2.TestCase):
+    def test_find(self):
+        from pajbot.modules.linkchecker import LinkTrie
+
+        trie = LinkTrie()
+        trie.add('pajlada.se', '/', 'a')
+        trie.add('www.forsen.tv', '/foo/', 'b')
+        trie.add('test.pajlada.com', '/foo/bar', 'c')
+
+        self.assertEqual(len(trie), 3)
+        self.assertEqual(list(trie.find('pajlada.se', '/')), ['a'])
+        self.assertEqual(list(trie.find('test.pajlada.se', '/abc/def')), ['a'])
+        self.assertEqual(list(trie.find('forsen.tv', '/foo')), ['b'])
+        self.assertEqual(list(trie.find('www.forsen.tv', '/foo/bar')), ['b'])
+        self.assertEqual(list(trie.find('a.test.pajlada.com', '/foo/bar/')), ['c'])
+
+        self.assertEqual(list(trie.find('pajlada.com', '/foo/bar')), [])
+        self.assertEqual(list(trie.find('forsen.tv', '/foobar')), [])
+        self.assertEqual(list(trie.find('apajlada.se', '/')), [])
+
+        self.assertTrue(trie.remove('pajlada.se', '/', 'a'))
+        self.assertFalse(trie.remove('pajlada.se', '/', 'a'))
+        self.assertEqual(len(trie), 2)
+        self.assertEqual(list(trie.find('pajlada.se', '/')), [])
+
+    def test_same_as_is_subdomain_and_is_subpath(self):
+        from pajbot.modules.linkchecker import LinkTrie, is_subdomain, is_subpath
+
+        links = [(domain, path) for domain in ['pajlada.se', 'www.pajlada.se', 'test.pajlada.se', 'se', 'pajlada.com']
+                 for path in ['', '/', '/a', '/a/', '/a/b', '/ab', '/a//', 'a']]
+        urls = [(domain, path) for domain in ['pajlada.se', 'www.pajlada.se', 'a.test.pajlada.se', 'xpajlada.se', 'pajlada.com', 'se']
+                for path in ['/', '/a', '/a/', '/a/b', '/a/bc', '/ab', '/a//b', '/b/a']]
+
+        trie = LinkTrie()
+        for link in links:
+            trie.add(link[0], link[1], link)
+
+        for domain, path in urls:
+            expected = set(link for link in links if is_subdomain(domain, link[0]) and is_subpath(path, link[1]))
+            self.assertEqual(set(trie.find(domain, path)), expected, '{}{}'.format(domain, path))
+
+
+class TestLinkCheckerCache(unittest2.TestCase):
+    def test_expiry(self):
+        from pajbot.modules.linkchecker import LinkCheckerCache
+
+        cache = LinkCheckerCache()
+        cache.set('http://pajlada.se/', True, 20, now=1000)
+        cache.set('http://forsen.tv', False, 600, now=1000)
+
+        self.assertTrue(cache.get('HTTP://PAJLADA.SE', now=1010))
+        self.assertIs(cache.get('http://forsen.tv', now=1010), False)
+        self.assertIsNone(cache.get('http://kastaren.com', now=1010))
+
+        self.assertIsNone(cache.get('http://pajlada.se', now=1020))
+        self.assertIs(cache.get('http://forsen.tv', now=1500), False)
+        self.assertEqual(len(cache), 1)
+
+    def test_lru(self):
+        from pajbot.modules.linkchecker import LinkCheckerCache
+
+        cache = LinkCheckerCache(max_size=2)
+        cache.set('http://a.com', True, 60, now=1000)
+        cache.set('http://b.com', True, 60, now=1000)
+        cache.get('http://a.com', now=1001)
+        cache.set('http://c.com', False, 60, now=1002)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get('http://a.com', now=1003))
+        self.assertIsNone(cache.get('http://b.com', now=1003))
+        self.assertIs(cache.get('http://c.com', now=1003), False)
+
+        cache.clear(safe=False)
+        self.assertTrue(cache.get('http://a.com', now=1003))
+        self.assertIsNone(cache.get('http://c.com', now=1003))
+
+    def test_redis(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed, see requirements/bench.txt')
+
+        from pajbot.modules.linkchecker import LinkCheckerCache
+
+        redis = fakeredis.FakeRedis(decode_responses=True)
+        redis.flushall()
+        cache = LinkCheckerCache(redis=redis)
+        cache.set('http://a.com', True, 60)
+        cache.set('http://c.com', False, 60)
+
+        # A new process gets the verdicts from redis
+        cache = LinkCheckerCache(redis=redis)
+        self.assertTrue(cache.get('http://a.com'))
+        self.assertIs(cache.get('http://c.com'), False)
+
+        # Clearing the bad verdicts only makes the bad verdicts in redis outdated
+        cache.clear(safe=False)
+        cache = LinkCheckerCache(redis=redis)
+        self.assertTrue(cache.get('http://a.com'))
+        self.assertIsNone(cache.get('http://c.com'))
+
+        cache.set('http://c.com', False, 60)
+        cache = LinkCheckerCache(redis=redis)
+        self.assertIs(cache.get('http://c.com'), False)
+
+    def test_redis_setting(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed, see requirements/bench.txt')
+
+        import pajbot.models.user  # NOQA
+        from pajbot.managers.redis import RedisManager
+        from pajbot.modules.linkchecker import LinkCheckerModule
+
+        class Bot:
+            streamer = 'pajlada'
+
+        old_redis = RedisManager.redis
+        RedisManager.redis = fakeredis.FakeRedis(decode_responses=True)
+
+        module = LinkCheckerModule()
+        module.bot = Bot()
+        module.apply_settings()
+        self.assertIsNone(module.cache.redis)
+
+        # Settings changed on the web only load the module again
+        module.load(settings={'check_workers': 1, 'cache_in_redis': True})
+        self.assertIs(module.cache.redis, RedisManager.redis)
+        self.assertEqual(module.cache.redis_prefix, 'pajlada:linkchecker:cache:')
+
+        module.load(settings={'check_workers': 1, 'cache_in_redis': False})
+        self.assertIsNone(module.cache.redis)
+
+        RedisManager.redis = old_redis
+
+
+class TestLinkCheckQueue(unittest2.TestCase):
+    def test_too_many_redirects(self):
+        import requests
+
+        import pajbot.models.user  # NOQA
+        from pajbot.modules.linkchecker import LinkCheckerModule
+
+        class RedirectLoopSession:
+            def head(self, url, **options):
+                raise requests.exceptions.TooManyRedirects()
+
+        class Action:
+            num_runs = 0
+
+            def run(self):
+                self.num_runs += 1
+
+        # A link behind too many redirects could not be checked, the lag policy decides what happens to it
+        module = LinkCheckerModule()
+        module.load()
+        action = Action()
+        module.check_url('http://redirect.loop/a', action, session=RedirectLoopSession())
+
+        self.assertEqual(action.num_runs, 0)
+        self.assertEqual(module.check_queue.num_failed_open, 1)
+        self.assertIsNone(module.cache.get('http://redirect.loop/a'))
+
+        module.load(settings={'check_lag_policy': 'Time out the user'})
+        module.check_url('http://redirect.loop/a', action, session=RedirectLoopSession())
+
+        self.assertEqual(action.num_runs, 1)
+        self.assertIsNone(module.cache.get('http://redirect.loop/a'))
+
+    def test_settings(self):
+        import pajbot.models.user  # NOQA
+        from pajbot.modules.linkchecker import LinkCheckerModule
+
+        # The module can be enabled before its settings are loaded
+        module = LinkCheckerModule()
+        module.apply_settings()
+        self.assertEqual(module.check_queue.per_host_limit, 2)
+        self.assertEqual(module.check_queue.max_lag, 30)
+        self.assertIs(module.check_queue.fail_closed, False)
+
+        # Settings changed on the web only load the module again
+        module.load(settings={'check_host_limit': 5, 'check_max_lag': 0, 'check_lag_policy': 'Time out the user'})
+        self.assertEqual(module.check_queue.per_host_limit, 5)
+        self.assertEqual(module.check_queue.max_lag, 0)
+        self.assertIs(module.check_queue.fail_closed, True)
+
+    def test_coalesce_and_host_limit(self):
+        from pajbot.actions import Action
+        from pajbot.modules.linkchecker import LinkCheckQueue
+
+        timeouts = []
+        queue = LinkCheckQueue(None, per_host_limit=1)
+        queue.add('http://a.com/1', Action(timeouts.append, args=['user1']), now=1000)
+        queue.add('http://A.com/1/', Action(timeouts.append, args=['user2']), now=1000)
+        queue.add('http://a.com/2', None, now=1000)
+        queue.add('http://b.com/', None, now=1000)
+
+        self.assertEqual(queue.stats(now=1000)['depth'], 3)
+        self.assertEqual(queue.num_coalesced, 1)
+
+        job = queue.next_job(now=1001)
+        self.assertEqual(job.url, 'http://a.com/1')
+
+        # a.com is at its limit, so b.com goes first
+        self.assertEqual(queue.next_job(now=1001).url, 'http://b.com/')
+        self.assertIsNone(queue.next_job(now=1001))
+
+        # Running the job runs the actions of every message the URL was in, even the ones that come in later
+        job.run()
+        queue.add('http://a.com/1', Action(timeouts.append, args=['user3']), now=1002)
+        self.assertEqual(timeouts, ['user1', 'user2', 'user3'])
+
+        queue.finish(job)
+        self.assertEqual(queue.next_job(now=1002).url, 'http://a.com/2')
+
+    def test_lag_policy(self):
+        from pajbot.actions import Action
+        from pajbot.modules.linkchecker import LinkCheckQueue
+
+        timeouts = []
+        queue = LinkCheckQueue(None, max_depth=1, max_lag=30)
+        queue.add('http://a.com/', Action(timeouts.append, args=['user1']), now=1000)
+        self.assertFalse(queue.add('http://b.com/', Action(timeouts.append, args=['user2']), now=1000))
+        self.assertIsNone(queue.next_job(now=1031))
+        self.assertEqual(queue.num_failed_open, 2)
+        self.assertEqual(timeouts, [])
+
+        queue.fail_closed = True
+        queue.add('http://a.com/', Action(timeouts.append, args=['user1']), now=1000)
+        self.assertIsNone(queue.next_job(now=1031))
+        self.assertEqual(queue.num_failed_closed, 1)
+        self.assertEqual(timeouts, ['user1'])
+
+
+class TestUserTagCache(unittest2.TestCase):
+    def test_lazy_expiry(self):
+        from pajbot.models.user import UserTagCache
+
+        class UserTagsRedis:
+            def __init__(self):
+                self.num_calls = 0
+
+            def hmget(self, key, usernames):
+                self.num_calls += 1
+                return ['{"forsen_sub":2000,"old_sub":1000}' if username == 'pajlada' else None for username in usernames]
+
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+        redis = UserTagsRedis()
+
+        UserTagCache.load(['pajlada', 'kastaren'], redis=redis)
+        self.assertEqual(redis.num_calls, 1)
+        self.assertEqual(UserTagCache.get('pajlada', now=1500), {'forsen_sub': 2000})
+        self.assertEqual(UserTagCache.get('kastaren', now=1500), {})
+
+        # Already loaded, no new redis calls
+        UserTagCache.load(['pajlada'], redis=redis)
+        self.assertEqual(redis.num_calls, 1)
+
+        UserTagCache.add('kastaren', 'forsen_sub', 3000)
+        self.assertEqual(UserTagCache.dirty, {'kastaren'})
+        self.assertEqual(UserTagCache.get('kastaren', now=2500), {'forsen_sub': 3000})
+        self.assertEqual(UserTagCache.get('kastaren', now=3000), {})
+
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+
+    def test_load_more_than_max_size(self):
+        from pajbot.models.user import UserTagCache
+
+        class UserTagsRedis:
+            def __init__(self):
+                self.num_calls = 0
+
+            def hmget(self, key, usernames):
+                self.num_calls += 1
+                return ['{"trumpsc_sub":4000000000}' if username == 'user0' else None for username in usernames]
+
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+        max_size = UserTagCache.max_size
+        UserTagCache.max_size = 10
+        redis = UserTagsRedis()
+
+        UserTagCache.set('pajlada', {'forsen_sub': 4000000000})
+        usernames = ['user{}'.format(i) for i in range(30)]
+        tags_per_user = UserTagCache.load(usernames, redis=redis)
+        self.assertEqual(redis.num_calls, 1)
+        self.assertEqual(len(tags_per_user), 30)
+        self.assertEqual(tags_per_user['user0'], {'trumpsc_sub': 4000000000})
+        self.assertEqual(tags_per_user['user29'], {})
+
+        # Users with changes are never evicted
+        self.assertEqual(len(UserTagCache.entries), 10)
+        self.assertIn('pajlada', UserTagCache.entries)
+        self.assertIn('user29', UserTagCache.entries)
+
+        UserTagCache.max_size = max_size
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+
+    def test_dirty_user_is_not_reloaded(self):
+        from pajbot.models.user import UserTagCache
+
+        class UserTagsRedis:
+            def __init__(self):
+                self.num_calls = 0
+
+            def hmget(self, key, usernames):
+                self.num_calls += 1
+                return ['{"forsen_sub":4000000000,"old_sub":4000000000}' for username in usernames]
+
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+        redis = UserTagsRedis()
+
+        UserTagCache.load(['pajlada'], redis=redis)
+        UserTagCache.set('pajlada', {'forsen_sub': 4000000000})
+
+        # Even after the TTL, the removed tag must not come back from redis before the flush
+        UserTagCache.entries['pajlada'][0] -= UserTagCache.TTL + 1
+        self.assertEqual(UserTagCache.load(['pajlada'], redis=redis), {'pajlada': {'forsen_sub': 4000000000}})
+        self.assertEqual(redis.num_calls, 1)
+
+        UserTagCache.entries.clear()
+        UserTagCache.dirty = set()
+
+
+class TestUserRedisBuffer(unittest2.TestCase):
+    def test_collapse_and_overlay(self):
+        import pajbot.models.user  # NOQA
+        from pajbot.models.user import UserRedis
+        from pajbot.models.user import UserRedisBuffer
+        from pajbot.streamhelper import StreamHelper
+
+        StreamHelper.init_streamer('pajlada')
+        UserRedisBuffer.pending = {}
+        UserRedisBuffer.enabled = True
+        try:
+            user = UserRedis('pajlada', redis=object())
+            user.num_lines = 5
+            user.num_lines = 6
+            user.banned = True
+            user.banned = False
+            user.username_raw = 'PajladA'
+
+            self.assertEqual(len(UserRedisBuffer.pending), 3)
+            self.assertEqual(UserRedisBuffer.pending[('pajlada:users:num_lines', 'pajlada')], ('zadd', 6))
+            self.assertEqual(UserRedisBuffer.pending[('pajlada:users:banned', 'pajlada')], ('hdel', None))
+
+            # A fresh object sees the pending writes on top of what redis returned
+            user = UserRedis('pajlada', redis=object())
+            user.load_redis_data([3.0, 0, None, None, None, None, '1'])
+            self.assertEqual(user.values['num_lines'], 6)
+            self.assertEqual(user.values['tokens'], 0)
+            self.assertEqual(user.values['username_raw'], 'PajladA')
+            self.assertIs(user.values['banned'], False)
+        finally:
+            UserRedisBuffer.pending = {}
+            UserRedisBuffer.enabled = False
+
+
+class TestUserCache(unittest2.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from collections import OrderedDict
+
+        import pajbot.models.user  # NOQA
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        from pajbot.managers.db import DBManager
+        from pajbot.models.user import User
+        from pajbot.models.user import UserCache
+
+        self.tmpdir = tempfile.mkdtemp()
+        DBManager.engine = create_engine('sqlite:///' + os.path.join(self.tmpdir, 'pajbot.db'))
+        DBManager.Session = sessionmaker(bind=DBManager.engine, autoflush=False)
+        User.__table__.create(DBManager.engine)
+
+        UserCache.entries = OrderedDict()
+        UserCache.dirty = set()
+        UserCache.evicted = {}
+        UserCache.init(max_size=2, ttl=60)
+
+    def tearDown(self):
+        import shutil
+        from collections import OrderedDict
+
+        from pajbot.managers.db import DBManager
+        from pajbot.models.user import UserCache
+
+        DBManager.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+        UserCache.enabled = False
+        UserCache.entries = OrderedDict()
+        UserCache.dirty = set()
+        UserCache.evicted = {}
+
+    def get_points(self, username):
+        from pajbot.managers.db import DBManager
+        from pajbot.models.user import User
+
+        with DBManager.create_session_scope() as db_session:
+            user = db_session.query(User).filter_by(username=username).one_or_none()
+            return None if user is None else user.points
+
+    def test_write_behind(self):
+        from pajbot.models.user import UserCache
+        from pajbot.models.user import UserCombined
+
+        user = UserCombined('pajlada')
+        user.points = 5
+        user.save()
+        self.assertIsNone(self.get_points('pajlada'))
+
+        self.assertEqual(UserCache.flush(), 1)
+        self.assertEqual(self.get_points('pajlada'), 5)
+        self.assertEqual(UserCache.flush(), 0)
+
+        # The cached model is shared by every user object
+        user = UserCombined('pajlada')
+        self.assertEqual(user.points, 5)
+        self.assertIs(user.user_model, UserCache.get_model('pajlada'))
+
+    def test_lazy_user(self):
+        from pajbot.models.user import UserCache
+        from pajbot.models.user import UserCombined
+
+        user = UserCombined('pajlada')
+        user.subscriber = True
+        self.assertFalse(user.model_loaded)
+        user.save()
+        self.assertFalse(user.model_loaded)
+
+        # Users that only had values set are loaded and created during the flush
+        self.assertEqual(UserCache.flush(), 1)
+        user = UserCombined('pajlada')
+        self.assertIs(user.subscriber, True)
+        self.assertIsNotNone(user.id)
+
+        # Setting a value to what it already is does not make the user dirty
+        user.subscriber = True
+        self.assertFalse(user.sql_dirty())
+        user.save()
+        self.assertEqual(UserCache.flush(), 0)
+
+    def test_eviction(self):
+        from pajbot.models.user import UserCache
+        from pajbot.models.user import UserCombined
+
+        user = UserCombined('pajlada')
+        user.points = 10
+        user.save()
+        UserCache.set_extra('forsen', {'debts': [50]})
+
+        UserCombined('a').level
+        UserCombined('b').level
+
+        # pajlada is evicted, but still has to be written back
+        self.assertNotIn('pajlada', UserCache.entries)
+        self.assertIn('pajlada', UserCache.evicted)
+        self.assertEqual(UserCache.get_extra('forsen'), {'debts': [50]})
+
+        self.assertEqual(UserCache.flush(), 1)
+        self.assertEqual(self.get_points('pajlada'), 10)
+        self.assertEqual(UserCache.evicted, {})
+        self.assertLessEqual(len(UserCache.entries), 2)
+
+    def test_threads(self):
+        import threading
+
+        from pajbot.models.user import UserCache
+
+        def set_pending(prefix):
+            for i in range(200):
+                UserCache.set_pending('{}{}'.format(prefix, i), {'points': i})
+
+        # Entries are evicted all the time with max_size 2, no pending values must get lost
+        threads = [threading.Thread(target=set_pending, args=(prefix, )) for prefix in 'abcd']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(UserCache.flush(), 800)
+        self.assertEqual(self.get_points('c199'), 199)
+
+    def test_uncached(self):
+        from pajbot.models.user import UserCache
+        from pajbot.models.user import UserCombined
+        from pajbot.models.user import UserSQLCache
+
+        UserCache.enabled = False
+        UserSQLCache.cache = {}
+
+        user = UserCombined('pajlada')
+        user.subscriber = True
+        self.assertTrue(user.model_loaded)
+        user.save()
+
+        # Without the UserCache, saved users are remembered by the UserSQLCache
+        user = UserCombined('pajlada')
+        user.subscriber = True
+        self.assertIs(user.subscriber, True)
+        self.assertEqual(user.level, 100)
+        self.assertFalse(user.model_loaded)
+
+        user.subscriber = False
+        self.assertTrue(user.model_loaded)
+        user.save()
+        self.assertIs(UserCombined('pajlada').subscriber, False)
+
+        UserSQLCache.cache = {}
+
+
+class TestBenchReplay(unittest2.TestCase):
+    def test_parse_line(self):
+        from pajbot.bench.replay import parse_line
+        from pajbot.bench.replay import percentile
+
+        event = parse_line('@display-name=Pajlada;emotes=25:0-4;subscriber=1;system-msg=a\\sb :pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #pajlada :Kappa 123 :)\r\n')
+        self.assertEqual(event.type, 'pubmsg')
+        self.assertEqual(event.source.user, 'pajlada')
+        self.assertEqual(event.target, '#pajlada')
+        self.assertEqual(event.arguments, ['Kappa 123 :)'])
+        tags = {tag['key']: tag['value'] for tag in event.tags}
+        self.assertEqual(tags['emotes'], '25:0-4')
+        self.assertEqual(tags['system-msg'], 'a b')
+
+        event = parse_line(':pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #pajlada :\x01ACTION dances\x01')
+        self.assertEqual(event.type, 'action')
+        self.assertEqual(event.arguments, ['dances'])
+
+        self.assertEqual(parse_line('@login=pajlada :tmi.twitch.tv USERNOTICE #pajlada').arguments, [])
+        self.assertIsNone(parse_line(':tmi.twitch.tv CLEARCHAT #pajlada :pajlada'))
+        self.assertIsNone(parse_line(''))
+
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 50), 3)
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 100), 5)
+        self.assertEqual(percentile([], 99), 0)
+
 
 class ActionsTester(unittest2.TestCase):
     def setUp(self):